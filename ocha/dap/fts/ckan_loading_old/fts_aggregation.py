@@ -0,0 +1,226 @@
+"""
+Answers the funding/pledges GroupBy queries of the FTS API locally, from a mirrored contributions table, rather than
+with a round trip per (query, grouping) combination.
+LocalGroupingEngine denormalizes the contributions once (attaching each one's emergency, appeal, country and project
+cluster), and indexes rows by each query field the first time it's used, so a query is a lookup of the matching row
+positions followed by a vectorized group sum.
+
+Install an engine with fts_queries.set_grouping_engine() to have fetch_grouping_type_json_as_dataframe (and so all
+the funding/pledges fetches) use it. ReconcilingGroupingEngine runs queries both locally and against the server,
+recording any differences, to check the local results can be trusted.
+"""
+
+import fts_queries
+import numpy as np
+import pandas as pd
+import threading
+
+FUNDING_STATUS_PLEDGE = 'Pledge'
+
+# the query fields of the API, and the column of the denormalized table each one filters on
+QUERY_COLUMNS = {
+    'emergency': 'emergency_id',
+    'appeal': 'appeal_id',
+    'country': 'country',
+    'donor': 'donor',
+    'recipient': 'recipient',
+    'year': 'year',
+}
+
+# the groupings of the API, and the column of the denormalized table each one groups by
+GROUPING_COLUMNS = {
+    'donor': 'donor',
+    'recipient': 'recipient',
+    'sector': 'sector',
+    'emergency': 'emergency',
+    'appeal': 'appeal',
+    'country': 'country',
+    'cluster': 'cluster',
+}
+
+DEFAULT_TOLERANCE = 0.5  # dollars
+
+
+def parse_query(query):
+    """
+    'Appeal=942' -> ('appeal', '942')
+    """
+    field, value = query.split('=', 1)
+    return field.strip().lower(), value.strip()
+
+
+def get_column_values(dataframe, column):
+    """
+    The values of column as a plain array (categoricals included), or all NaN if dataframe doesn't have it
+    """
+    if column not in dataframe.columns:
+        values = np.empty(len(dataframe))
+        values.fill(np.nan)
+        return values
+    return np.asarray(dataframe[column])
+
+
+def map_ids(ids, lookup):
+    """
+    Maps the values of ids (which may be NaN) through the Series lookup, NaN where not found
+    """
+    return pd.Series(ids).map(lookup).values
+
+
+def build_grouping_frame(middle_part, amounts, alias):
+    """
+    A frame shaped like the one fetch_grouping_type_json_as_dataframe builds from the server's response
+    """
+    if amounts.empty:
+        return pd.DataFrame()
+
+    amounts = amounts.order(ascending=False)
+    frame = pd.DataFrame({'type': amounts.index, 'amount': amounts.values}, columns=['amount', 'type'])
+
+    if alias:
+        frame = frame.rename(columns={'type': alias, 'amount': middle_part})
+        frame = frame.set_index(alias)
+
+    return frame
+
+
+class LocalGroupingEngine(object):
+    def __init__(self, contributions, emergencies=None, appeals=None, projects=None, countries=None):
+        """
+        contributions, emergencies, appeals and projects are as returned by fts_queries (indexed by id), countries is
+        used to accept ISO codes in Country= queries. Anything but the contributions can be left out, at the cost of
+        the groupings and queries that need them.
+        """
+        # positions are used as row labels from here on
+        contributions = contributions.reset_index(drop=True)
+
+        table = pd.DataFrame(dict((column, get_column_values(contributions, column)) for column in
+                                  ['emergency_id', 'appeal_id', 'donor', 'recipient', 'year', 'amount']))
+        table['is_pledge'] = get_column_values(contributions, 'status') == FUNDING_STATUS_PLEDGE
+
+        if emergencies is not None and not emergencies.empty:
+            table['emergency'] = map_ids(table.emergency_id, emergencies.title)
+            table['country'] = map_ids(table.emergency_id, emergencies.country)
+        if appeals is not None and not appeals.empty:
+            table['appeal'] = map_ids(table.appeal_id, appeals.title)
+        if projects is not None and not projects.empty:
+            projects_by_code = projects.drop_duplicates('code').set_index('code')
+            for column in ['cluster', 'sector']:
+                if column in projects_by_code.columns:
+                    table[column] = map_ids(get_column_values(contributions, 'project_code'),
+                                            projects_by_code[column])
+
+        self.table = table
+        self.index_lock = threading.Lock()
+        self.positions_by_column = {}
+
+        self.country_iso_code_to_name = {}
+        if countries is not None and not countries.empty:
+            self.country_iso_code_to_name = dict(zip(countries.iso_code_A, countries.name))
+
+    @classmethod
+    def from_country_data(cls, country_data, projects=None, countries=None):
+        """
+        Builds an engine from the tables of a fts_bulk.YearSweepCountryData (which must have loaded contributions)
+        """
+        if country_data.contributions_by_emergency is None:
+            raise ValueError('No contributions loaded to build a local grouping engine from')
+        contributions = fts_queries.concat_non_empty_dataframes(country_data.contributions_by_emergency.values())
+        return cls(contributions, emergencies=country_data.emergencies, appeals=country_data.appeals,
+                   projects=projects, countries=countries)
+
+    def get_positions(self, column, value):
+        """
+        Row positions where column has value, through an index on column built the first time it's queried
+        """
+        with self.index_lock:
+            if column not in self.positions_by_column:
+                # key everything by string, as query values come in as strings
+                keys = self.table[column].map(lambda key: unicode(int(key)) if isinstance(key, float) and key == key
+                                              else unicode(key))
+                self.positions_by_column[column] = keys.groupby(keys.values).indices
+            positions_by_value = self.positions_by_column[column]
+
+        return positions_by_value.get(value, np.array([], dtype=np.int64))
+
+    def get_amounts(self, middle_part, query, grouping):
+        """
+        Series of the summed amount for each value of the grouping, for the contributions matching the query
+        """
+        field, value = parse_query(query)
+        if field not in QUERY_COLUMNS:
+            raise ValueError('Unsupported query for local grouping: ' + query)
+        if field == 'country':
+            value = self.country_iso_code_to_name.get(value, value)
+
+        column = QUERY_COLUMNS[field]
+        if column not in self.table.columns:
+            raise ValueError('No data to answer ' + query + ' locally')
+
+        rows = self.table.take(self.get_positions(column, value))
+        rows = rows[rows.is_pledge.values == (middle_part == 'pledges')]
+
+        if not grouping:
+            return pd.Series({'Total': rows.amount.sum()}) if not rows.empty else pd.Series()
+
+        group_column = GROUPING_COLUMNS.get(grouping.lower())
+        if group_column not in self.table.columns:
+            raise ValueError('Unsupported grouping for local grouping: ' + grouping)
+
+        return rows.groupby(group_column).amount.sum()
+
+    def get_grouping(self, middle_part, query, grouping, alias):
+        """
+        Same arguments and result as fts_queries.fetch_grouping_type_json_as_dataframe
+        """
+        return build_grouping_frame(middle_part, self.get_amounts(middle_part, query, grouping), alias)
+
+
+def diff_groupings(local, remote, middle_part, alias, tolerance=DEFAULT_TOLERANCE):
+    """
+    Rows (by grouping value) where the local and server amounts differ by more than tolerance
+    """
+    def get_amounts(frame):
+        if frame.empty:
+            return pd.Series()
+        return frame[middle_part] if alias else frame.set_index('type').amount
+
+    compared = pd.DataFrame({'local': get_amounts(local), 'server': get_amounts(remote)}).fillna(0.)
+    compared['difference'] = compared.local - compared.server
+    return compared[compared.difference.abs() > tolerance]
+
+
+class ReconcilingGroupingEngine(object):
+    """
+    Answers queries from the server as usual, but also locally through engine, recording the queries where the two
+    disagree
+    """
+    def __init__(self, engine, tolerance=DEFAULT_TOLERANCE):
+        self.engine = engine
+        self.tolerance = tolerance
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.mismatches = []
+
+    def get_grouping(self, middle_part, query, grouping, alias):
+        remote = fts_queries.fetch_grouping_type_json_from_server(middle_part, query, grouping, alias)
+
+        try:
+            local = self.engine.get_grouping(middle_part, query, grouping, alias)
+            differences = diff_groupings(local, remote, middle_part, alias, self.tolerance)
+        except ValueError as error:
+            differences = pd.DataFrame({'error': [str(error)]})
+
+        with self.lock:
+            self.queries += 1
+            if not differences.empty:
+                self.mismatches.append(((middle_part, query, grouping), differences))
+
+        return remote
+
+    def print_report(self):
+        with self.lock:
+            print 'Local grouping reconciliation: %d of %d queries differ' % (len(self.mismatches), self.queries)
+            for (middle_part, query, grouping), differences in self.mismatches:
+                print middle_part, query, 'GroupBy', grouping
+                print differences.to_string()
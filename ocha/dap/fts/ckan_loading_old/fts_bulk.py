@@ -0,0 +1,150 @@
+"""
+Per-country data for FTS, either fetched country by country from the API, or loaded for all countries at once.
+Going country by country means Appeal/country, Emergency/country and then per-emergency Contribution calls for
+every single country, which adds up to thousands of round trips. Instead, YearSweepCountryData pulls the
+year-level endpoints once per year, and then partitions the results by country in memory.
+
+Both classes provide the same methods, so code written against one works with the other, and return the same
+frames: a country's rows are in id order, with the column types the per-country responses would have had.
+"""
+
+import collections
+import fts_queries
+import numpy as np
+import pandas as pd
+
+
+def remove_duplicate_ids(dataframe):
+    # something spanning years could show up in more than one year's results
+    return dataframe[~pd.Series(dataframe.index).duplicated().values]
+
+
+def coerce_integer_columns(dataframe):
+    """
+    Converts float columns holding only whole numbers to int64, as pd.read_json does for each response: a column that
+    needs floats somewhere in the all-countries frame may not within one country's rows
+    """
+    for column in dataframe.columns:
+        values = dataframe[column]
+        if values.dtype == np.float64 and len(values) and not values.isnull().any():
+            integer_values = values.astype(np.int64)
+            if (integer_values == values).all():
+                dataframe[column] = integer_values
+    return dataframe
+
+
+class LiveCountryData(object):
+    """
+    Fetches data for each country as it is asked for
+    """
+    def get_appeals(self, country):
+        return fts_queries.fetch_appeals_json_for_country_as_dataframe(country)
+
+    def get_emergencies(self, country):
+        return fts_queries.fetch_emergencies_json_for_country_as_dataframe(country)
+
+    def get_contributions_by_emergency(self, emergency_ids):
+        """
+        Returns a list of contributions dataframes, one for each of emergency_ids
+        """
+        return fts_queries.fetch_many(fts_queries.fetch_contributions_json_for_emergency_as_dataframe, emergency_ids)
+
+
+class YearSweepCountryData(object):
+    """
+    Loads appeals, emergencies and their contributions for all countries from year_start to year_end up front,
+    and indexes them by country (ISO code, as accepted by the per-country endpoints) for fast lookup.
+    Without load_contributions only the appeals and emergencies are loaded, for callers fetching contributions
+    themselves (get_contributions_by_emergency then fetches them as LiveCountryData does).
+    """
+    def __init__(self, year_start, year_end, max_workers=fts_queries.DEFAULT_MAX_WORKERS, load_contributions=True):
+        years = range(year_start, year_end + 1)
+
+        countries = fts_queries.fetch_countries_json_as_dataframe()
+        # appeals and emergencies refer to countries by name
+        self.country_name_to_iso_code = dict(zip(countries.name, countries.iso_code_A))
+
+        print 'Loading appeals and emergencies for', year_start, 'to', year_end
+        # in id order, so each country's rows come out in the same order as from the per-country endpoints
+        self.appeals = remove_duplicate_ids(fts_queries.concat_non_empty_dataframes(
+            fts_queries.fetch_many(fts_queries.fetch_appeals_json_for_year_as_dataframe, years, max_workers)))
+        self.appeals = self.appeals.sort_index()
+        self.emergencies = remove_duplicate_ids(fts_queries.concat_non_empty_dataframes(
+            fts_queries.fetch_many(fts_queries.fetch_emergencies_json_for_year_as_dataframe, years, max_workers)))
+        self.emergencies = self.emergencies.sort_index()
+
+        self.contributions_by_emergency = None
+        if load_contributions:
+            print 'Loading contributions for', len(self.emergencies), 'emergencies'
+            contributions_list = fts_queries.fetch_many(
+                fts_queries.fetch_contributions_json_for_emergency_as_dataframe, self.emergencies.index, max_workers)
+            self.contributions_by_emergency = dict(zip(self.emergencies.index, contributions_list))
+
+        # (table, country name) -> number of rows that couldn't be given to any country, see print_unpartitioned()
+        self.unpartitioned = collections.Counter()
+
+        self.appeal_positions_by_country = self.build_country_index('appeals', self.appeals)
+        self.emergency_positions_by_country = self.build_country_index('emergencies', self.emergencies)
+
+        self.print_unpartitioned()
+
+    def build_country_index(self, table_name, dataframe):
+        """
+        Hash index from country ISO code to the positions of that country's rows.
+        Rows whose country isn't in the Country list (e.g. regional appeals), or that have none, aren't in the index,
+        and are counted in unpartitioned instead.
+        """
+        if dataframe.empty:
+            return {}
+
+        positions_by_country = {}
+        grouped_rows = 0
+        for country_name, positions in dataframe.groupby('country').indices.iteritems():
+            grouped_rows += len(positions)
+            iso_code = self.country_name_to_iso_code.get(country_name)
+            if iso_code is not None:
+                positions_by_country[iso_code] = positions
+            else:
+                self.unpartitioned[(table_name, country_name)] += len(positions)
+
+        # groupby leaves out the rows with no country at all
+        if grouped_rows < len(dataframe):
+            self.unpartitioned[(table_name, '(none)')] += len(dataframe) - grouped_rows
+
+        return positions_by_country
+
+    def print_unpartitioned(self):
+        """
+        Reports the rows left out of every country's data. The per-country endpoints may still return some of them
+        (Appeal/country can include regional appeals), in which case the files produced from this differ.
+        """
+        if not self.unpartitioned:
+            return
+
+        print 'Warning: %d rows not matched to any country:' % sum(self.unpartitioned.values())
+        for (table_name, country_name), count in sorted(self.unpartitioned.iteritems()):
+            print '  %s: %d with country %s' % (table_name, count, country_name)
+
+    def get_partition(self, dataframe, positions_by_country, country):
+        positions = positions_by_country.get(country)
+        if positions is None:
+            return pd.DataFrame()  # same as the per-country endpoints return when there's nothing
+
+        return coerce_integer_columns(dataframe.take(positions))
+
+    def get_appeals(self, country):
+        return self.get_partition(self.appeals, self.appeal_positions_by_country, country)
+
+    def get_emergencies(self, country):
+        return self.get_partition(self.emergencies, self.emergency_positions_by_country, country)
+
+    def get_contributions_by_emergency(self, emergency_ids):
+        """
+        Returns a list of contributions dataframes, one for each of emergency_ids
+        """
+        if self.contributions_by_emergency is None:
+            return LIVE_COUNTRY_DATA.get_contributions_by_emergency(emergency_ids)
+        return [self.contributions_by_emergency.get(emergency_id, pd.DataFrame()) for emergency_id in emergency_ids]
+
+
+LIVE_COUNTRY_DATA = LiveCountryData()
@@ -0,0 +1,291 @@
+"""
+A persistent on-disk cache for raw FTS API responses.
+Responses are stored content-addressed, under a hash of the full URL (query string included), so that reruns
+after a partial failure don't have to go back to the network for anything that was already fetched.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import urlparse
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'fts_cache')
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3  # 2 GB
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+# how long a response stays fresh, keyed by the first part of the API path
+# reference data rarely changes, funding figures can change daily
+DEFAULT_TTLS = {
+    'Sector': 7 * DAY,
+    'Country': 7 * DAY,
+    'Organization': DAY,
+    'Emergency': DAY,
+    'Appeal': DAY,
+    'Project': DAY,
+    'Cluster': DAY,
+    'Contribution': DAY,
+    'funding': 12 * HOUR,
+    'pledges': 12 * HOUR,
+}
+DEFAULT_TTL = DAY
+
+# when evicting, shrink to this fraction of the maximum so we don't evict on every single write
+EVICTION_LOW_WATER_MARK = 0.9
+
+
+class CacheMissError(Exception):
+    """
+    Raised in cache-only (offline) mode when a response isn't available locally
+    """
+    pass
+
+
+def get_endpoint_family(url):
+    """
+    Reduce an FTS URL to the family of endpoint it belongs to, dropping ids and query values, e.g.
+        http://fts.unocha.org/api/v1/Appeal/country/KEN.json -> Appeal/country
+        http://fts.unocha.org/api/v1/funding.json?Year=2013&GroupBy=donor -> funding?GroupBy&Year
+    """
+    parsed = urlparse.urlparse(url)
+
+    path = parsed.path
+    if '/api/v1/' in path:
+        path = path.split('/api/v1/', 1)[1]
+    path = path.strip('/')
+    if path.endswith('.json'):
+        path = path[:-len('.json')]
+
+    parts = path.split('/')
+    # the last part is an id/name whenever there is more than just the entity type
+    family = '/'.join(parts[:2]) if len(parts) > 2 else parts[0]
+
+    if parsed.query:
+        family += '?' + '&'.join(sorted(param.split('=')[0] for param in parsed.query.split('&')))
+
+    return family
+
+
+def get_endpoint(url):
+    """
+    The entity type part of the endpoint family, e.g. 'Appeal' or 'funding'
+    """
+    return get_endpoint_family(url).split('?')[0].split('/')[0]
+
+
+class ResponseCache(object):
+    """
+    Keeps raw response bodies in cache_dir, with per-endpoint TTLs and least-recently-used eviction once the
+    cache grows beyond max_bytes. File modification time records when a response was fetched, access time
+    records when it was last used.
+    In cache_only mode nothing is fetched; stale entries are still served and missing ones raise CacheMissError.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, ttls=None, default_ttl=DEFAULT_TTL,
+                 cache_only=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.default_ttl = default_ttl
+        self.cache_only = cache_only
+
+        self.lock = threading.Lock()
+        self.total_bytes = None  # computed on first write, as it requires a scan of the cache directory
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get_path(self, url):
+        key = hashlib.sha1(url).hexdigest()
+        # fan out into subdirectories so no single directory gets huge
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def get_ttl(self, url):
+        """
+        None means the response never expires
+        """
+        return self.ttls.get(get_endpoint(url), self.default_ttl)
+
+    def open(self, url):
+        """
+        Returns the cached response as an open file, or None if missing or expired
+        """
+        path = self.get_path(url)
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.count('misses')
+            return None
+
+        now = time.time()
+        ttl = self.get_ttl(url)
+        if not self.cache_only and ttl is not None and now - stat.st_mtime > ttl:
+            self.count('expired')
+            self.count('misses')
+            return None
+
+        try:
+            cache_file = open(path, 'rb')
+            # set access time explicitly as many filesystems are mounted noatime/relatime
+            os.utime(path, (now, stat.st_mtime))
+        except (IOError, OSError):
+            # possibly evicted by another process in the meantime
+            self.count('misses')
+            return None
+
+        self.count('hits')
+        return cache_file
+
+    def get(self, url):
+        """
+        Returns the cached response body, or None if missing or expired
+        """
+        cache_file = self.open(url)
+        if cache_file is None:
+            return None
+
+        with cache_file:
+            return cache_file.read()
+
+    def open_for_write(self, url):
+        """
+        Returns a CacheWriter, the response is only stored once it is committed
+        """
+        return CacheWriter(self, url)
+
+    def put(self, url, content):
+        writer = self.open_for_write(url)
+        writer.write(content)
+        writer.commit()
+
+    def note_bytes_written(self, byte_count):
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(entry[1] for entry in self.list_entries())
+            else:
+                self.total_bytes += byte_count
+            needs_eviction = self.total_bytes > self.max_bytes
+
+        if needs_eviction:
+            self.evict()
+
+    def fetch(self, url, fetch_function):
+        """
+        Returns the response body for url, calling fetch_function(url) and storing the result if it isn't cached
+        """
+        content = self.get(url)
+        if content is not None:
+            return content
+
+        if self.cache_only:
+            raise CacheMissError('No cached response for ' + url)
+
+        content = fetch_function(url)
+        self.put(url, content)
+        return content
+
+    def list_entries(self):
+        """
+        Returns (path, size, access time) for every cached response
+        """
+        entries = []
+        for directory, subdirectories, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.endswith('.json'):
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_atime))
+        return entries
+
+    def evict(self):
+        """
+        Remove least recently used responses until we're comfortably below max_bytes
+        """
+        with self.lock:
+            entries = sorted(self.list_entries(), key=lambda entry: entry[2])
+            total_bytes = sum(entry[1] for entry in entries)
+            target_bytes = self.max_bytes * EVICTION_LOW_WATER_MARK
+
+            for path, size, atime in entries:
+                if total_bytes <= target_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total_bytes -= size
+                self.evictions += 1
+
+            self.total_bytes = total_bytes
+
+    def clear(self):
+        with self.lock:
+            for path, size, atime in self.list_entries():
+                os.remove(path)
+            self.total_bytes = 0
+
+    def count(self, counter_name):
+        with self.lock:
+            setattr(self, counter_name, getattr(self, counter_name) + 1)
+
+    def get_stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / requests if requests else 0.,
+            }
+
+    def print_stats(self):
+        stats = self.get_stats()
+        print 'Response cache %s: %d hits, %d misses (%d expired), %d evictions, %.0f%% hit rate' %\
+            (self.cache_dir, stats['hits'], stats['misses'], stats['expired'], stats['evictions'],
+             100 * stats['hit_rate'])
+
+
+class CacheWriter(object):
+    """
+    Writes a response to a temporary file which is renamed into place on commit,
+    so readers never see a partially written response
+    """
+    def __init__(self, cache, url):
+        self.cache = cache
+        self.path = cache.get_path(url)
+        self.byte_count = 0
+
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass  # another thread/process got there first
+
+        handle, self.temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        self.temp_file = os.fdopen(handle, 'wb')
+
+    def write(self, content):
+        self.temp_file.write(content)
+        self.byte_count += len(content)
+
+    def commit(self):
+        self.temp_file.close()
+        os.rename(self.temp_path, self.path)
+        self.cache.note_bytes_written(self.byte_count)
+
+    def discard(self):
+        self.temp_file.close()
+        os.remove(self.temp_path)
@@ -0,0 +1,143 @@
+"""
+Categorical columns for FTS frames.
+Contributions, projects, organizations and funding repeat a handful of distinct strings (donor, recipient, status,
+cluster, ...) over many rows, and pd.read_json keeps a separate Python string for every one of them. Stored as
+categoricals, each row is just a small integer code, which takes far less memory and makes grouping and pivoting on
+those columns much faster.
+
+Codes come from a dictionary shared by the whole process, so the same value gets the same code in every frame.
+The dictionary only ever grows, so frames converted earlier have fewer categories than later ones, but their codes
+are still valid.
+
+pandas 0.15 can't pd.concat frames with categorical columns (it fails with "axis 1 out of bounds"), so frames that
+may have them are concatenated with concat() instead.
+"""
+
+import collections
+import numpy as np
+import pandas as pd
+import threading
+
+CATEGORICAL_COLUMNS = ['donor', 'recipient', 'status', 'cluster', 'country', 'organisation', 'type']
+
+
+def is_categorical(series):
+    return pd.core.common.is_categorical_dtype(series)
+
+
+class CategoryDictionary(object):
+    """
+    The categories seen so far for each column, with the code of each value being its position in the list
+    """
+    def __init__(self, column_names=CATEGORICAL_COLUMNS):
+        self.column_names = set(column_names)
+        self.lock = threading.Lock()
+        self.categories = collections.defaultdict(list)
+        self.codes = collections.defaultdict(dict)
+
+    def get_categories(self, column_name):
+        with self.lock:
+            return list(self.categories[column_name])
+
+    def get_category_count(self, column_name):
+        with self.lock:
+            return len(self.categories.get(column_name, ()))
+
+    def encode(self, column_name, values):
+        """
+        Returns a Categorical of values, adding any values not seen before to the column's categories
+        """
+        # factorize does the per-row work in C, so we only deal with each distinct value once
+        labels, unique_values = pd.factorize(values)
+
+        with self.lock:
+            categories = self.categories[column_name]
+            codes_by_value = self.codes[column_name]
+
+            for value in unique_values:
+                if value not in codes_by_value:
+                    codes_by_value[value] = len(categories)
+                    categories.append(value)
+
+            unique_codes = np.array([codes_by_value[value] for value in unique_values], dtype=np.int64)
+            categories = list(categories)
+
+        # labels are -1 for missing values, which is also the code for missing in a Categorical
+        codes = np.where(labels >= 0, unique_codes.take(np.maximum(labels, 0)), -1)
+        return pd.Categorical.from_codes(codes, categories)
+
+    def categorize(self, dataframe):
+        """
+        Converts the known low-cardinality string columns of dataframe to categoricals, in place
+        """
+        for column_name in dataframe.columns:
+            if column_name in self.column_names and dataframe[column_name].dtype == object:
+                dataframe[column_name] = self.encode(column_name, dataframe[column_name].values)
+        return dataframe
+
+    def concat(self, dataframes):
+        """
+        pd.concat of dataframes, categorical columns and all. Categoricals are turned back into plain values for the
+        concat, and the columns that were categorical in any of the frames are converted again afterwards: with this
+        dictionary's codes for its own columns, otherwise with categories of their own.
+        """
+        categorical_columns = []
+        for dataframe in dataframes:
+            for column_name in dataframe.columns:
+                if is_categorical(dataframe[column_name]) and column_name not in categorical_columns:
+                    categorical_columns.append(column_name)
+
+        if not categorical_columns:
+            return pd.concat(dataframes)
+
+        concatenated = pd.concat([decategorize(dataframe) for dataframe in dataframes])
+        for column_name in categorical_columns:
+            values = concatenated[column_name].values
+            if column_name in self.column_names:
+                concatenated[column_name] = self.encode(column_name, values)
+            else:
+                concatenated[column_name] = pd.Categorical(values)
+        return concatenated
+
+    def get_stats(self):
+        with self.lock:
+            return dict((column_name, len(categories)) for column_name, categories in self.categories.iteritems())
+
+
+def decategorize(dataframe):
+    """
+    Returns dataframe with any categorical columns turned back into plain object columns, e.g. for storing it, as
+    the codes of a stored categorical wouldn't match those of the dictionary in another process
+    """
+    categorical_columns = [column_name for column_name in dataframe.columns if is_categorical(dataframe[column_name])]
+    if not categorical_columns:
+        return dataframe
+
+    dataframe = dataframe.copy()
+    for column_name in categorical_columns:
+        dataframe[column_name] = np.asarray(dataframe[column_name])
+    return dataframe
+
+
+# shared by everything in the process, so codes are consistent across fetches
+CATEGORIES = CategoryDictionary()
+
+
+if __name__ == "__main__":
+    # concatenate frames categorized at different times (so with different numbers of categories), as well as one
+    # with a categorical the dictionary didn't make and one with no categoricals at all
+    dictionary = CategoryDictionary()
+    first = dictionary.categorize(pd.DataFrame({'donor': ['A', 'B', None], 'amount': [1., 2., 3.]}))
+    second = dictionary.categorize(pd.DataFrame({'donor': ['C', 'A'], 'amount': [4., 5.]}))
+    third = pd.DataFrame({'donor': pd.Categorical(['B', 'D']), 'amount': [6., 7.]})
+    fourth = pd.DataFrame({'donor': ['E'], 'amount': [8.]})
+
+    concatenated = dictionary.concat([first, second, third, fourth])
+    print concatenated
+
+    assert is_categorical(concatenated.donor)
+    assert [value if pd.notnull(value) else None for value in concatenated.donor] == \
+        ['A', 'B', None, 'C', 'A', 'B', 'D', 'E']
+    assert list(concatenated.amount) == [1., 2., 3., 4., 5., 6., 7., 8.]
+    assert list(concatenated.donor.cat.categories) == dictionary.get_categories('donor')
+    print 'Concat OK'
@@ -0,0 +1,126 @@
+"""
+A client for the FTS API which keeps connections open between calls.
+Every call used to open a fresh TCP connection, which was a large share of the per-call latency when making the
+thousands of calls needed for an all-countries run. The client holds a pooled keep-alive session instead.
+"""
+
+import fts_cache
+import fts_manifest
+import fts_metrics
+import fts_scheduler
+import pandas as pd
+import requests
+import time
+from requests.adapters import HTTPAdapter
+
+# should be at least as big as the number of threads fetching at once (see fts_queries.DEFAULT_MAX_WORKERS)
+DEFAULT_POOL_SIZE = 16
+
+# in seconds, some of the larger responses (e.g. Organization) take a while to come back
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 300
+
+# bytes read at a time when streaming a response
+STREAMING_CHUNK_SIZE = 64 * 1024
+
+
+class FtsClient(object):
+    """
+    Fetches responses from the FTS API over a pooled keep-alive session and parses them into dataframes.
+    If a fts_cache.ResponseCache is given, response bodies are read from/written to it.
+    Requests are rate limited and retried by a fts_scheduler.RequestScheduler, a default one unless given.
+    """
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, gzip=True, cache=None, scheduler=None):
+        self.session = requests.Session()
+
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # requests transparently decompresses, so this just cuts down on bytes over the wire
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate' if gzip else 'identity'
+
+        self.timeout = (connect_timeout, read_timeout)
+        self.cache = cache
+        self.scheduler = scheduler or fts_scheduler.RequestScheduler(max_concurrency=pool_size)
+
+    def fetch_url_content(self, url):
+        """
+        Always goes to the network, bypassing any cache
+        """
+        return self.scheduler.call(lambda: self.get_response(url).content)
+
+    def get_response(self, url, stream=False):
+        """
+        A single attempt at a request, raising for HTTP error statuses
+        """
+        response = self.session.get(url, timeout=self.timeout, stream=stream)
+        response.raise_for_status()
+        return response
+
+    def fetch_content(self, url):
+        start = time.time()
+
+        if self.cache is None:
+            content = self.fetch_url_content(url)
+        else:
+            content = self.cache.fetch(url, self.fetch_url_content)
+
+        fts_metrics.note_response(time.time() - start, len(content))
+        fts_manifest.note_response_content(url, content)
+        return content
+
+    def iter_content(self, url, chunk_size=STREAMING_CHUNK_SIZE):
+        """
+        Yields the response body in chunks, without ever holding all of it in memory.
+        Responses are written through to the cache, but only if they're read to the end.
+        """
+        if self.cache is not None:
+            cache_file = self.cache.open(url)
+            if cache_file is not None:
+                with cache_file:
+                    for chunk in iter(lambda: cache_file.read(chunk_size), ''):
+                        fts_metrics.note_bytes(len(chunk))
+                        yield chunk
+                return
+
+            if self.cache.cache_only:
+                raise fts_cache.CacheMissError('No cached response for ' + url)
+
+        response = self.scheduler.call(lambda: self.get_response(url, stream=True))
+
+        writer = self.cache.open_for_write(url) if self.cache is not None else None
+        completed = False
+        try:
+            for chunk in response.iter_content(chunk_size):
+                if writer:
+                    writer.write(chunk)
+                fts_metrics.note_bytes(len(chunk))
+                yield chunk
+            completed = True
+        finally:
+            response.close()
+            if writer and completed:
+                writer.commit()
+            elif writer:
+                writer.discard()
+
+    def fetch_json_as_dataframe(self, url):
+        content = self.fetch_content(url)
+
+        start = time.time()
+        dataframe = pd.read_json(content)
+        fts_metrics.note_decode(time.time() - start)
+
+        return dataframe
+
+    def enable_cache(self, **kwargs):
+        """
+        Accepts the same arguments as fts_cache.ResponseCache, e.g. cache_dir, max_bytes, ttls, cache_only
+        """
+        self.cache = fts_cache.ResponseCache(**kwargs)
+        return self.cache
+
+    def close(self):
+        self.session.close()
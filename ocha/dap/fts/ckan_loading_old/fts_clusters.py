@@ -0,0 +1,256 @@
+"""
+Standardizes cluster names, which FTS doesn't: the same cluster shows up as e.g. "SHELTER AND NFI" in one appeal and
+"SHELTER AND NON-FOOD ITEMS" in the next, in both project and cluster data.
+
+Each name is first normalized (case, punctuation, common abbreviations, filler words). A name whose normalized form
+matches one of the curated STANDARD_CLUSTERS maps straight to it. Otherwise the name is compared with the standard
+names that share a token or token prefix with it (a blocking index, so only a handful of candidates are scored rather
+than all of them), and mapped to the most similar one if it's similar enough. Anything else is passed through as it
+is. Names are only ever matched against the curated list, never against each other, so the result doesn't depend on
+the order names are seen in (which, with countries produced in parallel, is down to thread timing).
+
+Every mapping made is kept in a CSV table (raw name, standard name, score, how it was matched) which is reused across
+runs, so only names never seen before need matching. The table is kept next to the response cache, like the
+organization lookup; set FTS_CLUSTER_MAPPING_PATH to keep it somewhere that outlives the temp directory, e.g. when
+it has hand fixes in it. Rows can be edited by hand to fix a bad match, or to group a name with another that isn't in
+the curated list; give them the method 'manual' to mark them as such.
+"""
+
+import collections
+import fts_cache
+import os
+import pandas as pd
+import re
+import threading
+
+DEFAULT_MAPPING_PATH = os.environ.get('FTS_CLUSTER_MAPPING_PATH',
+                                      os.path.join(fts_cache.DEFAULT_CACHE_DIR, 'cluster_mapping.csv'))
+
+# the global clusters/sectors used by FTS, plus other common cluster names
+STANDARD_CLUSTERS = [
+    'AGRICULTURE',
+    'CAMP COORDINATION AND CAMP MANAGEMENT',
+    'COORDINATION AND SUPPORT SERVICES',
+    'EARLY RECOVERY',
+    'ECONOMIC RECOVERY AND INFRASTRUCTURE',
+    'EDUCATION',
+    'EMERGENCY TELECOMMUNICATIONS',
+    'FOOD',
+    'FOOD SECURITY',
+    'HEALTH',
+    'LOGISTICS',
+    'MINE ACTION',
+    'MULTI-SECTOR',
+    'NUTRITION',
+    'PROTECTION',
+    'PROTECTION/HUMAN RIGHTS/RULE OF LAW',
+    'SAFETY AND SECURITY OF STAFF AND OPERATIONS',
+    'SHELTER AND NON-FOOD ITEMS',
+    'WATER AND SANITATION',
+    'WATER, SANITATION AND HYGIENE',
+]
+
+ABBREVIATIONS = {
+    'NFI': 'NON FOOD ITEMS',
+    'NFIS': 'NON FOOD ITEMS',
+    'WASH': 'WATER SANITATION HYGIENE',
+    'CCCM': 'CAMP COORDINATION CAMP MANAGEMENT',
+    'ETC': 'EMERGENCY TELECOMMUNICATIONS',
+    'CSS': 'COORDINATION SUPPORT SERVICES',
+    'ERI': 'ECONOMIC RECOVERY INFRASTRUCTURE',
+    'MULTISECTOR': 'MULTI SECTOR',
+}
+
+FILLER_WORDS = {'AND', 'OF', 'THE', 'FOR', 'CLUSTER', 'SECTOR'}
+
+NON_ALPHANUMERIC = re.compile(r'[^0-9A-Z]+')
+
+PREFIX_LENGTH = 4  # so e.g. ITEM/ITEMS and SANITATION/SANITARY share a block
+DEFAULT_THRESHOLD = 0.6
+DEFAULT_MAX_CANDIDATES = 5
+
+MAPPING_COLUMNS = ['raw_name', 'standard_name', 'score', 'method']
+
+METHOD_EXACT = 'exact'
+METHOD_FUZZY = 'fuzzy'
+METHOD_UNMATCHED = 'unmatched'
+METHOD_MANUAL = 'manual'
+
+
+def get_tokens(name):
+    """
+    u'Shelter & NFIs' -> ['SHELTER', 'NON', 'FOOD', 'ITEMS']
+    """
+    tokens = []
+    for token in NON_ALPHANUMERIC.sub(' ', name.upper().replace('&', ' AND ')).split():
+        tokens.extend(ABBREVIATIONS.get(token, token).split())
+    # filler words only go if there's something else left
+    meaningful_tokens = [token for token in tokens if token not in FILLER_WORDS]
+    return meaningful_tokens or tokens
+
+
+def normalize_name(name):
+    return ' '.join(get_tokens(name))
+
+
+def get_block_keys(tokens):
+    return set(tokens) | set(token[:PREFIX_LENGTH] for token in tokens)
+
+
+def get_trigrams(normalized_name):
+    padded = ' ' + normalized_name + ' '
+    return set(padded[index:index + 3] for index in range(len(padded) - 2))
+
+
+def get_similarity(trigrams, other_trigrams):
+    if not trigrams or not other_trigrams:
+        return 0.
+    return float(len(trigrams & other_trigrams)) / len(trigrams | other_trigrams)
+
+
+class ClusterStandardizer(object):
+    def __init__(self, standard_names=STANDARD_CLUSTERS, mapping_path=DEFAULT_MAPPING_PATH,
+                 threshold=DEFAULT_THRESHOLD, max_candidates=DEFAULT_MAX_CANDIDATES):
+        """
+        mapping_path is where the mapping table is loaded from and saved to, None not to keep one
+        """
+        self.mapping_path = mapping_path
+        self.threshold = threshold
+        self.max_candidates = max_candidates
+
+        self.lock = threading.RLock()
+
+        # normalized name -> standard name, standard name -> its trigrams, block key -> standard names
+        self.standard_by_normalized = {}
+        self.trigrams_by_standard = {}
+        self.block_index = collections.defaultdict(set)
+
+        # raw name -> (standard name, score, method)
+        self.mapping = {}
+        self.unsaved_changes = False
+
+        for standard_name in standard_names:
+            self.add_standard_name(standard_name)
+
+        if mapping_path and os.path.exists(mapping_path):
+            self.load_mapping(mapping_path)
+
+    def add_standard_name(self, standard_name):
+        normalized = normalize_name(standard_name)
+        if normalized in self.standard_by_normalized:
+            return
+
+        self.standard_by_normalized[normalized] = standard_name
+        self.trigrams_by_standard[standard_name] = get_trigrams(normalized)
+        for key in get_block_keys(normalized.split()):
+            self.block_index[key].add(standard_name)
+
+    def load_mapping(self, path):
+        mapping = pd.read_csv(path, encoding='utf-8')
+        with self.lock:
+            for raw_name, standard_name, score, method in mapping[MAPPING_COLUMNS].itertuples(index=False):
+                # manual rows can map to anything, but matching itself only ever maps to a curated name (or passes
+                # the name through), so anything else is left over from older runs and gets matched again
+                if method != METHOD_MANUAL and standard_name not in self.trigrams_by_standard \
+                        and standard_name != raw_name:
+                    self.unsaved_changes = True
+                    continue
+                self.mapping[raw_name] = (standard_name, score, method)
+
+    def save_mapping(self, path=None):
+        path = path or self.mapping_path
+        with self.lock:
+            if not path or not self.unsaved_changes:
+                return
+
+            rows = [(raw_name,) + entry for raw_name, entry in sorted(self.mapping.iteritems())]
+            mapping = pd.DataFrame.from_records(rows, columns=MAPPING_COLUMNS)
+
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            mapping.to_csv(path + '.tmp', index=False, encoding='utf-8')
+            os.rename(path + '.tmp', path)
+
+            self.unsaved_changes = False
+
+    def get_candidates(self, tokens):
+        """
+        The standard names sharing the most block keys with tokens, at most max_candidates of them
+        """
+        shared_key_counts = collections.Counter()
+        for key in get_block_keys(tokens):
+            shared_key_counts.update(self.block_index.get(key, ()))
+        # most shared keys first, then alphabetically, so ties always go the same way
+        ranked = sorted(shared_key_counts.iteritems(), key=lambda item: (-item[1], item[0]))
+        return [standard_name for standard_name, count in ranked[:self.max_candidates]]
+
+    def match(self, raw_name):
+        """
+        Returns (standard name, score, method) for a name not in the mapping yet
+        """
+        normalized = normalize_name(raw_name)
+        if not normalized:
+            return raw_name, 0., METHOD_UNMATCHED
+
+        if normalized in self.standard_by_normalized:
+            return self.standard_by_normalized[normalized], 1., METHOD_EXACT
+
+        trigrams = get_trigrams(normalized)
+        best_name, best_score = None, 0.
+        for candidate in self.get_candidates(normalized.split()):
+            score = get_similarity(trigrams, self.trigrams_by_standard[candidate])
+            if score > best_score:
+                best_name, best_score = candidate, score
+
+        if best_score >= self.threshold:
+            return best_name, round(best_score, 3), METHOD_FUZZY
+
+        # nothing close enough, so leave the name alone (add a manual row to the mapping to group it with others)
+        return raw_name, round(best_score, 3), METHOD_UNMATCHED
+
+    def standardize_name(self, raw_name):
+        if pd.isnull(raw_name):
+            return raw_name
+
+        with self.lock:
+            entry = self.mapping.get(raw_name)
+            if entry is None:
+                entry = self.match(raw_name)
+                self.mapping[raw_name] = entry
+                self.unsaved_changes = True
+            return entry[0]
+
+    def standardize(self, raw_names):
+        """
+        The standard name for each of raw_names, matching each distinct name only once
+        """
+        raw_names = pd.Series(raw_names)
+        standard_names = dict((raw_name, self.standardize_name(raw_name)) for raw_name in raw_names.unique())
+        return raw_names.map(standard_names).values
+
+    def standardize_frame(self, dataframe, column='cluster', output_column='standard_cluster'):
+        """
+        Adds output_column to dataframe (in place) with the standard names for column: 'cluster' for projects,
+        'name' for clusters
+        """
+        if column in dataframe.columns:
+            dataframe[output_column] = self.standardize(dataframe[column].values)
+        return dataframe
+
+
+# the standardizer shared within the process, see get_cluster_standardizer()
+STANDARDIZER = None
+STANDARDIZER_LOCK = threading.Lock()
+
+
+def get_cluster_standardizer():
+    """
+    The shared standardizer, using the mapping table at DEFAULT_MAPPING_PATH; call save_mapping() on it when done
+    """
+    global STANDARDIZER
+
+    with STANDARDIZER_LOCK:
+        if STANDARDIZER is None:
+            STANDARDIZER = ClusterStandardizer()
+        return STANDARDIZER
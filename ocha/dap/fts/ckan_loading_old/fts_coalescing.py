@@ -0,0 +1,125 @@
+"""
+Merges identical requests made within one process into a single fetch.
+The same query often gets issued several times in one run (e.g. a country's appeals are needed for both the
+appeals and the projects CSVs), possibly from different threads at the same moment. Requests already in flight are
+waited on rather than repeated, and recently completed results are handed out again.
+
+A result that ends up shared (waited on by other callers, or kept for later ones) is left untouched, and each caller
+gets a copy of their own, so callers can add, replace or modify columns without affecting each other. A result only
+one caller asked for is handed over as is, so big one-off responses (e.g. a single emergency's contributions) are
+neither copied nor held on to. Which results are kept for later callers is up to the retain function, so it can be
+limited to small responses that are asked for again and again.
+"""
+
+import collections
+import sys
+import threading
+import time
+
+DEFAULT_RECENT_SECONDS = 5 * 60
+DEFAULT_MAX_RECENT = 256
+
+
+class PendingRequest(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+        self.waiters = 0
+
+
+class RequestCoalescer(object):
+    """
+    Keeps track of requests in flight and results completed within the last recent_seconds (at most max_recent
+    of them), keyed by whatever identifies a request, e.g. its URL.
+    Only results for which retain(key) is true are kept once complete, all of them if retain is None.
+    """
+    def __init__(self, recent_seconds=DEFAULT_RECENT_SECONDS, max_recent=DEFAULT_MAX_RECENT, retain=None):
+        self.recent_seconds = recent_seconds
+        self.max_recent = max_recent
+        self.retain = retain
+
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.recent = collections.OrderedDict()  # key -> (completion time, result), oldest first
+
+        self.requests = 0
+        self.fetches = 0
+        self.coalesced_in_flight = 0
+        self.coalesced_recent = 0
+
+    def fetch(self, key, fetch_function):
+        """
+        Returns the result of fetch_function(), which is only called if there is no identical request in flight or
+        recently completed. If the result is shared with other callers, each gets a copy.
+        """
+        with self.lock:
+            self.requests += 1
+
+            if key in self.recent:
+                completion_time, result = self.recent[key]
+                if time.time() - completion_time <= self.recent_seconds:
+                    self.coalesced_recent += 1
+                    return result.copy()
+                del self.recent[key]
+
+            pending = self.in_flight.get(key)
+            is_leader = pending is None
+            if is_leader:
+                pending = PendingRequest()
+                self.in_flight[key] = pending
+                self.fetches += 1
+            else:
+                self.coalesced_in_flight += 1
+                pending.waiters += 1
+
+        if not is_leader:
+            pending.done.wait()
+            if pending.exc_info:
+                raise pending.exc_info[0], pending.exc_info[1], pending.exc_info[2]
+            return pending.result.copy()
+
+        try:
+            result = fetch_function()
+        except:
+            pending.exc_info = sys.exc_info()
+            with self.lock:
+                del self.in_flight[key]
+            pending.done.set()
+            raise
+
+        retained = self.retain is None or self.retain(key)
+        with self.lock:
+            del self.in_flight[key]
+            # nobody can start waiting on it from here on, so this is the final say on whether it's shared
+            shared = retained or pending.waiters > 0
+            if retained:
+                self.recent[key] = (time.time(), result)
+                while len(self.recent) > self.max_recent:
+                    self.recent.popitem(last=False)
+
+        pending.result = result
+        pending.done.set()
+
+        # a shared result is only ever copied from, never handed out itself
+        return result.copy() if shared else result
+
+    def clear(self):
+        with self.lock:
+            self.recent.clear()
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'fetches': self.fetches,
+                'coalesced_in_flight': self.coalesced_in_flight,
+                'coalesced_recent': self.coalesced_recent,
+                'saved': self.coalesced_in_flight + self.coalesced_recent,
+            }
+
+    def print_stats(self):
+        stats = self.get_stats()
+        print 'Request coalescing: %d requests, %d fetches, saved %d (%d in flight, %d recently completed)' %\
+            (stats['requests'], stats['fetches'], stats['saved'], stats['coalesced_in_flight'],
+             stats['coalesced_recent'])
@@ -0,0 +1,384 @@
+"""
+Writes FTS tables out chunk by chunk (e.g. one appeal's projects at a time) rather than concatenating everything first,
+so memory is bounded by the largest chunk instead of the largest country's whole history.
+Chunks can come with different columns (missing optional fields, or an empty response with none at all), so each is
+reconciled with the output schema: missing columns are left empty, and columns not in the schema (e.g. a field newly
+added to the API) are added to it, at the end. A CSV's header is written with its first chunk, so columns first seen
+after that are dropped with a warning; if that warning shows up, the schema needs updating.
+
+A schema can also give each column a type (see PROJECT_SCHEMA), which every chunk is cast to. Otherwise each chunk
+would be written with the types pd.read_json happened to give its response, so e.g. an id would come out as 923 in
+one chunk and 923.0 in the next (one where some row had no id). Amounts are written as whole numbers when they are
+whole (380000, as pd.read_json gives them) and dates as e.g. 2002-11-24 00:00:00, as the concatenating path wrote them.
+
+Tables can be written in any of OUTPUT_FORMATS, chosen by the extension of the output path (see open_writer):
+  - csv: plain UTF-8 CSV
+  - csv.gz: the same, gzipped on a pool of threads (see ParallelGzipFile)
+  - columnar: a fts_columnar table, typed and much quicker to load
+"""
+
+import collections
+import fts_columnar
+import fts_manifest
+import numpy as np
+import os
+import pandas as pd
+import sys
+import threading
+import zlib
+from multiprocessing.pool import ThreadPool
+
+# column types of a schema
+INT = 'int'  # int64, no missing values allowed
+FLOAT = 'float'  # float64, e.g. for ids that can be missing
+AMOUNT = 'amount'  # float64, written without a fraction when it's a whole number
+DATE = 'date'  # written as DATE_FORMAT
+TEXT = 'text'  # written as is
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# index first, then the columns in the order pd.read_json gives them (sorted), as the concatenating path writes them
+PROJECT_SCHEMA = collections.OrderedDict([
+    ('appeal_id', INT),
+    ('cluster', TEXT),
+    ('code', TEXT),
+    ('current_requirements', AMOUNT),
+    ('end_date', DATE),
+    ('funding', AMOUNT),
+    ('last_updated_datetime', DATE),
+    ('organisation', TEXT),
+    ('organisation_abbreviation', TEXT),
+    ('original_requirements', AMOUNT),
+    ('pledges', AMOUNT),
+    ('title', TEXT),
+    ('standard_cluster', TEXT),  # added by fts_clusters
+])
+
+CONTRIBUTION_SCHEMA = collections.OrderedDict([
+    ('amount', AMOUNT),
+    ('appeal_id', FLOAT),  # missing for contributions outside any appeal
+    ('decision_date', DATE),
+    ('donor', TEXT),
+    ('emergency_id', INT),
+    ('is_allocation', TEXT),  # can be missing, so not a bool
+    ('project_code', TEXT),
+    ('recipient', TEXT),
+    ('status', TEXT),
+    ('year', INT),
+])
+
+PROJECT_COLUMNS = list(PROJECT_SCHEMA)
+CONTRIBUTION_COLUMNS = list(CONTRIBUTION_SCHEMA)
+
+INDEX_LABEL = 'id'
+
+CSV = 'csv'
+GZIP_CSV = 'csv.gz'
+COLUMNAR = 'columnar'
+
+# format -> extension of the output path
+OUTPUT_FORMATS = collections.OrderedDict([
+    (CSV, '.csv'),
+    (GZIP_CSV, '.csv.gz'),
+    (COLUMNAR, '.columns'),
+])
+
+GZIP_BLOCK_SIZE = 1024 * 1024
+GZIP_LEVEL = 6
+COMPRESSION_WORKERS = 4
+
+# shared by all gzip files being written, see get_compression_pool()
+COMPRESSION_POOL = None
+COMPRESSION_POOL_LOCK = threading.Lock()
+
+# columns already warned about, so each is only mentioned once per process
+WARNED_COLUMNS = set()
+WARNED_COLUMNS_LOCK = threading.Lock()
+
+
+def warn_about_dropped_columns(path, columns):
+    with WARNED_COLUMNS_LOCK:
+        new_columns = [column for column in columns if column not in WARNED_COLUMNS]
+        WARNED_COLUMNS.update(new_columns)
+
+    if new_columns:
+        print >> sys.stderr, 'Warning: dropping columns first seen after the header was written, from', path + ':', \
+            ', '.join(new_columns)
+
+
+def cast_column(path, column, column_type, values):
+    """
+    values (a Series) as column_type, raising ValueError rather than losing anything
+    """
+    if column_type == INT:
+        if values.isnull().any():
+            raise ValueError('Missing values in int column %s of %s' % (column, path))
+        int_values = values.astype(np.int64)
+        if not (int_values == values).all():
+            raise ValueError('Fractional values in int column %s of %s' % (column, path))
+        return int_values
+    elif column_type in (FLOAT, AMOUNT):
+        return values.astype(np.float64)
+    elif column_type == DATE:
+        return pd.to_datetime(values)
+    else:
+        return values
+
+
+def format_amounts(values):
+    """
+    Strings for a Series of amounts: whole numbers without a fraction, others in full, and empty for missing ones
+    """
+    formatted = np.empty(len(values), dtype=object)
+    formatted.fill('')
+    present = values.notnull().values
+    whole = present & (values == np.floor(values)).values
+    formatted[whole] = [str(value) for value in values.values[whole].astype(np.int64)]
+    formatted[present & ~whole] = [repr(value) for value in values.values[present & ~whole]]
+    return pd.Series(formatted, index=values.index)
+
+
+def format_dates(values, date_format=DATE_FORMAT):
+    """
+    Strings for a Series of dates, empty for missing ones. Dates repeat a lot, so each distinct one is only
+    formatted once.
+    """
+    labels, unique_dates = pd.factorize(pd.DatetimeIndex(values))
+    formatted = [date.strftime(date_format) for date in pd.DatetimeIndex(unique_dates)]
+    formatted.append('')  # for the missing dates, labelled -1
+    return pd.Series(np.array(formatted, dtype=object).take(labels), index=values.index)
+
+
+def get_output_format(path):
+    for output_format, extension in reversed(OUTPUT_FORMATS.items()):  # .csv.gz before .csv
+        if path.endswith(extension):
+            return output_format
+    raise ValueError('Unknown output format for ' + path)
+
+
+def get_compression_pool():
+    global COMPRESSION_POOL
+
+    with COMPRESSION_POOL_LOCK:
+        if COMPRESSION_POOL is None:
+            COMPRESSION_POOL = ThreadPool(COMPRESSION_WORKERS)
+        return COMPRESSION_POOL
+
+
+def set_compression_workers(workers):
+    """
+    Must be called before any gzip output is written
+    """
+    global COMPRESSION_WORKERS
+    COMPRESSION_WORKERS = workers
+
+
+def compress_gzip_member(data, level=GZIP_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # 16 + ... for a gzip header
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipFile(object):
+    """
+    Write-only file gzipping everything written to it into path.
+    What's written is cut into blocks of block_size, each compressed as a gzip member of its own on the compression
+    pool (zlib releases the GIL while compressing), and the members are written out in order. A file of several gzip
+    members decompresses to the concatenation of them, with gunzip, Python's gzip module or pandas alike.
+    At most 2 blocks per compression worker are held at once.
+    """
+    def __init__(self, path, block_size=GZIP_BLOCK_SIZE):
+        self.output_file = open(path, 'wb')
+        self.block_size = block_size
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.pending = collections.deque()
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        self.buffer.append(data)
+        self.buffered_bytes += len(data)
+        if self.buffered_bytes >= self.block_size:
+            self.compress_buffer()
+
+    def compress_buffer(self):
+        if not self.buffer:
+            return
+
+        block = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered_bytes = 0
+
+        self.pending.append(get_compression_pool().apply_async(compress_gzip_member, (block,)))
+        while len(self.pending) > 2 * COMPRESSION_WORKERS:
+            self.output_file.write(self.pending.popleft().get())
+
+    def close(self):
+        self.compress_buffer()
+        while self.pending:
+            self.output_file.write(self.pending.popleft().get())
+        self.output_file.close()
+
+
+class StreamingWriter(object):
+    """
+    Base for writers appending dataframes to the output at path, with the given columns (and the index, labelled
+    index_label). Use as a context manager, or call close() when done. The output only appears at path once closed,
+    so a failure part way through doesn't leave a truncated file behind.
+    With a fts_manifest.OutputManifest, the output at path is only replaced if its content changed, and the hashes of
+    the responses noted by inputs (a fts_manifest.InputCollector) are recorded along with it.
+    """
+    def __init__(self, path, columns, index_label=INDEX_LABEL, manifest=None, inputs=None):
+        self.path = path
+        self.temp_path = path + '.tmp'
+        self.columns = list(columns)
+        # a schema (dict of column -> type) gives the types every chunk is cast to
+        self.column_types = dict(columns) if isinstance(columns, dict) else {}
+        self.index_label = index_label
+        self.manifest = manifest
+        self.inputs = inputs
+        self.rows = 0
+
+    def write(self, dataframe):
+        if dataframe.empty:
+            return
+
+        extra_columns = [column for column in dataframe.columns if column not in self.columns]
+        if extra_columns:
+            if self.can_add_columns():
+                self.add_columns(extra_columns)
+            else:
+                warn_about_dropped_columns(self.path, extra_columns)
+
+        chunk = dataframe.reindex(columns=self.columns)
+        for column, column_type in self.column_types.iteritems():
+            chunk[column] = cast_column(self.path, column, column_type, chunk[column])
+        self.write_chunk(chunk)
+        self.rows += len(chunk)
+
+    def can_add_columns(self):
+        return True
+
+    def add_columns(self, columns):
+        """
+        Adds columns to the end of the schema, written as is
+        """
+        self.columns.extend(columns)
+
+    def write_chunk(self, chunk):
+        raise NotImplementedError
+
+    def finish(self):
+        """
+        Completes the output at temp_path
+        """
+        raise NotImplementedError
+
+    def abort(self):
+        """
+        Stops writing, leaving whatever was written at temp_path to be removed
+        """
+        raise NotImplementedError
+
+    def close(self):
+        self.finish()
+
+        if self.manifest is None:
+            fts_manifest.replace_path(self.temp_path, self.path)
+        else:
+            input_hashes = self.inputs.get_hashes() if self.inputs is not None else None
+            self.manifest.commit(self.path, self.temp_path, input_hashes)
+
+    def discard(self):
+        self.abort()
+        fts_manifest.remove_path(self.temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class StreamingCsvWriter(StreamingWriter):
+    """
+    Writes CSV, gzipped if path ends with .gz
+    """
+    def __init__(self, path, columns, index_label=INDEX_LABEL, manifest=None, inputs=None):
+        StreamingWriter.__init__(self, path, columns, index_label, manifest, inputs)
+
+        if path.endswith('.gz'):
+            self.output_file = ParallelGzipFile(self.temp_path)
+        else:
+            self.output_file = open(self.temp_path, 'w')
+        self.header_written = False
+
+    def can_add_columns(self):
+        return not self.header_written
+
+    def write_chunk(self, chunk):
+        for column, column_type in self.column_types.iteritems():
+            if column_type == AMOUNT:
+                chunk[column] = format_amounts(chunk[column])
+            elif column_type == DATE:
+                chunk[column] = format_dates(chunk[column])
+        chunk.to_csv(self.output_file, header=not self.header_written, index=True, index_label=self.index_label,
+                     encoding='utf-8')
+        self.header_written = True
+
+    def finish(self):
+        if not self.header_written:
+            # nothing written, but an empty file should still say what it would have had
+            self.output_file.write(','.join([self.index_label or ''] + self.columns) + '\n')
+            self.header_written = True
+        self.output_file.close()
+
+    def abort(self):
+        self.output_file.close()
+
+
+class StreamingColumnarWriter(StreamingWriter):
+    """
+    Writes a fts_columnar table (a directory)
+    """
+    def __init__(self, path, columns, index_label=INDEX_LABEL, manifest=None, inputs=None):
+        StreamingWriter.__init__(self, path, columns, index_label, manifest, inputs)
+        if os.path.exists(self.temp_path):
+            fts_manifest.remove_path(self.temp_path)  # left behind by an interrupted run
+        self.table_writer = fts_columnar.ColumnarWriter(self.temp_path, self.columns, index_label)
+
+    def add_columns(self, columns):
+        StreamingWriter.add_columns(self, columns)
+        for column in columns:
+            self.table_writer.add_column(column)
+
+    def write_chunk(self, chunk):
+        self.table_writer.write(chunk)
+
+    def finish(self):
+        self.table_writer.close()
+
+    def abort(self):
+        self.table_writer.close_files()
+
+
+def open_writer(path, columns, index_label=INDEX_LABEL, manifest=None, inputs=None):
+    """
+    A streaming writer for the output format that path's extension stands for.
+    columns is a list of column names, or a schema like PROJECT_SCHEMA giving each a type too.
+    """
+    if get_output_format(path) == COLUMNAR:
+        return StreamingColumnarWriter(path, columns, index_label, manifest, inputs)
+    return StreamingCsvWriter(path, columns, index_label, manifest, inputs)
+
+
+def write_dataframe(dataframe, path, manifest=None, inputs=None):
+    """
+    Writes all of dataframe (and its index) to path, in the output format that path's extension stands for
+    """
+    with open_writer(path, dataframe.columns, dataframe.index.name, manifest, inputs) as writer:
+        writer.write(dataframe)
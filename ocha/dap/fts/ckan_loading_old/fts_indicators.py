@@ -0,0 +1,178 @@
+"""
+Accumulates indicator values (indicator, region, year, value) for the CHD exports.
+Rather than a Python object per value (hundreds of thousands of them for an all-countries run), values go straight
+into typed column buffers: indicator and region codes are interned to small integers, years and values are kept in
+int and float arrays, and the buffers grow by doubling. A whole year range for one indicator and region, or a whole
+table of years by indicators for one region, can be added in a single call.
+
+Each build uses its own IndicatorStore, so several can run in one process, and stores for separate parts of a build
+(e.g. one per region) can be merged into one with extend().
+"""
+
+import numpy as np
+import pandas as pd
+import threading
+
+DEFAULT_CAPACITY = 1024
+
+COLUMNS = ['indicator', 'region', 'year', 'value']
+
+
+class IndicatorStore(object):
+    def __init__(self, max_year=None, capacity=DEFAULT_CAPACITY):
+        """
+        Values for years after max_year, and infinite values (e.g. from dividing by zero), are left out
+        """
+        self.max_year = max_year
+        self.lock = threading.Lock()
+
+        # code -> position in the list, for indicators and regions
+        self.indicators = []
+        self.indicator_codes = {}
+        self.regions = []
+        self.region_codes = {}
+
+        self.size = 0
+        self.indicator_column = np.empty(capacity, dtype=np.int32)
+        self.region_column = np.empty(capacity, dtype=np.int32)
+        self.year_column = np.empty(capacity, dtype=np.int64)
+        self.value_column = np.empty(capacity, dtype=np.float64)
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def intern(name, names, codes):
+        code = codes.get(name)
+        if code is None:
+            code = codes[name] = len(names)
+            names.append(name)
+        return code
+
+    def reserve(self, count):
+        """
+        Makes room for count more values (with the lock held)
+        """
+        needed = self.size + count
+        capacity = len(self.value_column)
+        if needed <= capacity:
+            return
+
+        while capacity < needed:
+            capacity *= 2
+        for name in ['indicator_column', 'region_column', 'year_column', 'value_column']:
+            column = getattr(self, name)
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+
+    def add_rows(self, indicators, indicator_positions, region, years, values):
+        """
+        Adds a value for region per year in years, for the indicator at the matching position of indicator_positions
+        in the list indicators
+        """
+        years = np.asarray(years, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+
+        kept = ~np.isinf(values)
+        if self.max_year is not None:
+            kept &= years <= self.max_year
+        if not kept.all():
+            indicator_positions = indicator_positions[kept]
+            years = years[kept]
+            values = values[kept]
+
+        count = len(values)
+        if not count:
+            return
+
+        with self.lock:
+            indicator_codes = np.array([self.intern(indicator, self.indicators, self.indicator_codes)
+                                        for indicator in indicators], dtype=np.int32)
+            region_code = self.intern(region, self.regions, self.region_codes)
+
+            self.reserve(count)
+            end = self.size + count
+            self.indicator_column[self.size:end] = indicator_codes.take(indicator_positions)
+            self.region_column[self.size:end] = region_code
+            self.year_column[self.size:end] = years
+            self.value_column[self.size:end] = values
+            self.size = end
+
+    def append_years(self, indicator, region, years, values):
+        """
+        Adds the values of indicator for region, one for each of years
+        """
+        self.add_rows([indicator], np.zeros(len(years), dtype=np.int64), region, years, values)
+
+    def append(self, indicator, region, year, value):
+        self.append_years(indicator, region, [year], [value])
+
+    def append_table(self, region, table):
+        """
+        Adds the values of table (indexed by year, with a column per indicator) for region, a year at a time
+        """
+        indicator_count = len(table.columns)
+        self.add_rows(list(table.columns), np.tile(np.arange(indicator_count), len(table)), region,
+                      np.repeat(np.asarray(table.index, dtype=np.int64), indicator_count),
+                      np.asarray(table.values, dtype=np.float64).ravel())
+
+    def extend(self, other):
+        """
+        Adds all of the values of another store, after those already here
+        """
+        with other.lock:
+            count = other.size
+            other_indicators = list(other.indicators)
+            other_regions = list(other.regions)
+            other_indicator_column = other.indicator_column[:count].copy()
+            other_region_column = other.region_column[:count].copy()
+            other_year_column = other.year_column[:count].copy()
+            other_value_column = other.value_column[:count].copy()
+
+        if not count:
+            return
+
+        with self.lock:
+            # the other store's codes needn't match ours, so map them over
+            indicator_codes = np.array([self.intern(name, self.indicators, self.indicator_codes)
+                                        for name in other_indicators], dtype=np.int32)
+            region_codes = np.array([self.intern(name, self.regions, self.region_codes)
+                                     for name in other_regions], dtype=np.int32)
+
+            self.reserve(count)
+            end = self.size + count
+            self.indicator_column[self.size:end] = indicator_codes.take(other_indicator_column)
+            self.region_column[self.size:end] = region_codes.take(other_region_column)
+            self.year_column[self.size:end] = other_year_column
+            self.value_column[self.size:end] = other_value_column
+            self.size = end
+
+    def get_columns(self, categorical=True):
+        """
+        Dict of column name -> values. The year and value arrays are views of the buffers rather than copies, so
+        they're only valid until more values are added. Indicators and regions are categoricals of the interned
+        codes, or without categorical, object arrays of the names.
+        """
+        size = self.size
+        if categorical:
+            indicators = pd.Categorical.from_codes(self.indicator_column[:size], list(self.indicators))
+            regions = pd.Categorical.from_codes(self.region_column[:size], list(self.regions))
+        else:
+            indicators = np.array(self.indicators, dtype=object).take(self.indicator_column[:size])
+            regions = np.array(self.regions, dtype=object).take(self.region_column[:size])
+
+        return {
+            'indicator': indicators,
+            'region': regions,
+            'year': self.year_column[:size],
+            'value': self.value_column[:size],
+        }
+
+    def to_dataframe(self, categorical=True):
+        """
+        All values as a frame with columns indicator, region, year and value, built straight from the buffers
+        (pandas still copies each column into a block of its own)
+        """
+        with self.lock:
+            return pd.DataFrame(self.get_columns(categorical), columns=COLUMNS)
@@ -0,0 +1,280 @@
+"""
+Keeps produce_csvs from rewriting output files whose content didn't change, so their modification times (and what
+gets uploaded to CKAN) only move with real changes.
+
+Every response read from the web, the response cache or a local JSON directory is hashed as it's read. While an
+output file is produced inside collect_inputs(), the URL of every response it's built from is noted, including those
+fetched on worker threads by fts_queries.fetch_many/iter_many. OutputManifest keeps a JSON file next to the outputs
+with the hash of each of those responses and of the content, for each output file:
+  - if none of a file's input responses changed since the last run (and the file is still there), the file isn't
+    even serialized
+  - otherwise the new content goes to a temporary file, which only replaces the old one if its hash differs
+Inputs read from snapshots aren't hashed, so files built from them are always serialized, but still only replaced if
+they changed. The files that did change are listed by print_report(), and under 'last_run' in the manifest.
+"""
+
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+MANIFEST_FILENAME = 'output_manifest.json'
+HASH_CHUNK_SIZE = 64 * 1024
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# URL -> hash of the response last read for it, shared by all threads as coalesced fetches are only read once
+RESPONSE_HASHES = {}
+RESPONSE_HASHES_LOCK = threading.Lock()
+
+# the collector noting inputs on each thread, see collect_inputs()
+THREAD_STATE = threading.local()
+
+
+def hash_content(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+def hash_file(path):
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(HASH_CHUNK_SIZE), ''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def hash_path(path):
+    """
+    Hash of the file at path, or of all the files in it if it's a directory (e.g. a fts_columnar table)
+    """
+    if not os.path.isdir(path):
+        return hash_file(path)
+
+    lines = ['%s %s\n' % (filename, hash_file(os.path.join(path, filename))) for filename in sorted(os.listdir(path))]
+    return hash_content(''.join(lines))
+
+
+def replace_path(temp_path, path):
+    """
+    Moves the file or directory at temp_path to path, replacing whatever is there
+    """
+    if os.path.isdir(path):
+        # directories can't be renamed over each other, so move the old one out of the way first
+        if os.path.exists(path + '.old'):
+            shutil.rmtree(path + '.old')
+        os.rename(path, path + '.old')
+        os.rename(temp_path, path)
+        shutil.rmtree(path + '.old')
+    else:
+        os.rename(temp_path, path)
+
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def note_response_hash(url, content_hash):
+    with RESPONSE_HASHES_LOCK:
+        RESPONSE_HASHES[url] = content_hash
+
+
+def note_response_content(url, content):
+    note_response_hash(url, hash_content(content))
+
+
+def iter_hashed_chunks(url, chunks):
+    """
+    Passes chunks through, noting the hash of the response for url once all of it has been read
+    """
+    hasher = hashlib.sha1()
+    for chunk in chunks:
+        hasher.update(chunk)
+        yield chunk
+    note_response_hash(url, hasher.hexdigest())
+
+
+def get_inputs_hash(input_hashes):
+    """
+    A single hash for a dict of URL -> response hash
+    """
+    lines = ['%s %s\n' % (url, content_hash) for url, content_hash in sorted(input_hashes.iteritems())]
+    return hash_content(''.join(lines).encode('utf-8'))
+
+
+class InputCollector(object):
+    """
+    The URLs of the responses an output is built from
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.urls = set()
+
+    def add(self, url):
+        with self.lock:
+            self.urls.add(url)
+
+    def update(self, other):
+        with other.lock:
+            urls = set(other.urls)
+        with self.lock:
+            self.urls.update(urls)
+
+    def get_hashes(self):
+        """
+        URL -> response hash for each input, or None if any of them wasn't hashed (e.g. it came from a snapshot) or
+        nothing was fetched at all (e.g. the output was built from data loaded beforehand), so the inputs are unknown
+        """
+        with self.lock:
+            urls = list(self.urls)
+        if not urls:
+            return None
+        with RESPONSE_HASHES_LOCK:
+            hashes = dict((url, RESPONSE_HASHES.get(url)) for url in urls)
+
+        if None in hashes.values():
+            return None
+        return hashes
+
+
+def get_current_collector():
+    return getattr(THREAD_STATE, 'collector', None)
+
+
+@contextlib.contextmanager
+def collect_inputs():
+    """
+    Notes the responses fetched within the block (on this thread, or by fetch_many/iter_many on its behalf) in the
+    InputCollector it yields. Blocks can be nested, the outer collector also gets the inputs of the inner one.
+    """
+    parent = get_current_collector()
+    collector = InputCollector()
+    THREAD_STATE.collector = collector
+    try:
+        yield collector
+    finally:
+        THREAD_STATE.collector = parent
+        if parent is not None:
+            parent.update(collector)
+
+
+def note_input(url):
+    collector = get_current_collector()
+    if collector is not None:
+        collector.add(url)
+
+
+def propagate_inputs(function):
+    """
+    Wraps function so that the inputs it fetches when called on another thread (e.g. in a pool) are noted by the
+    collector of the calling thread
+    """
+    collector = get_current_collector()
+    if collector is None:
+        return function
+
+    def wrapper(*args, **kwargs):
+        previous = get_current_collector()
+        THREAD_STATE.collector = collector
+        try:
+            return function(*args, **kwargs)
+        finally:
+            THREAD_STATE.collector = previous
+
+    return wrapper
+
+
+class OutputManifest(object):
+    """
+    Hashes of the output files under the directory of path, and of the responses each was built from, kept in the
+    JSON file at path
+    """
+    def __init__(self, path):
+        self.path = path
+        self.root_dir = os.path.dirname(path)
+        self.lock = threading.Lock()
+
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as manifest_file:
+                self.entries = json.load(manifest_file)['files']
+
+        # what happened to each output file this run
+        self.changed = []
+        self.unchanged = []
+
+    def get_key(self, output_path):
+        return os.path.relpath(output_path, self.root_dir)
+
+    def is_unchanged(self, output_path, input_hashes):
+        """
+        Whether output_path is still there and was last produced from responses with the same input_hashes (as
+        returned by InputCollector.get_hashes), in which case it's noted as unchanged and needn't be produced again
+        """
+        if input_hashes is None or not os.path.exists(output_path):
+            return False
+
+        key = self.get_key(output_path)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.get('inputs_hash') != get_inputs_hash(input_hashes):
+                return False
+            self.unchanged.append(key)
+        return True
+
+    def commit(self, output_path, temp_path, input_hashes=None):
+        """
+        Moves temp_path (a file or directory) to output_path if its content differs from what was last recorded for
+        output_path, otherwise removes it. Either way the hashes are recorded; returns whether output_path changed.
+        """
+        content_hash = hash_path(temp_path)
+        key = self.get_key(output_path)
+
+        with self.lock:
+            entry = self.entries.get(key, {})
+            changed = entry.get('content_hash') != content_hash or not os.path.exists(output_path)
+
+            if changed:
+                replace_path(temp_path, output_path)
+                self.changed.append(key)
+            else:
+                remove_path(temp_path)
+                self.unchanged.append(key)
+
+            self.entries[key] = {
+                'content_hash': content_hash,
+                'inputs_hash': get_inputs_hash(input_hashes) if input_hashes is not None else None,
+                'inputs': input_hashes,
+                'changed_at': datetime.datetime.now().strftime(TIMESTAMP_FORMAT) if changed
+                else entry.get('changed_at'),
+            }
+
+        return changed
+
+    def save(self):
+        with self.lock:
+            manifest = {
+                'files': self.entries,
+                'last_run': {
+                    'saved_at': datetime.datetime.now().strftime(TIMESTAMP_FORMAT),
+                    'changed': sorted(self.changed),
+                },
+            }
+
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            # write then rename, so a crash mid-write doesn't lose the whole manifest
+            with open(self.path + '.tmp', 'w') as manifest_file:
+                json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+            os.rename(self.path + '.tmp', self.path)
+
+    def print_report(self):
+        with self.lock:
+            print 'Output files: %d changed, %d unchanged' % (len(self.changed), len(self.unchanged))
+            for key in sorted(self.changed):
+                print ' ', key
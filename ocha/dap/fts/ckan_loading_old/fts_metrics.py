@@ -0,0 +1,182 @@
+"""
+Per-endpoint instrumentation of FTS fetches, to find out where the time in a run goes.
+For every top-level fetch we record the endpoint family (e.g. Appeal/country, Contribution/emergency,
+funding?GroupBy&Year), the wall time, the time spent getting the response (network or cache/local file), the bytes
+received, the time spent decoding the response into a raw dataframe, the time spent building the final dataframe
+out of that, and the resulting row count.
+
+Records are passed to any hooks registered with add_hook(), and summarized per endpoint family by SUMMARY, which
+can be printed (and optionally dumped as JSON) at process exit with enable_exit_report().
+"""
+
+import atexit
+import collections
+import fts_cache
+import functools
+import json
+import pandas as pd
+import threading
+import time
+
+HOOKS = []
+
+# the record for the fetch currently in progress on each thread
+THREAD_STATE = threading.local()
+
+
+class FetchRecord(object):
+    __slots__ = ['url', 'endpoint_family', 'wall_seconds', 'network_seconds', 'bytes_received', 'decode_seconds',
+                 'build_seconds', 'rows']
+
+    def __init__(self):
+        self.url = None
+        self.endpoint_family = None
+        self.wall_seconds = 0.
+        self.network_seconds = 0.
+        self.bytes_received = 0
+        self.decode_seconds = 0.
+        self.build_seconds = 0.
+        self.rows = None
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class MetricsSummary(object):
+    """
+    Totals of the records seen, per endpoint family
+    """
+    TOTALLED_FIELDS = ['wall_seconds', 'network_seconds', 'bytes_received', 'decode_seconds', 'build_seconds', 'rows']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = collections.defaultdict(lambda: dict.fromkeys(['calls'] + self.TOTALLED_FIELDS, 0))
+
+    def __call__(self, record):
+        with self.lock:
+            totals = self.totals[record.endpoint_family]
+            totals['calls'] += 1
+            for field in self.TOTALLED_FIELDS:
+                totals[field] += getattr(record, field) or 0
+
+    def as_dataframe(self):
+        """
+        One row per endpoint family, slowest (in total) first
+        """
+        with self.lock:
+            summary = pd.DataFrame.from_dict(dict(self.totals), orient='index')
+
+        if summary.empty:
+            return summary
+
+        summary.index.name = 'endpoint_family'
+        summary['mean_wall_seconds'] = summary.wall_seconds / summary.calls
+        summary = summary[['calls', 'wall_seconds', 'mean_wall_seconds', 'network_seconds', 'bytes_received',
+                           'decode_seconds', 'build_seconds', 'rows']]
+        return summary.sort('wall_seconds', ascending=False)
+
+    def write_json(self, path):
+        with self.lock:
+            totals = dict(self.totals)
+
+        with open(path, 'w') as json_file:
+            json.dump(totals, json_file, indent=2, sort_keys=True)
+
+    def clear(self):
+        with self.lock:
+            self.totals.clear()
+
+
+SUMMARY = MetricsSummary()
+HOOKS.append(SUMMARY)
+
+
+def add_hook(hook):
+    """
+    hook will be called with a FetchRecord after each top-level fetch completes (on the thread that fetched)
+    """
+    HOOKS.append(hook)
+
+
+def remove_hook(hook):
+    HOOKS.remove(hook)
+
+
+def get_current_record():
+    return getattr(THREAD_STATE, 'record', None)
+
+
+def instrumented(function):
+    """
+    Decorator for fetch functions. Only the outermost decorated call on a thread produces a record,
+    as fetch functions are layered on top of each other.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if get_current_record() is not None:
+            return function(*args, **kwargs)
+
+        record = FetchRecord()
+        THREAD_STATE.record = record
+        start = time.time()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            THREAD_STATE.record = None
+
+        record.wall_seconds = time.time() - start
+        # whatever isn't spent getting and decoding the response goes to building the final dataframe
+        record.build_seconds = max(0., record.wall_seconds - record.network_seconds - record.decode_seconds)
+        if hasattr(result, '__len__'):
+            record.rows = len(result)
+
+        for hook in HOOKS:
+            hook(record)
+
+        return result
+
+    return wrapper
+
+
+def note_url(url):
+    record = get_current_record()
+    if record is not None and record.url is None:
+        record.url = url
+        record.endpoint_family = fts_cache.get_endpoint_family(url)
+
+
+def note_response(seconds, byte_count):
+    record = get_current_record()
+    if record is not None:
+        record.network_seconds += seconds
+        record.bytes_received += byte_count
+
+
+def note_bytes(byte_count):
+    record = get_current_record()
+    if record is not None:
+        record.bytes_received += byte_count
+
+
+def note_decode(seconds):
+    record = get_current_record()
+    if record is not None:
+        record.decode_seconds += seconds
+
+
+def print_summary():
+    summary = SUMMARY.as_dataframe()
+    if summary.empty:
+        return
+
+    print 'FTS fetches by endpoint:'
+    print summary.to_string()
+
+
+def enable_exit_report(json_path=None):
+    """
+    Print the per-endpoint summary when the process exits, and also write it as JSON if json_path is given
+    """
+    atexit.register(print_summary)
+    if json_path:
+        atexit.register(SUMMARY.write_json, json_path)
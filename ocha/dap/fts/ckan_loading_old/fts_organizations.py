@@ -0,0 +1,155 @@
+"""
+Lookup of FTS organizations by name.
+Other API calls (e.g. funding grouped by Recipient) only refer to organizations by their free-text name, so finding
+an organization's type means joining on that name. Rather than every script fetching the (big) organizations
+response and indexing it again, OrganizationLookup builds a hash index on normalized names once, saves it next to
+the response cache, and shares it within the process.
+
+Names are normalized (case, accents, punctuation and whitespace) before lookup, so trivial differences still match.
+Names that normalize the same but belong to organizations of different types are ambiguous; they resolve to the
+organization with the lowest id, and are listed by print_report(), along with any names that didn't match at all.
+"""
+
+import collections
+import fts_cache
+import fts_queries
+import os
+import pandas as pd
+import pickle
+import re
+import threading
+import time
+import unicodedata
+
+DEFAULT_PATH = os.path.join(fts_cache.DEFAULT_CACHE_DIR, 'organization_lookup.pickle')
+DEFAULT_MAX_AGE = 7 * 24 * 60 * 60  # organizations don't change often
+
+NON_ALPHANUMERIC = re.compile(r'[^0-9a-z]+', re.UNICODE)
+
+
+def normalize_name(name):
+    """
+    u'  M\xe9decins Sans Fronti\xe8res (MSF)' -> u'medecins sans frontieres msf'
+    """
+    if not isinstance(name, unicode):
+        name = str(name).decode('utf-8', 'replace')
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+    return NON_ALPHANUMERIC.sub(' ', name.lower()).strip()
+
+
+class OrganizationLookup(object):
+    def __init__(self, organizations):
+        """
+        organizations is as returned by fts_queries.fetch_organizations_json_as_dataframe (indexed by id), and
+        needs at least the name and type columns
+        """
+        # normalized name -> (id, name, type), and normalized name -> ids, for names shared by different types
+        self.by_name = {}
+        self.ambiguous = {}
+
+        for organization_id, name, organization_type in sorted(zip(organizations.index, organizations.name,
+                                                                   organizations.type)):
+            if pd.isnull(name):
+                continue
+
+            key = normalize_name(name)
+            existing = self.by_name.get(key)
+            if existing is None:
+                self.by_name[key] = (organization_id, name, organization_type)
+            elif existing[2] != organization_type:
+                self.ambiguous.setdefault(key, [existing[0]]).append(organization_id)
+
+        self.init_unmatched()
+
+    def init_unmatched(self):
+        self.unmatched = collections.Counter()
+        self.unmatched_lock = threading.Lock()
+
+    def __getstate__(self):
+        # only the index itself is worth saving
+        return {'by_name': self.by_name, 'ambiguous': self.ambiguous}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.init_unmatched()
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def get(self, name):
+        """
+        The (id, name, type) of the organization called name, or None (noted for the report) if there isn't one
+        """
+        if pd.isnull(name):
+            return None
+
+        organization = self.by_name.get(normalize_name(name))
+        if organization is None:
+            with self.unmatched_lock:
+                self.unmatched[name] += 1
+        return organization
+
+    def get_type(self, name, default=None):
+        organization = self.get(name)
+        return organization[2] if organization is not None else default
+
+    def map_types(self, names, default=None):
+        """
+        The type for each of names (e.g. a recipient column or index), looking up each distinct name only once
+        """
+        names = pd.Series(names)
+        types = dict((name, self.get_type(name, default)) for name in names.unique())
+        return names.map(types).values
+
+    def print_report(self):
+        if self.ambiguous:
+            print 'Organization names shared by organizations of different types (resolved to the lowest id):'
+            for key, organization_ids in sorted(self.ambiguous.iteritems()):
+                print '  %s: %s' % (self.by_name[key][1], ', '.join(str(organization_id)
+                                                                     for organization_id in organization_ids))
+
+        with self.unmatched_lock:
+            if self.unmatched:
+                print 'Organization names not found (times looked up):'
+                for name, count in self.unmatched.most_common():
+                    print '  %s: %d' % (name, count)
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with open(path + '.tmp', 'wb') as lookup_file:
+            pickle.dump(self, lookup_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as lookup_file:
+            return pickle.load(lookup_file)
+
+
+# the lookup shared within the process, see get_organization_lookup()
+LOOKUP = None
+LOOKUP_LOCK = threading.Lock()
+
+
+def get_organization_lookup(path=DEFAULT_PATH, max_age=DEFAULT_MAX_AGE, refresh=False):
+    """
+    The shared lookup, loaded from path if it was saved there less than max_age seconds ago,
+    otherwise built from a fresh fetch of the organizations (and saved to path)
+    """
+    global LOOKUP
+
+    with LOOKUP_LOCK:
+        if LOOKUP is not None and not refresh:
+            return LOOKUP
+
+        if not refresh and os.path.exists(path) and time.time() - os.path.getmtime(path) < max_age:
+            LOOKUP = OrganizationLookup.load(path)
+        else:
+            organizations = fts_queries.fetch_organizations_json_as_dataframe(columns=['name', 'type'])
+            LOOKUP = OrganizationLookup(organizations)
+            LOOKUP.save(path)
+
+        return LOOKUP
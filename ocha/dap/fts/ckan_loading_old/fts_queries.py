@@ -5,16 +5,181 @@ At some point we may want to create dedicated classes for each type of data retu
 but then we'll also need to implement join logic between these classes.
 """
 
+import collections
+import datetime
+import fts_cache
+import fts_categories
+import fts_client
+import fts_clusters
+import fts_coalescing
+import fts_manifest
+import fts_metrics
+import fts_sources
+import fts_streaming
+import itertools
+import os
 import pandas as pd
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
-FTS_BASE_URL = 'http://fts.unocha.org/api/v1/'
+# can be pointed at a local stand-in (see fts_stub_server) for offline runs and benchmarking
+FTS_BASE_URL = os.environ.get('FTS_BASE_URL', 'http://fts.unocha.org/api/v1/')
 JSON_SUFFIX = '.json'
 
+# calls are latency bound rather than CPU bound, so threads work fine for fetching many things at once
+DEFAULT_MAX_WORKERS = 8
 
+# formats FTS uses for dates, tried in order before resorting to dateutil's lenient parser
+DATE_FORMATS = ['%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S']
+
+# every date string parsed so far, and those that needed the lenient parser
+DATE_CACHE = {}
+FALLBACK_DATE_STRINGS = set()
+DATE_CACHE_LOCK = threading.Lock()
+DATE_PARSING_STATS = {'values': 0, 'fallback_values': 0}
+
+# all fetches go through this client, so connections are pooled and kept alive between calls
+DEFAULT_CLIENT = fts_client.FtsClient()
+
+# where the data actually comes from, the live API unless configured otherwise (see fts_sources)
+DATA_SOURCE = fts_sources.create_data_source(os.environ.get('FTS_DATA_SOURCE', 'web'), DEFAULT_CLIENT)
+
+
+# endpoints whose results are kept for a few minutes after completing, as they're small and asked for repeatedly (e.g.
+# a country's appeals for both the appeals and projects CSVs); big ones like Contribution and Project aren't kept
+RETAINED_ENDPOINTS = {'Country', 'Organization', 'Sector', 'Appeal', 'Emergency'}
+
+# identical requests made while one is in flight, or shortly after it completed, share its result
+COALESCER = fts_coalescing.RequestCoalescer(retain=lambda url: fts_cache.get_endpoint(url) in RETAINED_ENDPOINTS)
+
+# endpoints whose responses are decoded record by record to keep peak memory down, see enable_streaming()
+STREAMING_ENDPOINTS = set()
+
+# answers funding/pledges GroupBy queries instead of the server if set, see set_grouping_engine()
+GROUPING_ENGINE = None
+
+# endpoints whose low-cardinality string columns are converted to categoricals, see enable_categoricals()
+CATEGORICAL_ENDPOINTS = set()
+
+
+def set_data_source(data_source):
+    global DATA_SOURCE
+    DATA_SOURCE = data_source
+
+
+def set_grouping_engine(grouping_engine):
+    """
+    Have fetch_grouping_type_json_as_dataframe call grouping_engine.get_grouping() (with the same arguments)
+    rather than the server, e.g. a fts_aggregation.LocalGroupingEngine. None goes back to the server.
+    """
+    global GROUPING_ENGINE
+    GROUPING_ENGINE = grouping_engine
+
+
+def enable_streaming(endpoints=('Organization', 'Contribution')):
+    """
+    Decode responses from these endpoints incrementally (see fts_streaming).
+    This uses much less memory for large responses, but is slower than pd.read_json's decoder.
+    """
+    STREAMING_ENDPOINTS.update(endpoints)
+
+
+def enable_categoricals(endpoints=('Contribution', 'Project', 'Organization', 'funding', 'pledges')):
+    """
+    Convert the repetitive string columns (donor, status, cluster, ...) of responses from these endpoints to
+    categoricals with process-wide codes (see fts_categories).
+    Concatenate the resulting frames with concat_non_empty_dataframes(), as pd.concat can't handle categoricals.
+    """
+    CATEGORICAL_ENDPOINTS.update(endpoints)
+
+
+def categorize_if_enabled(url, dataframe):
+    if fts_cache.get_endpoint(url) in CATEGORICAL_ENDPOINTS:
+        fts_categories.CATEGORIES.categorize(dataframe)
+    return dataframe
+
+
+def configure_default_client(**kwargs):
+    """
+    Replace the default client, e.g. to change pool_size or timeouts (see fts_client.FtsClient).
+    Any response cache already enabled is carried over.
+    """
+    global DEFAULT_CLIENT
+    kwargs.setdefault('cache', DEFAULT_CLIENT.cache)
+    DEFAULT_CLIENT.close()
+    DEFAULT_CLIENT = fts_client.FtsClient(**kwargs)
+    if isinstance(DATA_SOURCE, fts_sources.WebDataSource):
+        DATA_SOURCE.client = DEFAULT_CLIENT
+    return DEFAULT_CLIENT
+
+
+def enable_response_cache(**kwargs):
+    """
+    Keep raw responses on disk between runs.
+    Accepts the same arguments as fts_cache.ResponseCache, e.g. cache_dir, max_bytes, ttls, cache_only
+    """
+    return DEFAULT_CLIENT.enable_cache(**kwargs)
+
+
+def disable_response_cache():
+    DEFAULT_CLIENT.cache = None
+
+
+@fts_metrics.instrumented
 def fetch_json_as_dataframe(url):
-    return pd.read_json(url)
+    """
+    Note that identical requests may be merged into one fetch, each caller getting a copy of their own (see
+    fts_coalescing)
+    """
+    fts_metrics.note_url(url)
+    fts_manifest.note_input(url)
+    return COALESCER.fetch(url, lambda: fetch_json_as_dataframe_uncoalesced(url))
+
+
+def fetch_json_as_dataframe_uncoalesced(url):
+    if fts_cache.get_endpoint(url) in STREAMING_ENDPOINTS:
+        return fetch_json_as_dataframe_streaming(url)
+
+    return categorize_if_enabled(url, DATA_SOURCE.fetch_json_as_dataframe(url))
+
+
+def iter_json_records(url):
+    """
+    Yields the records of the JSON array at url one at a time, reading only as much of the response as needed
+    """
+    return fts_streaming.iter_json_array_records(DATA_SOURCE.iter_content(url))
+
+
+@fts_metrics.instrumented
+def fetch_json_as_dataframe_streaming(url, columns=None, max_records=None):
+    """
+    Like fetch_json_as_dataframe, but decodes the response record by record straight into column buffers.
+    columns restricts the result to just those columns, max_records stops reading after that many records.
+    """
+    fts_metrics.note_url(url)
+    fts_manifest.note_input(url)
+
+    try:
+        records = iter_json_records(url)
+    except NotImplementedError:
+        # this source can't stream (e.g. snapshots, which are already dataframes), so just trim what it returns
+        dataframe = DATA_SOURCE.fetch_json_as_dataframe(url)
+        if columns:
+            dataframe = dataframe.reindex(columns=columns)
+        if max_records is not None:
+            dataframe = dataframe[:max_records]
+        return categorize_if_enabled(url, dataframe)
+
+    # reading the response and decoding it are interleaved, so this is all counted as decoding
+    start = time.time()
+    dataframe = fts_streaming.records_to_dataframe(records, columns=columns, max_records=max_records)
+    fts_metrics.note_decode(time.time() - start)
 
+    return categorize_if_enabled(url, dataframe)
 
+
+@fts_metrics.instrumented
 def fetch_json_as_dataframe_with_id(url):
     dataframe = fetch_json_as_dataframe(url)
     if 'id' in dataframe.columns:
@@ -27,23 +192,95 @@ def build_json_url(middle_part):
     return FTS_BASE_URL + middle_part + JSON_SUFFIX
 
 
+def parse_date_string(date_string):
+    """
+    Returns the Timestamp for date_string, and whether it had to fall back to the (slow, lenient) dateutil parser
+    because it didn't match any of DATE_FORMATS
+    """
+    for date_format in DATE_FORMATS:
+        try:
+            return pd.Timestamp(datetime.datetime.strptime(date_string, date_format)), False
+        except ValueError:
+            continue
+
+    return pd.Timestamp(pd.datetools.parse(date_string)), True
+
+
 def convert_date_columns_from_string_to_timestamp(dataframe, column_names):
+    """
+    Dates repeat a lot (e.g. across all the contributions of a big emergency), so each distinct string is only
+    parsed once per process.
+    Returns the number of values that needed the lenient fallback parser.
+    """
+    fallback_value_count = 0
+
     for column_name in column_names:
-        dataframe[column_name] = dataframe[column_name].apply(pd.datetools.parse)
+        column = dataframe[column_name]
 
+        # missing dates aren't strings, and will simply map to NaT
+        date_strings = [date_string for date_string in column.unique() if isinstance(date_string, basestring)]
 
+        with DATE_CACHE_LOCK:
+            timestamps = dict((date_string, DATE_CACHE[date_string]) for date_string in date_strings
+                              if date_string in DATE_CACHE)
+
+        # parse what's new outside the lock, so other threads aren't held up (two threads might both parse the same
+        # string, which does no harm)
+        parsed = {}
+        fallback_strings = set()
+        for date_string in date_strings:
+            if date_string not in timestamps:
+                parsed[date_string], used_fallback = parse_date_string(date_string)
+                if used_fallback:
+                    fallback_strings.add(date_string)
+
+        with DATE_CACHE_LOCK:
+            DATE_CACHE.update(parsed)
+            FALLBACK_DATE_STRINGS.update(fallback_strings)
+            fallback_strings = [date_string for date_string in date_strings if date_string in FALLBACK_DATE_STRINGS]
+
+        timestamps.update(parsed)
+        if fallback_strings:
+            fallback_value_count += column.isin(fallback_strings).sum()
+
+        # only map with the column's own strings, not the whole cache
+        if timestamps:
+            dataframe[column_name] = column.map(timestamps)
+        else:
+            dataframe[column_name] = pd.Series(pd.NaT, index=column.index, dtype='datetime64[ns]')
+
+    with DATE_CACHE_LOCK:
+        DATE_PARSING_STATS['values'] += len(dataframe) * len(column_names)
+        DATE_PARSING_STATS['fallback_values'] += fallback_value_count
+
+    return fallback_value_count
+
+
+@fts_metrics.instrumented
 def fetch_sectors_json_as_dataframe():
     return fetch_json_as_dataframe_with_id(build_json_url('Sector'))
 
 
+@fts_metrics.instrumented
 def fetch_countries_json_as_dataframe():
     return fetch_json_as_dataframe_with_id(build_json_url('Country'))
 
 
-def fetch_organizations_json_as_dataframe():
-    return fetch_json_as_dataframe_with_id(build_json_url('Organization'))
+@fts_metrics.instrumented
+def fetch_organizations_json_as_dataframe(columns=None):
+    """
+    This is a big response, so optionally only keep some of the columns (decoding incrementally to save memory)
+    """
+    url = build_json_url('Organization')
+
+    if not columns:
+        return fetch_json_as_dataframe_with_id(url)
+
+    columns = ['id'] + [column for column in columns if column != 'id']
+    return fetch_json_as_dataframe_streaming(url, columns=columns).set_index('id')
 
 
+@fts_metrics.instrumented
 def fetch_emergencies_json_for_country_as_dataframe(country):
     """
     This accepts both names ("Slovakia") and ISO country codes ("SVK")
@@ -51,10 +288,12 @@ def fetch_emergencies_json_for_country_as_dataframe(country):
     return fetch_json_as_dataframe_with_id(build_json_url('Emergency/country/' + country))
 
 
+@fts_metrics.instrumented
 def fetch_emergencies_json_for_year_as_dataframe(year):
     return fetch_json_as_dataframe_with_id(build_json_url('Emergency/year/' + str(year)))
 
 
+@fts_metrics.instrumented
 def fetch_appeals_json_as_dataframe_given_url(url):
     dataframe = fetch_json_as_dataframe_with_id(url)
     if not dataframe.empty:
@@ -62,6 +301,7 @@ def fetch_appeals_json_as_dataframe_given_url(url):
     return dataframe
 
 
+@fts_metrics.instrumented
 def fetch_appeals_json_for_country_as_dataframe(country):
     """
     This accepts both names ("Slovakia") and ISO country codes ("SVK")
@@ -69,10 +309,12 @@ def fetch_appeals_json_for_country_as_dataframe(country):
     return fetch_appeals_json_as_dataframe_given_url(build_json_url('Appeal/country/' + country))
 
 
+@fts_metrics.instrumented
 def fetch_appeals_json_for_year_as_dataframe(year):
     return fetch_appeals_json_as_dataframe_given_url(build_json_url('Appeal/year/' + str(year)))
 
 
+@fts_metrics.instrumented
 def fetch_projects_json_for_appeal_as_dataframe(appeal_id):
     dataframe = fetch_json_as_dataframe_with_id(build_json_url('Project/appeal/' + str(appeal_id)))
     if not dataframe.empty:  # guard against empty result
@@ -80,11 +322,85 @@ def fetch_projects_json_for_appeal_as_dataframe(appeal_id):
     return dataframe
 
 
+def fetch_many(fetch_function, ids, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Calls fetch_function on each of the ids using a bounded pool of threads.
+    Results are returned as a list in the same order as the ids.
+    """
+    ids = list(ids)
+    # inputs fetched on the pool threads belong to whatever output this thread is producing
+    fetch_function = fts_manifest.propagate_inputs(fetch_function)
+
+    if max_workers <= 1 or len(ids) <= 1:
+        return [fetch_function(single_id) for single_id in ids]
+
+    pool = ThreadPool(min(max_workers, len(ids)))
+    try:
+        return pool.map(fetch_function, ids)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def iter_many(fetch_function, ids, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Like fetch_many, but yields the results one by one in the same order as the ids, as soon as each is available.
+    At most 2 * max_workers results are fetched ahead of the one being consumed, so only that many are held at once.
+    """
+    ids = list(ids)
+    fetch_function = fts_manifest.propagate_inputs(fetch_function)
+
+    if max_workers <= 1 or len(ids) <= 1:
+        for single_id in ids:
+            yield fetch_function(single_id)
+        return
+
+    remaining_ids = iter(ids)
+    pool = ThreadPool(min(max_workers, len(ids)))
+    try:
+        pending = collections.deque(pool.apply_async(fetch_function, (single_id,))
+                                    for single_id in itertools.islice(remaining_ids, 2 * max_workers))
+        while pending:
+            result = pending.popleft().get()
+            for single_id in itertools.islice(remaining_ids, 1):
+                pending.append(pool.apply_async(fetch_function, (single_id,)))
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def concat_non_empty_dataframes(dataframes):
+    # empty dataframes can mess up concat, and an empty list can't be concatenated at all
+    non_empty_dataframes = [frame for frame in dataframes if not frame.empty]
+
+    if non_empty_dataframes:
+        # pandas can't concat categorical columns itself, see fts_categories
+        return fts_categories.CATEGORIES.concat(non_empty_dataframes)
+    else:
+        return pd.DataFrame()
+
+
+def fetch_projects_json_for_appeals_as_dataframe(appeal_ids, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    All projects for the given appeals, concatenated into one frame in the order of appeal_ids
+    """
+    return concat_non_empty_dataframes(
+        fetch_many(fetch_projects_json_for_appeal_as_dataframe, appeal_ids, max_workers))
+
+
+@fts_metrics.instrumented
 def fetch_clusters_json_for_appeal_as_dataframe(appeal_id):
+    """
+    Clusters are named differently from one appeal to the next, so a standard_cluster column is added with the
+    standard names (see fts_clusters); call save_mapping() on fts_clusters.get_cluster_standardizer() when done
+    """
     # NOTE no id present in this data
-    return fetch_json_as_dataframe(build_json_url('Cluster/appeal/' + str(appeal_id)))
+    dataframe = fetch_json_as_dataframe(build_json_url('Cluster/appeal/' + str(appeal_id)))
+    return fts_clusters.get_cluster_standardizer().standardize_frame(dataframe, column='name')
 
 
+@fts_metrics.instrumented
 def fetch_contributions_json_as_dataframe_given_url(url):
     dataframe = fetch_json_as_dataframe_with_id(url)
     if not dataframe.empty:  # guard against empty result
@@ -92,15 +408,26 @@ def fetch_contributions_json_as_dataframe_given_url(url):
     return dataframe
 
 
+@fts_metrics.instrumented
 def fetch_contributions_json_for_appeal_as_dataframe(appeal_id):
     return fetch_contributions_json_as_dataframe_given_url(build_json_url('Contribution/appeal/' + str(appeal_id)))
 
 
+@fts_metrics.instrumented
 def fetch_contributions_json_for_emergency_as_dataframe(emergency_id):
     return fetch_contributions_json_as_dataframe_given_url(
         build_json_url('Contribution/emergency/' + str(emergency_id)))
 
 
+def fetch_contributions_json_for_emergencies_as_dataframe(emergency_ids, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    All contributions for the given emergencies, concatenated into one frame in the order of emergency_ids
+    """
+    return concat_non_empty_dataframes(
+        fetch_many(fetch_contributions_json_for_emergency_as_dataframe, emergency_ids, max_workers))
+
+
+@fts_metrics.instrumented
 def fetch_grouping_type_json_as_dataframe(middle_part, query, grouping, alias):
     """
     Query can be one of:
@@ -119,7 +446,16 @@ def fetch_grouping_type_json_as_dataframe(middle_part, query, grouping, alias):
         Country
         Cluster
     Alias is used to name the grouping type column and use it as an index.
+    If a grouping engine is set (see set_grouping_engine), it answers instead of the server.
     """
+    if GROUPING_ENGINE is not None:
+        return GROUPING_ENGINE.get_grouping(middle_part, query, grouping, alias)
+
+    return fetch_grouping_type_json_from_server(middle_part, query, grouping, alias)
+
+
+@fts_metrics.instrumented
+def fetch_grouping_type_json_from_server(middle_part, query, grouping, alias):
     url = build_json_url(middle_part) + '?' + query
 
     if grouping:
@@ -138,21 +474,25 @@ def fetch_grouping_type_json_as_dataframe(middle_part, query, grouping, alias):
         processed_frame = processed_frame.rename(columns={'type': alias, 'amount': middle_part})
         processed_frame = processed_frame.set_index(alias)
 
-    return processed_frame
+    return categorize_if_enabled(url, processed_frame)
 
 
+@fts_metrics.instrumented
 def fetch_grouping_type_json_for_appeal_as_dataframe(middle_part, appeal_id, grouping, alias):
     return fetch_grouping_type_json_as_dataframe(middle_part, 'Appeal=' + str(appeal_id), grouping, alias)
 
 
+@fts_metrics.instrumented
 def fetch_grouping_type_json_for_emergency_as_dataframe(middle_part, emergency_id, grouping, alias):
     return fetch_grouping_type_json_as_dataframe(middle_part, 'Emergency=' + str(emergency_id), grouping, alias)
 
 
+@fts_metrics.instrumented
 def fetch_grouping_type_json_for_year_as_dataframe(middle_part, year, grouping, alias):
     return fetch_grouping_type_json_as_dataframe(middle_part, 'Year=' + str(year), grouping, alias)
 
 
+@fts_metrics.instrumented
 def fetch_funding_json_for_appeal_as_dataframe(appeal_id, grouping, alias):
     """
     Committed or contributed funds, including carry over from previous years
@@ -160,6 +500,7 @@ def fetch_funding_json_for_appeal_as_dataframe(appeal_id, grouping, alias):
     return fetch_grouping_type_json_for_appeal_as_dataframe("funding", appeal_id, grouping, alias)
 
 
+@fts_metrics.instrumented
 def fetch_funding_json_for_emergency_as_dataframe(emergency_id, grouping, alias):
     """
     Committed or contributed funds, including carry over from previous years
@@ -167,6 +508,7 @@ def fetch_funding_json_for_emergency_as_dataframe(emergency_id, grouping, alias)
     return fetch_grouping_type_json_for_emergency_as_dataframe("funding", emergency_id, grouping, alias)
 
 
+@fts_metrics.instrumented
 def fetch_pledges_json_for_appeal_as_dataframe(appeal_id, grouping, alias):
     """
     Contains uncommitted pledges, not funding that has already processed to commitment or contribution stages
@@ -175,11 +517,11 @@ def fetch_pledges_json_for_appeal_as_dataframe(appeal_id, grouping, alias):
 
 
 if __name__ == "__main__":
-    # test various fetch commands (requires internet connection)
+    # test various fetch commands (requires internet connection, or FTS_BASE_URL pointing at fts_stub_server)
     country = 'Chad'
     appeal_id = 942
 
     print fetch_sectors_json_as_dataframe()
     print fetch_emergencies_json_for_country_as_dataframe(country)
     print fetch_projects_json_for_appeal_as_dataframe(appeal_id)
-    print fetch_funding_json_for_appeal_as_dataframe(appeal_id)
+    print fetch_funding_json_for_appeal_as_dataframe(appeal_id, 'Donor', 'donor')
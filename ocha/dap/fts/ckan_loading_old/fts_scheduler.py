@@ -0,0 +1,261 @@
+"""
+Schedules calls to the FTS API so full runs survive throttling and transient errors, rather than failing halfway.
+Each call goes through:
+  - a token bucket, limiting the rate of requests
+  - a concurrency cap, limiting the number of requests in flight at once
+  - retries with jittered exponential backoff, for errors worth retrying
+Both the rate and the concurrency cap adapt: they back off sharply when the server throttles us (429/503) or slows
+down, at most once per decrease_interval so a burst of throttling responses to requests already in flight doesn't
+drive them to the floor, and creep back up while things are going well. Other retryable errors (timeouts, other
+5xx) are just retried, as they say nothing about how fast we're going.
+"""
+
+import random
+import requests
+import threading
+import time
+
+# HTTP statuses worth retrying: throttling, and the server or a proxy in front of it having a bad moment
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+THROTTLING_STATUSES = {429, 503}
+
+DEFAULT_RATE = 200.  # requests per second, well above what a full run manages unthrottled
+DEFAULT_MIN_RATE = 0.5
+DEFAULT_DECREASE_INTERVAL = 1.  # seconds
+DEFAULT_MAX_CONCURRENCY = 16
+DEFAULT_INITIAL_CONCURRENCY = 8
+DEFAULT_MAX_RETRIES = 6
+DEFAULT_BACKOFF_BASE = 0.5  # seconds
+DEFAULT_BACKOFF_MAX = 60.
+# responses slower than this count as the server struggling
+DEFAULT_TARGET_LATENCY = 10.
+
+
+def get_http_status(error):
+    response = getattr(error, 'response', None)
+    return response.status_code if response is not None else None
+
+
+def is_retryable(error):
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return get_http_status(error) in RETRYABLE_STATUSES
+
+
+def is_throttling(error):
+    return get_http_status(error) in THROTTLING_STATUSES
+
+
+def get_retry_after(error):
+    """
+    Seconds the server asked us to wait, if any (only the delta-seconds form of Retry-After is handled)
+    """
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket(object):
+    """
+    Allows rate calls per second on average, with bursts of up to burst calls
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1., rate)
+        self.tokens = self.burst
+        self.last_refill = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+
+
+class RequestScheduler(object):
+    """
+    Runs calls with rate limiting, an adaptive concurrency cap and retries (see module docstring).
+    The adaptation is additive increase/multiplicative decrease: every success nudges the rate and concurrency
+    cap back up towards their maximums, a throttling response or slow response halves them (at most once per
+    decrease_interval).
+    """
+    def __init__(self, rate=DEFAULT_RATE, min_rate=DEFAULT_MIN_RATE, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 initial_concurrency=DEFAULT_INITIAL_CONCURRENCY, max_retries=DEFAULT_MAX_RETRIES,
+                 backoff_base=DEFAULT_BACKOFF_BASE, backoff_max=DEFAULT_BACKOFF_MAX,
+                 target_latency=DEFAULT_TARGET_LATENCY, decrease_interval=DEFAULT_DECREASE_INTERVAL):
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.bucket = TokenBucket(rate)
+
+        self.max_concurrency = max_concurrency
+        self.concurrency_limit = float(min(initial_concurrency, max_concurrency))
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.target_latency = target_latency
+        self.decrease_interval = decrease_interval
+        self.last_decrease = 0.
+
+        self.random = random.Random()
+
+        self.calls = 0
+        self.attempts = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failures = 0
+
+    def call(self, function):
+        """
+        Returns function(), retrying it if it raises a retryable error
+        """
+        with self.condition:
+            self.calls += 1
+
+        for attempt in range(self.max_retries + 1):
+            self.acquire_slot()
+            self.bucket.acquire()
+
+            start = time.time()
+            try:
+                result = function()
+            except Exception as error:
+                self.release_slot()
+
+                if not is_retryable(error):
+                    self.count('failures')
+                    raise
+
+                self.on_error(error)
+
+                if attempt == self.max_retries:
+                    self.count('failures')
+                    raise
+
+                self.count('retries')
+                time.sleep(self.get_backoff(attempt, error))
+                continue
+
+            self.release_slot()
+            self.on_success(time.time() - start)
+            return result
+
+    def acquire_slot(self):
+        with self.condition:
+            while self.in_flight >= int(self.concurrency_limit):
+                self.condition.wait()
+            self.in_flight += 1
+            self.attempts += 1
+
+    def release_slot(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def get_backoff(self, attempt, error):
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+
+        # "full jitter", so threads that failed together don't all retry together
+        return self.random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def on_success(self, latency):
+        if latency > self.target_latency:
+            self.back_off()
+            return
+
+        with self.condition:
+            # additive increase: roughly +1 concurrency per "window" of concurrency_limit successes
+            self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1. / self.concurrency_limit)
+            new_rate = min(self.max_rate, self.bucket.rate + 0.1)
+            self.condition.notify()
+
+        self.bucket.set_rate(new_rate)
+
+    def on_error(self, error):
+        # only throttling says we're going too fast, other errors are retried at the same pace
+        if is_throttling(error):
+            self.count('throttled')
+            self.back_off()
+
+    def back_off(self):
+        with self.condition:
+            # responses to requests sent before the last decrease don't reflect it yet
+            now = time.time()
+            if now - self.last_decrease < self.decrease_interval:
+                return
+            self.last_decrease = now
+
+            self.concurrency_limit = max(1., self.concurrency_limit / 2)
+            new_rate = max(self.min_rate, self.bucket.rate / 2)
+
+        self.bucket.set_rate(new_rate)
+
+    def count(self, counter_name):
+        with self.condition:
+            setattr(self, counter_name, getattr(self, counter_name) + 1)
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                'calls': self.calls,
+                'attempts': self.attempts,
+                'retries': self.retries,
+                'throttled': self.throttled,
+                'failures': self.failures,
+                'concurrency_limit': int(self.concurrency_limit),
+                'rate': self.bucket.rate,
+            }
+
+    def print_stats(self):
+        stats = self.get_stats()
+        print 'Request scheduling: %d calls, %d attempts, %d retries (%d throttled), %d failures, ' \
+              'now at %d concurrent and %.1f requests/second' %\
+            (stats['calls'], stats['attempts'], stats['retries'], stats['throttled'], stats['failures'],
+             stats['concurrency_limit'], stats['rate'])
+
+
+if __name__ == "__main__":
+    # exercise the scheduler against a local stub server that fails/throttles a good share of requests
+    import fts_client
+    import fts_stub_server
+    import fts_synthetic
+    from multiprocessing.pool import ThreadPool
+
+    server = fts_stub_server.start_in_background(failure_rate=0.2, throttle_rate=0.1, latency=0.05, seed=0,
+                                                 synthetic_data=fts_synthetic.SyntheticFtsData(seed=0))
+    client = fts_client.FtsClient(scheduler=RequestScheduler(backoff_base=0.05, backoff_max=1.))
+
+    appeal_ids = range(fts_synthetic.FIRST_APPEAL_ID, fts_synthetic.FIRST_APPEAL_ID + 200)
+    urls = [server.base_url + 'Project/appeal/' + str(appeal_id) + '.json' for appeal_id in appeal_ids]
+
+    start = time.time()
+    pool = ThreadPool(16)
+    responses = pool.map(client.fetch_url_content, urls)
+    pool.close()
+
+    print 'Fetched', len(responses), 'responses in %.1f seconds' % (time.time() - start)
+    client.scheduler.print_stats()
+    server.shutdown()
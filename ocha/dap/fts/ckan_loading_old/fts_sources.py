@@ -0,0 +1,244 @@
+"""
+Pluggable sources for the raw data behind fts_queries, so the same queries can be answered from a local mirror
+as well as from the live API:
+  - WebDataSource: the FTS API itself, through an fts_client.FtsClient
+  - JsonDirectoryDataSource: a directory of JSON responses, laid out like the API paths
+  - SnapshotDataSource: a directory of pickled dataframes, by far the fastest to load
+  - RecordingDataSource: wraps another source and saves everything it returns, to build the local mirrors
+
+Sources can be chosen per process with the FTS_DATA_SOURCE environment variable, e.g.
+    FTS_DATA_SOURCE=json:/data/fts_mirror python produce_csvs.py
+"""
+
+import argparse
+import fts_manifest
+import fts_metrics
+import os
+import pandas as pd
+import time
+import urlparse
+
+JSON_EXTENSION = '.json'
+SNAPSHOT_EXTENSION = '.pickle'
+
+
+class DataNotAvailableError(Exception):
+    """
+    Raised by the local sources when they don't hold the requested data
+    """
+    pass
+
+
+def get_relative_key(url):
+    """
+    Turns a URL into a relative path identifying the response, with query parameters in a consistent order, e.g.
+        http://fts.unocha.org/api/v1/Appeal/country/KEN.json -> Appeal/country/KEN
+        http://fts.unocha.org/api/v1/funding.json?Year=2013&GroupBy=donor -> funding/GroupBy=donor&Year=2013
+    """
+    parsed = urlparse.urlparse(url)
+
+    path = parsed.path
+    if '/api/v1/' in path:
+        path = path.split('/api/v1/', 1)[1]
+    path = path.strip('/')
+    if path.endswith(JSON_EXTENSION):
+        path = path[:-len(JSON_EXTENSION)]
+
+    if parsed.query:
+        path += '/' + '&'.join(sorted(parsed.query.split('&')))
+
+    return path
+
+
+def build_local_path(root_dir, url, extension):
+    return os.path.join(root_dir, *(get_relative_key(url) + extension).split('/'))
+
+
+def make_parent_directory(path):
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass  # another thread got there first
+
+
+def write_file(path, content):
+    make_parent_directory(path)
+    with open(path, 'wb') as output_file:
+        output_file.write(content)
+
+
+def read_json_timed(content):
+    start = time.time()
+    dataframe = pd.read_json(content)
+    fts_metrics.note_decode(time.time() - start)
+    return dataframe
+
+
+def iter_file_chunks(path, chunk_size=64 * 1024):
+    with open(path, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(chunk_size), ''):
+            fts_metrics.note_bytes(len(chunk))
+            yield chunk
+
+
+class DataSource(object):
+    """
+    Interface for all sources: given a FTS API URL, return the raw dataframe for it
+    """
+    def fetch_json_as_dataframe(self, url):
+        raise NotImplementedError
+
+    def iter_content(self, url):
+        """
+        Optionally, return the raw JSON for url as an iterable of chunks, for incremental decoding (see fts_streaming)
+        """
+        raise NotImplementedError
+
+
+class WebDataSource(DataSource):
+    def __init__(self, client):
+        self.client = client
+
+    def fetch_content(self, url):
+        return self.client.fetch_content(url)
+
+    def fetch_json_as_dataframe(self, url):
+        return self.client.fetch_json_as_dataframe(url)
+
+    def iter_content(self, url):
+        return fts_manifest.iter_hashed_chunks(url, self.client.iter_content(url))
+
+
+class JsonDirectoryDataSource(DataSource):
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def get_path(self, url):
+        return build_local_path(self.root_dir, url, JSON_EXTENSION)
+
+    def fetch_content(self, url):
+        path = self.get_path(url)
+        if not os.path.exists(path):
+            raise DataNotAvailableError('No JSON file for ' + url + ' at ' + path)
+
+        start = time.time()
+        with open(path, 'rb') as json_file:
+            content = json_file.read()
+        fts_metrics.note_response(time.time() - start, len(content))
+        fts_manifest.note_response_content(url, content)
+
+        return content
+
+    def fetch_json_as_dataframe(self, url):
+        return read_json_timed(self.fetch_content(url))
+
+    def iter_content(self, url):
+        path = self.get_path(url)
+        if not os.path.exists(path):
+            raise DataNotAvailableError('No JSON file for ' + url + ' at ' + path)
+
+        return fts_manifest.iter_hashed_chunks(url, iter_file_chunks(path))
+
+
+class SnapshotDataSource(DataSource):
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def get_path(self, url):
+        return build_local_path(self.root_dir, url, SNAPSHOT_EXTENSION)
+
+    def fetch_json_as_dataframe(self, url):
+        path = self.get_path(url)
+        if not os.path.exists(path):
+            raise DataNotAvailableError('No snapshot for ' + url + ' at ' + path)
+
+        start = time.time()
+        dataframe = pd.read_pickle(path)
+        # reading and unpickling happen together, so count it all as decoding
+        fts_metrics.note_bytes(os.path.getsize(path))
+        fts_metrics.note_decode(time.time() - start)
+
+        return dataframe
+
+
+class RecordingDataSource(DataSource):
+    """
+    Passes calls through to another source (which must provide fetch_content, e.g. WebDataSource),
+    saving responses as JSON files and/or snapshots along the way
+    """
+    def __init__(self, source, json_dir=None, snapshot_dir=None):
+        self.source = source
+        self.json_dir = json_dir
+        self.snapshot_dir = snapshot_dir
+
+    def fetch_content(self, url):
+        return self.source.fetch_content(url)
+
+    def fetch_json_as_dataframe(self, url):
+        content = self.source.fetch_content(url)
+        dataframe = read_json_timed(content)
+
+        if self.json_dir:
+            write_file(build_local_path(self.json_dir, url, JSON_EXTENSION), content)
+        if self.snapshot_dir:
+            snapshot_path = build_local_path(self.snapshot_dir, url, SNAPSHOT_EXTENSION)
+            make_parent_directory(snapshot_path)
+            dataframe.to_pickle(snapshot_path)
+
+        return dataframe
+
+
+def create_data_source(spec, client):
+    """
+    Spec can be one of:
+        web
+        json:<directory>
+        snapshot:<directory>
+        record:<directory>  (live API, mirrored into <directory>/json and <directory>/snapshot)
+    """
+    kind, _, directory = spec.partition(':')
+
+    if kind == 'web':
+        return WebDataSource(client)
+    elif kind == 'json':
+        return JsonDirectoryDataSource(directory)
+    elif kind == 'snapshot':
+        return SnapshotDataSource(directory)
+    elif kind == 'record':
+        return RecordingDataSource(WebDataSource(client),
+                                   json_dir=os.path.join(directory, 'json'),
+                                   snapshot_dir=os.path.join(directory, 'snapshot'))
+    else:
+        raise ValueError('Unknown data source: ' + spec)
+
+
+def convert_json_directory_to_snapshots(json_dir, snapshot_dir):
+    """
+    Build a snapshot mirror out of a JSON mirror
+    """
+    for directory, subdirectories, filenames in os.walk(json_dir):
+        for filename in filenames:
+            if not filename.endswith(JSON_EXTENSION):
+                continue
+
+            json_path = os.path.join(directory, filename)
+            relative_path = os.path.relpath(json_path, json_dir)
+            snapshot_path = os.path.join(snapshot_dir, relative_path[:-len(JSON_EXTENSION)] + SNAPSHOT_EXTENSION)
+
+            with open(json_path, 'rb') as json_file:
+                dataframe = pd.read_json(json_file.read())
+
+            make_parent_directory(snapshot_path)
+            dataframe.to_pickle(snapshot_path)
+            print 'Wrote', snapshot_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert a directory of FTS JSON responses into snapshots')
+    parser.add_argument('json_dir')
+    parser.add_argument('snapshot_dir')
+    args = parser.parse_args()
+
+    convert_json_directory_to_snapshots(args.json_dir, args.snapshot_dir)
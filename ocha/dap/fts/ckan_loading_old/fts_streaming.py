@@ -0,0 +1,124 @@
+"""
+Incremental decoding of the large JSON arrays returned by some FTS endpoints (e.g. Organization and the
+per-emergency Contribution queries).
+pd.read_json loads the whole response as one string, builds a Python object tree from it, and only then builds a
+dataframe, so peak memory is several times that of the final dataframe. Here records are decoded one at a time,
+straight into per-column buffers, so peak memory stays close to the size of the output.
+"""
+
+import json
+import pandas as pd
+
+WHITESPACE = ' \t\n\r'
+
+
+def iter_json_array_records(chunks):
+    """
+    Yields each element of a top-level JSON array, given the text of the array as an iterable of chunks.
+    Only as many chunks are read as are needed, so callers can stop early.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+
+    buffer = ''
+    position = 0
+    exhausted = False
+    # one of: 'start' (expecting '['), 'first' (expecting a value or ']'), 'value', 'separator' (',' or ']')
+    state = 'start'
+
+    while True:
+        while position < len(buffer) and buffer[position] in WHITESPACE:
+            position += 1
+
+        if position >= len(buffer):
+            if exhausted:
+                raise ValueError('Unexpected end of JSON array')
+            buffer, position, exhausted = read_more(chunks, buffer, position)
+            continue
+
+        character = buffer[position]
+
+        if state == 'start':
+            if character != '[':
+                raise ValueError('Expected a JSON array, found ' + repr(character))
+            position += 1
+            state = 'first'
+        elif state in ('first', 'separator') and character == ']':
+            return
+        elif state == 'separator':
+            if character != ',':
+                raise ValueError('Expected "," or "]" in JSON array, found ' + repr(character))
+            position += 1
+            state = 'value'
+        else:
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if exhausted:
+                    raise
+                # most likely the record continues in the next chunk
+                buffer, position, exhausted = read_more(chunks, buffer, position)
+                continue
+
+            if end == len(buffer) and not exhausted:
+                # a number can decode "successfully" when cut short, so make sure this really is the end of it
+                buffer, position, exhausted = read_more(chunks, buffer, position)
+                continue
+
+            position = end
+            state = 'separator'
+            yield record
+
+
+def read_more(chunks, buffer, position):
+    """
+    Drops the already decoded part of the buffer and appends the next chunk.
+    Returns the new buffer, position and whether the chunks are exhausted.
+    """
+    try:
+        chunk = next(chunks)
+    except StopIteration:
+        return buffer, position, True
+
+    return buffer[position:] + chunk, 0, False
+
+
+def records_to_dataframe(records, columns=None, max_records=None):
+    """
+    Builds a dataframe from an iterable of dicts, one column buffer at a time.
+    columns restricts the output to just those columns, max_records stops reading after that many records.
+    """
+    buffers = {}
+    if columns:
+        for column in columns:
+            buffers[column] = []
+
+    record_count = 0
+
+    for record in records:
+        if max_records is not None and record_count >= max_records:
+            break
+
+        for column in (columns or record):
+            if column not in buffers:
+                # a column we haven't seen before, fill in for the earlier records
+                buffers[column] = [None] * record_count
+            buffers[column].append(record.get(column))
+
+        record_count += 1
+
+        # fill in any columns missing from this record
+        if not columns and len(buffers) != len(record):
+            for column_buffer in buffers.itervalues():
+                if len(column_buffer) < record_count:
+                    column_buffer.append(None)
+
+    # pd.read_json sorts columns by name, so do the same unless asked for specific ones
+    column_order = columns or sorted(buffers)
+
+    dataframe = pd.DataFrame(index=range(record_count))
+    for column in column_order:
+        # pop as we go so we don't hold both the buffer and the column
+        dataframe[column] = buffers.pop(column)
+
+    return dataframe
@@ -0,0 +1,164 @@
+"""
+A local stand-in for the FTS API, for exercising the client and benchmarking full runs without hitting the real server.
+Responses come from a directory of recorded fixtures if given, laid out as for fts_sources.JsonDirectoryDataSource
+(so a run with FTS_DATA_SOURCE=record:<dir> records them into <dir>/json), falling back to synthetic data generated
+for every endpoint shape (see fts_synthetic). Anything not covered by either gets a 404.
+
+It can add latency (fixed, plus random jitter) to every response, and inject failures (HTTP 500) and throttling
+(HTTP 429) into a share of them. Point fts_queries at it by setting FTS_BASE_URL to the base URL it prints.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import fts_sources
+import fts_synthetic
+import os
+import random
+import threading
+import time
+import urlparse
+
+
+class StubRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+
+        delay = server.get_delay()
+        if delay:
+            time.sleep(delay)
+
+        roll = server.roll()
+
+        if roll < server.throttle_rate:
+            self.send_body(429, 'Too Many Requests', '', extra_headers={'Retry-After': '1'})
+        elif roll < server.throttle_rate + server.failure_rate:
+            self.send_body(500, 'Internal Server Error', '')
+        else:
+            body = server.get_response_body(self.path)
+            if body is None:
+                self.send_body(404, 'Not Found', '')
+            else:
+                self.send_body(200, 'OK', body)
+
+    def send_body(self, status, message, body, extra_headers=None):
+        self.send_response(status, message)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (extra_headers or {}).iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # far too noisy when benchmarking
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, failure_rate=0., throttle_rate=0., latency=0., jitter=0., seed=None,
+                 fixtures_dir=None, synthetic_data=None):
+        """
+        synthetic_data is a fts_synthetic.SyntheticFtsData, or None to only serve the fixtures
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), StubRequestHandler)
+
+        self.failure_rate = failure_rate
+        self.throttle_rate = throttle_rate
+        self.latency = latency
+        self.jitter = jitter
+
+        self.fixtures_dir = fixtures_dir
+        self.synthetic_data = synthetic_data
+
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+
+        self.base_url = 'http://127.0.0.1:%d/api/v1/' % self.server_address[1]
+
+    def roll(self):
+        with self.random_lock:
+            return self.random.random()
+
+    def get_delay(self):
+        if not self.jitter:
+            return self.latency
+        return self.latency + self.roll() * self.jitter
+
+    def get_fixture_body(self, path):
+        if not self.fixtures_dir:
+            return None
+
+        fixture_path = fts_sources.build_local_path(self.fixtures_dir, path, fts_sources.JSON_EXTENSION)
+        if not os.path.exists(fixture_path):
+            return None
+
+        with open(fixture_path, 'rb') as fixture_file:
+            return fixture_file.read()
+
+    def get_synthetic_body(self, path):
+        if self.synthetic_data is None:
+            return None
+
+        parsed = urlparse.urlparse(path)
+        api_path = parsed.path.split('/api/v1/', 1)[-1].strip('/')
+        if api_path.endswith(fts_sources.JSON_EXTENSION):
+            api_path = api_path[:-len(fts_sources.JSON_EXTENSION)]
+
+        try:
+            return self.synthetic_data.get_response(api_path.split('/'), dict(urlparse.parse_qsl(parsed.query)))
+        except ValueError:  # e.g. a non-numeric appeal id
+            return None
+
+    def get_response_body(self, path):
+        """
+        The body for the request path (e.g. /api/v1/Appeal/country/KEN.json), or None if we have nothing for it
+        """
+        body = self.get_fixture_body(path)
+        if body is None:
+            body = self.get_synthetic_body(path)
+        return body
+
+
+def start_in_background(**kwargs):
+    """
+    Starts a StubServer (with the given arguments) on a daemon thread and returns it, call shutdown() when done
+    """
+    server = StubServer(**kwargs)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the FTS API')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--failure-rate', type=float, default=0.)
+    parser.add_argument('--throttle-rate', type=float, default=0.)
+    parser.add_argument('--latency', type=float, default=0., help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0., help='up to this many more seconds, at random')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--fixtures-dir', help='recorded responses, served in preference to synthetic ones')
+    parser.add_argument('--no-synthetic', action='store_true', help='only serve the recorded responses')
+    parser.add_argument('--scale', type=float, default=1.,
+                        help='multiplies the number of synthetic projects and contributions')
+    parser.add_argument('--countries', type=int, default=40, help='number of synthetic countries')
+    args = parser.parse_args()
+
+    synthetic = None
+    if not args.no_synthetic:
+        synthetic = fts_synthetic.SyntheticFtsData(seed=args.seed or 0, scale=args.scale,
+                                                   country_count=args.countries)
+        print 'Generated', len(synthetic.appeals), 'appeals,', len(synthetic.projects), 'projects and', \
+            len(synthetic.contributions), 'contributions'
+
+    stub_server = StubServer(port=args.port, failure_rate=args.failure_rate, throttle_rate=args.throttle_rate,
+                             latency=args.latency, jitter=args.jitter, seed=args.seed,
+                             fixtures_dir=args.fixtures_dir, synthetic_data=synthetic)
+    print 'Serving on', stub_server.base_url
+    stub_server.serve_forever()
@@ -0,0 +1,213 @@
+"""
+Incremental sync of the per-country FTS tables (emergencies, appeals, projects and contributions).
+A full build refetches the projects of every appeal and the contributions of every emergency, though almost all of
+them are old and no longer change. Instead, SyncStore keeps the tables from the previous run on disk, along with
+what was fetched for each appeal and emergency and when, and only refetches projects/contributions for:
+  - appeals/emergencies not seen before
+  - appeals from recent years, which are still being funded
+  - appeals whose requirements/funding/pledges totals have moved since the last fetch
+  - appeals with projects updated (last_updated_datetime) shortly before the last fetch, which may still be active
+  - emergencies with any such appeal
+  - anything not refetched for max_age_days, in case the above miss something
+The per-country lists of emergencies and appeals are cheap, so they are always refetched.
+The refetched rows then replace those for the same appeals/emergencies in the stored tables.
+"""
+
+import datetime
+import fts_categories
+import fts_queries
+import fts_sources
+import json
+import numpy as np
+import os
+import pandas as pd
+import tempfile
+
+DEFAULT_STATE_DIR = os.path.join(tempfile.gettempdir(), 'fts_sync')
+
+DEFAULT_RECENT_YEARS = 2  # this year and last
+DEFAULT_ACTIVE_DAYS = 30
+DEFAULT_MAX_AGE_DAYS = 30
+
+TABLE_EXTENSION = '.pickle'
+STATE_FILENAME = 'state.json'
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def format_timestamp(timestamp):
+    return timestamp.strftime(TIMESTAMP_FORMAT) if not pd.isnull(timestamp) else None
+
+
+def parse_timestamp(timestamp_string):
+    return datetime.datetime.strptime(timestamp_string, TIMESTAMP_FORMAT) if timestamp_string else None
+
+
+def get_appeal_fingerprint(appeal):
+    """
+    The appeal totals that change whenever its projects or funding do
+    """
+    return '%s/%s/%s/%s' % (appeal.get('original_requirements'), appeal.get('current_requirements'),
+                            appeal.get('funding'), appeal.get('pledges'))
+
+
+def merge_delta(stored, delta, key_column, refetched_keys, current_keys):
+    """
+    Replaces the rows of stored belonging to refetched_keys (values of key_column) with delta, dropping rows for
+    keys that no longer exist, and orders the result by the position of its key in current_keys (as a full
+    rebuild would)
+    """
+    current_keys = pd.Index(current_keys)
+
+    if not stored.empty:
+        keys = stored[key_column]
+        stored = stored[~keys.isin(list(refetched_keys)).values & keys.isin(list(current_keys)).values]
+
+    merged = fts_queries.concat_non_empty_dataframes([stored, delta])
+    if merged.empty:
+        return merged
+
+    keys = merged[key_column].values
+    if keys.dtype != current_keys.dtype:
+        keys = keys.astype(current_keys.dtype)  # e.g. appeal_id comes back as float
+
+    # stable, so rows for the same key stay in the order they came in
+    order = np.argsort(current_keys.get_indexer(keys), kind='mergesort')
+    return merged.take(order)
+
+
+class SyncStore(object):
+    TABLE_NAMES = ['emergencies', 'appeals', 'projects', 'contributions']
+
+    # the endpoint each table comes from, to decide whether to convert it to categoricals like fetched data
+    TABLE_ENDPOINTS = {'emergencies': 'Emergency', 'appeals': 'Appeal', 'projects': 'Project',
+                       'contributions': 'Contribution'}
+
+    def __init__(self, state_dir=DEFAULT_STATE_DIR, recent_years=DEFAULT_RECENT_YEARS,
+                 active_days=DEFAULT_ACTIVE_DAYS, max_age_days=DEFAULT_MAX_AGE_DAYS, now=None):
+        self.state_dir = state_dir
+        self.recent_years = recent_years
+        self.active_period = datetime.timedelta(days=active_days)
+        self.max_age = datetime.timedelta(days=max_age_days)
+        self.now = now or datetime.datetime.now()
+
+    def get_table_path(self, country, table_name):
+        return os.path.join(self.state_dir, country, table_name + TABLE_EXTENSION)
+
+    def get_state_path(self, country):
+        return os.path.join(self.state_dir, country, STATE_FILENAME)
+
+    def load_table(self, country, table_name):
+        path = self.get_table_path(country, table_name)
+        if not os.path.exists(path):
+            return pd.DataFrame()
+
+        table = pd.read_pickle(path)
+        if self.TABLE_ENDPOINTS[table_name] in fts_queries.CATEGORICAL_ENDPOINTS:
+            fts_categories.CATEGORIES.categorize(table)
+        return table
+
+    def save_table(self, country, table_name, table):
+        path = self.get_table_path(country, table_name)
+        fts_sources.make_parent_directory(path)
+        # write then rename, so an interrupted run leaves the previous table intact
+        fts_categories.decategorize(table).to_pickle(path + '.tmp')
+        os.rename(path + '.tmp', path)
+
+    def load_state(self, country):
+        path = self.get_state_path(country)
+        if not os.path.exists(path):
+            return {'appeals': {}, 'emergencies': {}}
+
+        with open(path) as state_file:
+            return json.load(state_file)
+
+    def save_state(self, country, state):
+        path = self.get_state_path(country)
+        fts_sources.make_parent_directory(path)
+        with open(path + '.tmp', 'w') as state_file:
+            json.dump(state, state_file, indent=1, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+    def is_recent(self, year):
+        return year > self.now.year - self.recent_years
+
+    def needs_refetch(self, entry, year, fingerprint=None):
+        """
+        Whether the data for an appeal/emergency with the given state entry should be refetched (see module docstring)
+        """
+        if entry is None or self.is_recent(year):
+            return True
+
+        if fingerprint is not None and entry.get('fingerprint') != fingerprint:
+            return True
+
+        fetched_at = parse_timestamp(entry['fetched_at'])
+        if self.now - fetched_at > self.max_age:
+            return True
+
+        last_updated = parse_timestamp(entry.get('last_updated'))
+        return last_updated is not None and fetched_at - last_updated < self.active_period
+
+    def sync_country(self, country):
+        """
+        Brings the stored tables for country up to date and returns them as a dict keyed by table name
+        """
+        emergencies = fts_queries.fetch_emergencies_json_for_country_as_dataframe(country)
+        appeals = fts_queries.fetch_appeals_json_for_country_as_dataframe(country)
+
+        state = self.load_state(country)
+        fetched_at = format_timestamp(self.now)
+
+        stale_appeal_ids = [appeal_id for appeal_id, appeal in appeals.iterrows()
+                            if self.needs_refetch(state['appeals'].get(str(appeal_id)), appeal['year'],
+                                                  get_appeal_fingerprint(appeal))]
+        # an emergency's contributions change along with the funding of its appeals
+        changing_emergency_ids = set(appeals.emergency_id.loc[stale_appeal_ids]) if stale_appeal_ids else set()
+        stale_emergency_ids = [emergency_id for emergency_id, emergency in emergencies.iterrows()
+                               if emergency_id in changing_emergency_ids or
+                               self.needs_refetch(state['emergencies'].get(str(emergency_id)), emergency['year'])]
+
+        new_projects = fts_queries.fetch_projects_json_for_appeals_as_dataframe(stale_appeal_ids)
+        new_contributions = fts_queries.fetch_contributions_json_for_emergencies_as_dataframe(stale_emergency_ids)
+
+        tables = {
+            'emergencies': emergencies,
+            'appeals': appeals,
+            'projects': merge_delta(self.load_table(country, 'projects'), new_projects, 'appeal_id',
+                                    stale_appeal_ids, appeals.index),
+            'contributions': merge_delta(self.load_table(country, 'contributions'), new_contributions,
+                                         'emergency_id', stale_emergency_ids, emergencies.index),
+        }
+
+        last_updated_by_appeal = {}
+        if not new_projects.empty:
+            last_updated_by_appeal = new_projects.groupby('appeal_id').last_updated_datetime.max().to_dict()
+
+        stale_appeal_id_set = set(stale_appeal_ids)
+        stale_emergency_id_set = set(stale_emergency_ids)
+
+        new_state = {'appeals': {}, 'emergencies': {}}
+        for appeal_id, appeal in appeals.iterrows():
+            if appeal_id in stale_appeal_id_set:
+                new_state['appeals'][str(appeal_id)] = {
+                    'fetched_at': fetched_at,
+                    'fingerprint': get_appeal_fingerprint(appeal),
+                    'last_updated': format_timestamp(last_updated_by_appeal.get(appeal_id)),
+                }
+            else:
+                new_state['appeals'][str(appeal_id)] = state['appeals'][str(appeal_id)]
+        for emergency_id in emergencies.index:
+            if emergency_id in stale_emergency_id_set:
+                new_state['emergencies'][str(emergency_id)] = {'fetched_at': fetched_at}
+            else:
+                new_state['emergencies'][str(emergency_id)] = state['emergencies'][str(emergency_id)]
+
+        # tables first, so if we're interrupted the state never claims more than the tables hold
+        for table_name in self.TABLE_NAMES:
+            self.save_table(country, table_name, tables[table_name])
+        self.save_state(country, new_state)
+
+        print 'Synced %s: refetched %d of %d appeals and %d of %d emergencies' % \
+            (country, len(stale_appeal_ids), len(appeals), len(stale_emergency_ids), len(emergencies))
+
+        return tables
@@ -0,0 +1,277 @@
+"""
+Generates a synthetic, but internally consistent, FTS dataset and answers API queries against it, for the stub
+server (see fts_stub_server). Ids line up across endpoints (appeals point at emergencies, contributions at
+projects, recipients are organizations, etc), and funding totals are summed from the contributions, so full
+country builds behave much as they would against the real thing.
+Everything is derived from the seed, so the same seed always gives the same data.
+"""
+
+import collections
+import json
+import random
+import string
+
+CLUSTERS = [
+    'AGRICULTURE',
+    'COORDINATION AND SUPPORT SERVICES',
+    'ECONOMIC RECOVERY AND INFRASTRUCTURE',
+    'EDUCATION',
+    'FOOD',
+    'HEALTH',
+    'MINE ACTION',
+    'MULTI-SECTOR',
+    'PROTECTION/HUMAN RIGHTS/RULE OF LAW',
+    'SAFETY AND SECURITY OF STAFF AND OPERATIONS',
+    'SHELTER AND NON-FOOD ITEMS',
+    'WATER AND SANITATION',
+]
+
+SECTORS = ['Agriculture', 'Coordination', 'Education', 'Food', 'Health', 'Protection', 'Shelter', 'Water']
+
+ORGANIZATION_TYPES = ['NGOs', 'Private Orgs. & Foundations', 'UN Agencies', 'Red Cross / Red Crescent',
+                      'Governments', 'Other']
+
+POOLED_FUNDS = ['Central Emergency Response Fund', 'Emergency Response Fund (OCHA)', 'Common Humanitarian Fund']
+
+APPEAL_TYPES = ['CAP', 'CAP', 'Flash', 'Other']
+STATUSES = ['Paid Contribution', 'Paid Contribution', 'Commitment', 'Pledge']
+
+# a few real countries, so the usual examples (Chad, KEN, ...) work, the rest are made up
+REAL_COUNTRIES = [('Chad', 'TCD'), ('Colombia', 'COL'), ('Kenya', 'KEN'), ('Yemen', 'YEM'), ('Afghanistan', 'AFG'),
+                  ('South Sudan', 'SSD'), ('Somalia', 'SOM'), ('Ethiopia', 'ETH')]
+
+FIRST_APPEAL_ID = 900
+
+
+def build_made_up_iso_code(index):
+    letters = string.ascii_uppercase
+    return 'Z' + letters[(index // 26) % 26] + letters[index % 26]
+
+
+class SyntheticFtsData(object):
+    """
+    scale multiplies the number of projects and contributions, and so roughly the size of the larger responses
+    """
+    def __init__(self, seed=0, scale=1., country_count=40, year_start=1999, year_end=2015):
+        rng = random.Random(seed)
+
+        self.countries = []
+        for index in range(country_count):
+            if index < len(REAL_COUNTRIES):
+                name, iso_code = REAL_COUNTRIES[index]
+            else:
+                name, iso_code = 'Country ' + str(index + 1), build_made_up_iso_code(index)
+            self.countries.append({'id': index + 1, 'name': name, 'iso_code_A': iso_code})
+
+        self.sectors = [{'id': index + 1, 'name': name} for index, name in enumerate(SECTORS)]
+
+        self.organizations = []
+        for index in range(int(60 * scale) + 1):
+            self.organizations.append({'id': index + 1, 'name': 'Organization ' + str(index + 1),
+                                       'abbreviation': 'ORG' + str(index + 1), 'type': rng.choice(ORGANIZATION_TYPES)})
+        for name in POOLED_FUNDS:
+            self.organizations.append({'id': len(self.organizations) + 1, 'name': name, 'abbreviation': '',
+                                       'type': 'UN Agencies'})
+
+        donors = ['Donor Government ' + str(index + 1) for index in range(30)] + POOLED_FUNDS
+
+        self.emergencies = []
+        self.appeals = []
+        self.projects = []
+        self.contributions = []
+
+        for country in self.countries:
+            for year in range(year_start, year_end + 1):
+                if rng.random() < 0.5:
+                    continue
+
+                emergency = {'id': 10000 + len(self.emergencies), 'title': '%s emergency %d' % (country['name'], year),
+                             'country': country['name'], 'year': year, 'glide': ''}
+                self.emergencies.append(emergency)
+
+                appeal = None
+                appeal_projects = []
+                if rng.random() < 0.6:
+                    appeal = {'id': FIRST_APPEAL_ID + len(self.appeals),
+                              'title': '%s appeal %d' % (country['name'], year),
+                              'country': country['name'], 'year': year, 'type': rng.choice(APPEAL_TYPES),
+                              'emergency_id': emergency['id'], 'start_date': '%d-01-01' % year,
+                              'end_date': '%d-12-31' % year,
+                              'launch_date': '%d-11-%02d' % (year - 1, rng.randint(1, 30)),
+                              'original_requirements': 0., 'current_requirements': 0., 'funding': 0., 'pledges': 0.}
+                    self.appeals.append(appeal)
+
+                    for index in range(int(rng.randint(5, 30) * scale)):
+                        organization = rng.choice(self.organizations)
+                        original_requirements = float(rng.randint(1, 500) * 10000)
+                        project = {'id': 50000 + len(self.projects),
+                                   'code': '%s-%02d/%s/%d' % (country['iso_code_A'], year % 100,
+                                                              string.ascii_uppercase[index % 26], len(self.projects)),
+                                   'appeal_id': appeal['id'], 'cluster': rng.choice(CLUSTERS),
+                                   'organisation': organization['name'],
+                                   'organisation_abbreviation': organization['abbreviation'],
+                                   'original_requirements': original_requirements,
+                                   'current_requirements': original_requirements * rng.choice([0.8, 1., 1., 1.2]),
+                                   'funding': 0., 'pledges': 0., 'title': 'Project ' + str(len(self.projects)),
+                                   'end_date': '%d-12-31' % year,
+                                   'last_updated_datetime': '%d-%02d-%02d %02d:%02d:00' % (
+                                       year, rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23),
+                                       rng.randint(0, 59))}
+                        appeal_projects.append(project)
+                        self.projects.append(project)
+                        appeal['original_requirements'] += project['original_requirements']
+                        appeal['current_requirements'] += project['current_requirements']
+
+                for index in range(int(rng.randint(5, 40) * scale)):
+                    donor = rng.choice(donors)
+                    project = rng.choice(appeal_projects) if appeal_projects and rng.random() < 0.8 else None
+                    contribution = {
+                        'id': 200000 + len(self.contributions),
+                        'emergency_id': emergency['id'],
+                        'appeal_id': appeal['id'] if appeal else None,
+                        'project_code': project['code'] if project else None,
+                        'donor': donor,
+                        'recipient': project['organisation'] if project else rng.choice(self.organizations)['name'],
+                        'status': rng.choice(STATUSES),
+                        'amount': float(rng.randint(1, 200) * 5000),
+                        'decision_date': '%d-%02d-%02d' % (year, rng.randint(1, 12), rng.randint(1, 28)),
+                        'year': year,
+                        'is_allocation': 1 if donor in POOLED_FUNDS else 0,
+                    }
+                    self.contributions.append(contribution)
+
+                    field = 'pledges' if contribution['status'] == 'Pledge' else 'funding'
+                    if project:
+                        project[field] += contribution['amount']
+                    if appeal:
+                        appeal[field] += contribution['amount']
+
+        self.emergencies_by_id = dict((emergency['id'], emergency) for emergency in self.emergencies)
+        self.appeals_by_id = dict((appeal['id'], appeal) for appeal in self.appeals)
+        self.projects_by_code = dict((project['code'], project) for project in self.projects)
+        self.country_names = dict((country['iso_code_A'], country['name']) for country in self.countries)
+
+        self.projects_by_appeal = self.group_by(self.projects, 'appeal_id')
+        self.contributions_by_appeal = self.group_by(self.contributions, 'appeal_id')
+        self.contributions_by_emergency = self.group_by(self.contributions, 'emergency_id')
+
+    @staticmethod
+    def group_by(records, field):
+        grouped = collections.defaultdict(list)
+        for record in records:
+            grouped[record[field]].append(record)
+        return grouped
+
+    def get_country_name(self, country):
+        """
+        The per-country endpoints accept both names and ISO codes
+        """
+        return self.country_names.get(country, country)
+
+    def get_response(self, path_parts, params):
+        """
+        Returns the JSON response for the API path (split on '/', without the .json) and query parameters,
+        or None if the path isn't one we know about
+        """
+        entity_type, arguments = path_parts[0], path_parts[1:]
+
+        if entity_type in ('funding', 'pledges'):
+            records = self.get_grouping(entity_type, params)
+        elif not arguments:
+            records = {'Sector': self.sectors, 'Country': self.countries,
+                       'Organization': self.organizations}.get(entity_type)
+        elif len(arguments) == 2:
+            records = self.get_related_records(entity_type, arguments[0], arguments[1])
+        else:
+            records = None
+
+        if records is None:
+            return None
+
+        return json.dumps(records)
+
+    def get_related_records(self, entity_type, related_type, related_value):
+        if related_type == 'country':
+            country_name = self.get_country_name(related_value)
+            if entity_type == 'Emergency':
+                return [emergency for emergency in self.emergencies if emergency['country'] == country_name]
+            if entity_type == 'Appeal':
+                return [appeal for appeal in self.appeals if appeal['country'] == country_name]
+        elif related_type == 'year':
+            if entity_type == 'Emergency':
+                return [emergency for emergency in self.emergencies if str(emergency['year']) == related_value]
+            if entity_type == 'Appeal':
+                return [appeal for appeal in self.appeals if str(appeal['year']) == related_value]
+        elif related_type == 'appeal':
+            appeal_id = int(related_value)
+            if entity_type == 'Project':
+                return self.projects_by_appeal.get(appeal_id, [])
+            if entity_type == 'Contribution':
+                return self.contributions_by_appeal.get(appeal_id, [])
+            if entity_type == 'Cluster':
+                return self.get_clusters(appeal_id)
+        elif related_type == 'emergency' and entity_type == 'Contribution':
+            return self.contributions_by_emergency.get(int(related_value), [])
+
+        return None
+
+    def get_clusters(self, appeal_id):
+        clusters = collections.OrderedDict()
+        for project in self.projects_by_appeal.get(appeal_id, []):
+            cluster = clusters.setdefault(project['cluster'], {'name': project['cluster'],
+                                                                'original_requirement': 0., 'current_requirement': 0.,
+                                                                'funding': 0., 'pledges': 0.})
+            cluster['original_requirement'] += project['original_requirements']
+            cluster['current_requirement'] += project['current_requirements']
+            cluster['funding'] += project['funding']
+            cluster['pledges'] += project['pledges']
+        return clusters.values()
+
+    def get_contribution_field(self, contribution, field):
+        """
+        The value of a contribution for a query or GroupBy parameter (lowercased)
+        """
+        emergency = self.emergencies_by_id[contribution['emergency_id']]
+        appeal = self.appeals_by_id.get(contribution['appeal_id'])
+        project = self.projects_by_code.get(contribution['project_code'])
+
+        if field in ('donor', 'recipient', 'year'):
+            return contribution[field]
+        elif field == 'emergency':
+            return emergency['title']
+        elif field == 'appeal':
+            return appeal['title'] if appeal else None
+        elif field == 'country':
+            return emergency['country']
+        elif field in ('cluster', 'sector'):
+            return project['cluster'] if project else None
+        return None
+
+    def matches_query(self, contribution, field, value):
+        if field == 'emergency':
+            return str(contribution['emergency_id']) == value
+        elif field == 'appeal':
+            return str(contribution['appeal_id']) == value
+        elif field == 'country':
+            return self.get_contribution_field(contribution, 'country') == self.get_country_name(value)
+        return unicode(self.get_contribution_field(contribution, field)) == value
+
+    def get_grouping(self, middle_part, params):
+        params = dict((key.lower(), value) for key, value in params.iteritems())
+        grouping = params.pop('groupby', '').lower()
+
+        amounts = collections.defaultdict(float)
+        for contribution in self.contributions:
+            if (contribution['status'] == 'Pledge') != (middle_part == 'pledges'):
+                continue
+            if not all(self.matches_query(contribution, field, value) for field, value in params.iteritems()):
+                continue
+
+            group = self.get_contribution_field(contribution, grouping) if grouping else 'Total'
+            if group is not None:
+                amounts[group] += contribution['amount']
+
+        grouped = [{'type': group, 'amount': amount} for group, amount in amounts.iteritems()]
+        grouped.sort(key=lambda group: -group['amount'])
+
+        return {'grouping': grouped, 'total': sum(amounts.itervalues())}
@@ -2,11 +2,18 @@
 Builds CHD indicators from FTS queries
 """
 
+import fts_aggregation
+import fts_bulk
+import fts_coalescing
+import fts_indicators
+import fts_metrics
+import fts_organizations
 import fts_queries
 import os
 import datetime
 import pandas as pd
-import numpy as np
+import sys
+import threading
 
 # note relying on strings is fragile - could break if things get renamed in FTS
 # we don't seem to have much in the way of alternatives, other than changing the FTS API
@@ -15,52 +22,113 @@ DONOR_CERF = "Central Emergency Response Fund"
 DONOR_CHF = "Common Humanitarian Fund"
 POOLED_FUNDS = [DONOR_CERF, DONOR_ERF, DONOR_CHF]
 
+# pooled fund -> indicators for its amount, its fraction of the fund's global allocations and its fraction of the
+# country's funding
+POOLED_FUND_INDICATORS = [
+    (DONOR_CERF, 'FY240', 'FY360', 'FY370'),
+    (DONOR_ERF, 'FY380', 'FY500', 'FY510'),
+    (DONOR_CHF, 'FY520', 'FY540', 'FY550'),
+]
+
 YEAR_START = 1999  # first year that FTS has data
 YEAR_END = datetime.date.today().year + 1  # next year can start to show up near current year-end
 
 
-class PooledFundCacheByYear(object):
+class YearCache(object):
     """
-    Caches global pooled fund amounts by year
+    Caches a value per year, shared by all threads. A year being loaded by one thread is waited on by any others
+    asking for it, rather than loaded again.
     """
     def __init__(self):
         self.year_cache = {}
-
+        self.lock = threading.Lock()
+        self.in_flight = {}  # year -> fts_coalescing.PendingRequest
+
+    def get_for_year(self, year, load_function):
+        """
+        The cached value for year, calling load_function(year) if nobody has yet
+        """
+        with self.lock:
+            if year in self.year_cache:
+                return self.year_cache[year]
+
+            pending = self.in_flight.get(year)
+            is_leader = pending is None
+            if is_leader:
+                pending = fts_coalescing.PendingRequest()
+                self.in_flight[year] = pending
+
+        if not is_leader:
+            pending.done.wait()
+            if pending.exc_info:
+                raise pending.exc_info[0], pending.exc_info[1], pending.exc_info[2]
+            return pending.result
+
+        try:
+            result = load_function(year)
+        except:
+            # let the waiters fail too, a later call can try again
+            pending.exc_info = sys.exc_info()
+            with self.lock:
+                del self.in_flight[year]
+            pending.done.set()
+            raise
+
+        with self.lock:
+            self.year_cache[year] = result
+            del self.in_flight[year]
+
+        pending.result = result
+        pending.done.set()
+        return result
+
+
+class PooledFundCacheByYear(YearCache):
+    """
+    Caches global pooled fund amounts by year
+    """
     # TODO investigate why this doesn't match FTS reports exactly for all values
     # - email sent to Sean Foo about it 2014-04-21
     def get_pooled_global_allocation_for_year(self, year):
-        if year not in self.year_cache:
-            global_funding_by_donor =\
-                fts_queries.fetch_grouping_type_json_for_year_as_dataframe('funding', year, 'donor', 'organization')
+        return self.get_for_year(year, self.load_pooled_global_allocation)
 
-            pooled_funds_amounts = global_funding_by_donor.funding.loc[POOLED_FUNDS]
+    def load_pooled_global_allocation(self, year):
+        global_funding_by_donor =\
+            fts_queries.fetch_grouping_type_json_for_year_as_dataframe('funding', year, 'donor', 'organization')
 
-            self.year_cache[year] = pooled_funds_amounts
+        return global_funding_by_donor.funding.loc[POOLED_FUNDS]
 
-        return self.year_cache[year]
+    def get_pooled_global_allocations(self, years):
+        """
+        DataFrame of the global allocations of each pooled fund (columns) in each of years (rows)
+        """
+        return pd.DataFrame([self.get_pooled_global_allocation_for_year(year) for year in years],
+                            index=years, columns=POOLED_FUNDS)
 
 
-class CountryFundingCacheByYear(object):
+class CountryFundingCacheByYear(YearCache):
     """
     Caches total funding amounts for each country by year
     """
     def __init__(self):
-        self.year_cache = {}
+        super(CountryFundingCacheByYear, self).__init__()
+        self.funding_table = None
+        self.funding_table_lock = threading.Lock()
 
         self.country_iso_code_to_name = {}
         countries = fts_queries.fetch_countries_json_as_dataframe()
         for country_id, row in countries.iterrows():
             self.country_iso_code_to_name[row['iso_code_A']] = row['name']
 
-    def get_total_country_funding_for_year(self, country_code, year):
-        if year not in self.year_cache:
-            funding_by_country =\
-                fts_queries.fetch_grouping_type_json_for_year_as_dataframe('funding', year, 'country', 'country')
+    def get_funding_by_country_for_year(self, year):
+        return self.get_for_year(year, self.load_funding_by_country)
 
-            self.year_cache[year] = funding_by_country
+    def load_funding_by_country(self, year):
+        return fts_queries.fetch_grouping_type_json_for_year_as_dataframe('funding', year, 'country', 'country')
 
+    def get_total_country_funding_for_year(self, country_code, year):
         # possibly no funding at all in that year
-        funding_series = self.year_cache[year]
+        funding_series = self.get_funding_by_country_for_year(year)
         if funding_series.empty:
             return 0
 
@@ -71,6 +139,34 @@ class CountryFundingCacheByYear(object):
         else:
             return 0
 
+    def get_funding_table(self, years):
+        """
+        DataFrame of total funding by year (rows) and country name (columns), 0 where there was none.
+        Built once for all countries, as every region needs the same years.
+        """
+        # regions populated at the same moment wait for the first one to build it
+        with self.funding_table_lock:
+            if self.funding_table is None or not self.funding_table.index.equals(years):
+                funding_by_year = []
+                for year in years:
+                    funding_series = self.get_funding_by_country_for_year(year)
+                    funding_by_year.append(pd.Series() if funding_series.empty else funding_series.funding)
+                self.funding_table = pd.DataFrame(funding_by_year, index=years).fillna(0.)
+
+            return self.funding_table
+
+    def get_total_country_funding(self, country_code, years):
+        """
+        Series of the total funding for the country in each of years
+        """
+        funding_table = self.get_funding_table(years)
+        country_name = self.country_iso_code_to_name[country_code]
+
+        if country_name in funding_table.columns:
+            return funding_table[country_name].astype(float)
+        else:
+            return pd.Series(0., index=years)
+
 
 POOLED_FUND_CACHE = PooledFundCacheByYear()
 COUNTRY_FUNDING_CACHE = CountryFundingCacheByYear()
@@ -81,43 +177,47 @@ ORG_TYPE_NGOS = 'NGOs'
 ORG_TYPE_PRIVATE_ORGS = 'Private Orgs. & Foundations'
 ORG_TYPE_UN_AGENCIES = 'UN Agencies'
 
-# holds IndicatorValue objects until we are ready to put them in a dataframe
-VALUES = []
+
+def create_value_store():
+    """
+    Holds the values of one build until we are ready to put them in a dataframe
+    """
+    # perhaps the wrong place to add this, but filter out distant future data
+    return fts_indicators.IndicatorStore(max_year=YEAR_END)
 
 
-class IndicatorValue(object):
-    def __init__(self, indicator, region, year, value):
-        self.indicator = indicator
-        self.region = region
-        self.year = year
-        self.value = value
+def add_row_to_values(values, indicator, region, year, value):
+    values.append(indicator, region, year, value)
 
 
-def add_row_to_values(indicator, region, year, value):
-    # perhaps the wrong place to add this, but filter out distant future data
-    if year > YEAR_END:
-        return
+def add_table_to_values(values, region, table):
+    """
+    Adds a table of values for region, indexed by year with a column per indicator
+    """
+    values.append_table(region, table)
 
-    if np.isinf(value):
-        return
 
-    VALUES.append(IndicatorValue(indicator, region, year, value))
+def get_years():
+    return pd.Index(range(YEAR_START, YEAR_END + 1), name='year')
 
 
-def get_values_as_dataframe():
-    indicators = [ind_value.indicator for ind_value in VALUES]
-    regions = [ind_value.region for ind_value in VALUES]
-    years = [ind_value.year for ind_value in VALUES]
-    values = [ind_value.value for ind_value in VALUES]
+def reindex_by_year(dataframe, columns):
+    """
+    dataframe (indexed by year) with the given columns, and a row for every year from YEAR_START to YEAR_END,
+    filling in zeros where there was nothing
+    """
+    return dataframe.reindex(index=get_years(), columns=columns).fillna(0.).astype(float)
 
-    return pd.DataFrame(
-        {'indicator': indicators, 'region': regions, 'year': years, 'value': values},
-        columns=['indicator', 'region', 'year', 'value']
-    )
 
+def divide_or_zero(numerator, denominator):
+    """
+    Element-wise numerator / denominator, with 0 wherever the denominator isn't positive
+    """
+    return (numerator / denominator.where(denominator > 0)).fillna(0.)
 
-def write_values_as_scraperwiki_style_csv(base_dir):
-    values = get_values_as_dataframe()
+
+def write_values_as_scraperwiki_style_csv(value_store, base_dir):
+    values = value_store.to_dataframe()
     values['dsID'] = 'fts'
     values['is_number'] = 1
     values['source'] = ''
@@ -129,127 +229,100 @@ def write_values_as_scraperwiki_style_csv(base_dir):
     print 'Wrote', filename
 
 
-def get_values_joined_with_indicators():
+def get_values_joined_with_indicators(value_store):
     """
     Useful for debugging
     """
-    values = get_values_as_dataframe()
+    values = value_store.to_dataframe(categorical=False)
     indicators = pd.read_csv('indicator.csv', index_col='indID')
     return pd.merge(left=values, right=indicators, left_on='indicator', right_index=True)
 
 
-def populate_appeals_level_data(country):
+def populate_appeals_level_data(values, country, country_data=fts_bulk.LIVE_COUNTRY_DATA):
     """
     Populate data based on the "appeals" concept in FTS.
     If funding data is not associated with an appeal, it will be excluded.
     If there was no appeal, fill in zeros for all items.
     This unfortunately conflates "zero" vs "missing" data.
     """
-    appeals = fts_queries.fetch_appeals_json_for_country_as_dataframe(country)
+    appeals = country_data.get_appeals(country)
 
     if not appeals.empty:
         # group all appeals by year, columns are now just the numerical ones:
         #  - current_requirements, emergency_id, funding, original_requirements, pledges
-        cross_appeals_by_year = appeals.groupby('year').sum().astype(float)
+        cross_appeals_by_year = appeals.groupby('year').sum()
         # Consolidated Appeals Process (CAP)-only
-        cap_appeals_by_year = appeals[appeals.type == 'CAP'].groupby('year').sum().astype(float)
+        cap_appeals_by_year = appeals[appeals.type == 'CAP'].groupby('year').sum()
     else:
-        # just re-use the empty frames
+        # just re-use the empty frames, reindexing fills them with zeros
         cross_appeals_by_year = appeals
         cap_appeals_by_year = appeals
 
-    for year in range(YEAR_START, YEAR_END + 1):
-        original_requirements = 0.
-        current_requirements = 0.
-        funding = 0.
-
-        if year in cross_appeals_by_year.index:
-            original_requirements = cross_appeals_by_year['original_requirements'][year]
-            current_requirements = cross_appeals_by_year['current_requirements'][year]
-            funding = cross_appeals_by_year['funding'][year]
-
-        add_row_to_values('FY010', country, year, original_requirements)
-        add_row_to_values('FY020', country, year, current_requirements)
-        add_row_to_values('FY040', country, year, funding)
-
-        cap_requirements = 0.
-        cap_funding = 0.
-
-        if year in cap_appeals_by_year.index:
-            cap_requirements = cap_appeals_by_year['current_requirements'][year]
-            cap_funding = cap_appeals_by_year['funding'][year]
-
-        add_row_to_values('FA010', country, year, cap_requirements)
-        add_row_to_values('FA140', country, year, cap_funding)
+    cross_appeals_by_year = reindex_by_year(cross_appeals_by_year,
+                                            ['original_requirements', 'current_requirements', 'funding'])
+    cap_appeals_by_year = reindex_by_year(cap_appeals_by_year, ['current_requirements', 'funding'])
 
+    table = pd.DataFrame(index=get_years())
+    table['FY010'] = cross_appeals_by_year['original_requirements']
+    table['FY020'] = cross_appeals_by_year['current_requirements']
+    table['FY040'] = cross_appeals_by_year['funding']
+    table['FA010'] = cap_appeals_by_year['current_requirements']
+    table['FA140'] = cap_appeals_by_year['funding']
 
-def get_organizations_indexed_by_name():
-    """
-    Load organizations from FTS and change index to be name, as sadly that's what is used in
-    other API calls, so we need to join on it.
-    This is a slow call, so it makes sense to cache it.
-    """
-    organizations = fts_queries.fetch_organizations_json_as_dataframe()
-    return organizations.set_index('name')
+    add_table_to_values(values, country, table)
 
 
-def populate_organization_level_data(country, organizations=None):
+def populate_organization_level_data(values, country, organization_lookup=None,
+                                     country_data=fts_bulk.LIVE_COUNTRY_DATA):
     """
-    Populate data on funding by organization type
+    Populate data on funding by organization type.
+    Sadly funding only refers to recipients by name, so types are found through a lookup by name (see
+    fts_organizations); unmatched recipients are left out.
     """
-    if organizations is None:
-        organizations = get_organizations_indexed_by_name()
+    if organization_lookup is None:
+        organization_lookup = fts_organizations.get_organization_lookup()
 
     # load appeals, analyze each one
-    appeals = fts_queries.fetch_appeals_json_for_country_as_dataframe(country)
-
-    funding_dataframes_by_appeal = []
+    appeals = country_data.get_appeals(country)
 
-    for appeal_id, appeal_row in appeals.iterrows():
-        # first check if there is any funding at all (otherwise API calls will get upset)
-        if appeal_row['funding'] == 0:
-            continue
-
-        # query funding by recipient, including "carry over" from previous years
-        funding_by_recipient = fts_queries.fetch_funding_json_for_appeal_as_dataframe(
-            appeal_id, grouping='Recipient', alias='organisation')
+    # first check if there is any funding at all (otherwise API calls will get upset)
+    funded_appeal_years = [(appeal_id, appeal_row['year']) for appeal_id, appeal_row in appeals.iterrows()
+                           if appeal_row['funding'] != 0]
 
-        funding_by_recipient['year'] = appeal_row['year']
+    # query funding by recipient, including "carry over" from previous years
+    fetch_funding_by_recipient = lambda appeal_id: fts_queries.fetch_funding_json_for_appeal_as_dataframe(
+        appeal_id, grouping='Recipient', alias='organisation')
+    funding_dataframes_by_appeal = fts_queries.fetch_many(
+        fetch_funding_by_recipient, [appeal_id for appeal_id, year in funded_appeal_years])
 
-        funding_dataframes_by_appeal.append(funding_by_recipient)
+    for funding_by_recipient, (appeal_id, year) in zip(funding_dataframes_by_appeal, funded_appeal_years):
+        funding_by_recipient['year'] = year
 
     if funding_dataframes_by_appeal:
-        funding_by_recipient_overall = pd.concat(funding_dataframes_by_appeal)
+        funding_by_recipient_overall = fts_queries.concat_non_empty_dataframes(funding_dataframes_by_appeal)
+        funding_by_recipient_overall['type'] = organization_lookup.map_types(funding_by_recipient_overall.index)
         # now roll up by organization type
-        funding_by_type = funding_by_recipient_overall.join(organizations.type).groupby(['type', 'year']).funding.sum()
+        funding_by_type = funding_by_recipient_overall.groupby(['type', 'year']).funding.sum().unstack('type')
     else:
-        funding_by_type = pd.Series()  # just an empty Series
+        funding_by_type = pd.DataFrame()  # just an empty frame
 
-    for year in range(YEAR_START, YEAR_END + 1):
-        ngo_funding = 0.
-        private_org_funding = 0.
-        un_agency_funding = 0.
+    funding_by_type = reindex_by_year(funding_by_type,
+                                      [ORG_TYPE_NGOS, ORG_TYPE_PRIVATE_ORGS, ORG_TYPE_UN_AGENCIES])
 
-        if (ORG_TYPE_NGOS, year) in funding_by_type:
-            ngo_funding = funding_by_type[(ORG_TYPE_NGOS, year)]
-        if (ORG_TYPE_PRIVATE_ORGS, year) in funding_by_type:
-            private_org_funding = funding_by_type[(ORG_TYPE_PRIVATE_ORGS, year)]
-        if (ORG_TYPE_UN_AGENCIES, year) in funding_by_type.index:
-            un_agency_funding = funding_by_type[(ORG_TYPE_UN_AGENCIES, year)]
+    table = pd.DataFrame(index=get_years())
+    table['FY190'] = funding_by_type[ORG_TYPE_NGOS]
+    table['FY200'] = funding_by_type[ORG_TYPE_PRIVATE_ORGS]
+    table['FY210'] = funding_by_type[ORG_TYPE_UN_AGENCIES]
 
-        add_row_to_values('FY190', country, year, ngo_funding)
-        add_row_to_values('FY200', country, year, private_org_funding)
-        add_row_to_values('FY210', country, year, un_agency_funding)
+    add_table_to_values(values, country, table)
 
 
-def populate_pooled_fund_data(country):
-    emergencies = fts_queries.fetch_emergencies_json_for_country_as_dataframe(country)
+def populate_pooled_fund_data(values, country, country_data=fts_bulk.LIVE_COUNTRY_DATA):
+    emergencies = country_data.get_emergencies(country)
 
     contribution_dataframes_by_emergency = []
 
-    for emergency_id, emergency_row in emergencies.iterrows():
-        contributions = fts_queries.fetch_contributions_json_for_emergency_as_dataframe(emergency_id)
-
+    for contributions in country_data.get_contributions_by_emergency(emergencies.index):
         if contributions.empty:
             continue
 
@@ -260,8 +333,7 @@ def populate_pooled_fund_data(country):
         contributions = contributions[contributions.status != FUNDING_STATUS_PLEDGE]
 
         # exclude non-CERF/ERF/CHF
-        donor_filter = lambda x: x in POOLED_FUNDS
-        contributions = contributions[contributions.donor.apply(donor_filter)]
+        contributions = contributions[contributions.donor.isin(POOLED_FUNDS)]
 
         if contributions.empty:
             continue  # if not excluded, can mess up concat
@@ -269,76 +341,116 @@ def populate_pooled_fund_data(country):
         contribution_dataframes_by_emergency.append(contributions)
 
     if contribution_dataframes_by_emergency:
-        contributions_overall = pd.concat(contribution_dataframes_by_emergency)
-        # sum amount by donor-year
-        amount_by_donor_year = contributions_overall.groupby(['donor', 'year']).amount.sum()
+        contributions_overall = fts_queries.concat_non_empty_dataframes(contribution_dataframes_by_emergency)
+        # sum amount by donor-year (grouping on a categorical can give empty groups, as NaN)
+        amount_by_donor_year = contributions_overall.groupby(['donor', 'year']).amount.sum().dropna()
+        amount_by_year = amount_by_donor_year.unstack('donor')
     else:
-        amount_by_donor_year = pd.Series()  # empty Series
+        amount_by_year = pd.DataFrame()  # empty frame
 
-    for year in range(YEAR_START, YEAR_END + 1):
-        # note that 'global_allocations' is close to FTS report numbers but not always exactly the same
-        # - email sent to Sean Foo about this 2014-04-21
-        # so FY360, FY500, FY540 are perhaps slightly off
-        global_allocations = POOLED_FUND_CACHE.get_pooled_global_allocation_for_year(year)
-        cerf_global_allocations = global_allocations[DONOR_CERF]
-        erf_global_allocations = global_allocations[DONOR_ERF]
-        chf_global_allocations = global_allocations[DONOR_CHF]
+    years = get_years()
+    amount_by_year = reindex_by_year(amount_by_year, POOLED_FUNDS)
 
-        country_funding = COUNTRY_FUNDING_CACHE.get_total_country_funding_for_year(country, year)
+    # note that 'global_allocations' is close to FTS report numbers but not always exactly the same
+    # - email sent to Sean Foo about this 2014-04-21
+    # so FY360, FY500, FY540 are perhaps slightly off
+    global_allocations = POOLED_FUND_CACHE.get_pooled_global_allocations(years)
 
-        cerf_amount = 0.
-        erf_amount = 0.
-        chf_amount = 0.
+    country_funding = COUNTRY_FUNDING_CACHE.get_total_country_funding(country, years)
 
-        if (DONOR_CERF, year) in amount_by_donor_year:
-            cerf_amount = amount_by_donor_year[(DONOR_CERF, year)]
-        if (DONOR_ERF, year) in amount_by_donor_year:
-            erf_amount = amount_by_donor_year[(DONOR_ERF, year)]
-        if (DONOR_CHF, year) in amount_by_donor_year:
-            chf_amount = amount_by_donor_year[(DONOR_CHF, year)]
+    # note the divisions can have divide by 0, "0" is used as fraction instead
+    # would maybe make more sense to use nan, but that will just show up as "empty" in exported CSV
+    # probably a better option would be to just create indicator for country funding and global allocation,
+    # but global allocation is problematic as it's not "per-region"
+    table = pd.DataFrame(index=years)
+    for fund, amount_indicator, global_fraction_indicator, country_fraction_indicator in POOLED_FUND_INDICATORS:
+        amount = amount_by_year[fund]
+        table[amount_indicator] = amount
+        table[global_fraction_indicator] = divide_or_zero(amount, global_allocations[fund])
+        table[country_fraction_indicator] = divide_or_zero(amount, country_funding)
 
-        # note the divisions can have divide by 0, "0" is used as fraction instead
-        # would maybe make more sense to use nan, but that will just show up as "empty" in exported CSV
-        # probably a better option would be to just create indicator for country funding and global allocation,
-        # but global allocation is problematic as it's not "per-region"
-        add_row_to_values('FY240', country, year, cerf_amount)
-        add_row_to_values('FY360', country, year, cerf_amount/cerf_global_allocations if cerf_global_allocations > 0 else 0)
-        add_row_to_values('FY370', country, year, cerf_amount/country_funding if country_funding > 0 else 0)
+    table['FY620'] = amount_by_year.sum(axis=1)
+    table['FY630'] = country_funding
 
-        add_row_to_values('FY380', country, year, erf_amount)
-        add_row_to_values('FY500', country, year, erf_amount/erf_global_allocations if erf_global_allocations > 0 else 0)
-        add_row_to_values('FY510', country, year, erf_amount/country_funding if country_funding > 0 else 0)
+    add_table_to_values(values, country, table)
 
-        add_row_to_values('FY520', country, year, chf_amount)
-        add_row_to_values('FY540', country, year, chf_amount/chf_global_allocations if chf_global_allocations > 0 else 0)
-        add_row_to_values('FY550', country, year, chf_amount/country_funding if country_funding > 0 else 0)
 
-        pooled_funding = cerf_amount + erf_amount + chf_amount
-        country_funding = COUNTRY_FUNDING_CACHE.get_total_country_funding_for_year(country, year)
+def populate_region(region, organization_lookup, country_data=fts_bulk.LIVE_COUNTRY_DATA):
+    """
+    Returns the values for region, in a store of its own
+    """
+    print "Populating indicators for region", region
+    values = create_value_store()
+    populate_appeals_level_data(values, region, country_data)
+    populate_organization_level_data(values, region, organization_lookup, country_data)
+    populate_pooled_fund_data(values, region, country_data)
+    return values
+
 
-        add_row_to_values('FY620', country, year, pooled_funding)
-        add_row_to_values('FY630', country, year, country_funding)
+def populate_data_for_regions(region_list, bulk=False, local_grouping=False, reconcile_grouping=False, workers=1):
+    """
+    Returns the values for all regions, in a fts_indicators.IndicatorStore.
+    With more than 1 worker, that many regions are populated at once, sharing the year caches (and in-flight
+    fetches) between them. Either way the values come out in region_list order.
+    With bulk, data for all regions is loaded up front from the year-level endpoints (see fts_bulk),
+    which needs far fewer calls when populating many regions.
+    With local_grouping (which needs bulk), funding by donor/country/recipient is summed from the bulk-loaded
+    contributions (see fts_aggregation) instead of being queried one grouping at a time. reconcile_grouping queries
+    the server as usual, but reports where the local sums would have differed.
+    """
+    # organizations are an expensive call, the lookup is saved between runs
+    organization_lookup = fts_organizations.get_organization_lookup()
 
+    if bulk:
+        country_data = fts_bulk.YearSweepCountryData(YEAR_START, YEAR_END)
+    else:
+        country_data = fts_bulk.LIVE_COUNTRY_DATA
 
-def populate_data_for_regions(region_list):
-    # cache organizations as it's an expensive call
-    organizations = get_organizations_indexed_by_name()
+    values = create_value_store()
 
-    for region in region_list:
-        print "Populating indicators for region", region
-        populate_appeals_level_data(region)
-        populate_organization_level_data(region, organizations)
-        populate_pooled_fund_data(region)
+    grouping_engine = None
+    if bulk and (local_grouping or reconcile_grouping):
+        grouping_engine = fts_aggregation.LocalGroupingEngine.from_country_data(
+            country_data, countries=fts_queries.fetch_countries_json_as_dataframe())
+        if reconcile_grouping:
+            grouping_engine = fts_aggregation.ReconcilingGroupingEngine(grouping_engine)
+        fts_queries.set_grouping_engine(grouping_engine)
+
+    try:
+        region_values = fts_queries.fetch_many(
+            lambda region: populate_region(region, organization_lookup, country_data), region_list, workers)
+        for region_store in region_values:
+            values.extend(region_store)
+    finally:
+        if grouping_engine is not None:
+            fts_queries.set_grouping_engine(None)
+
+    organization_lookup.print_report()
+    if reconcile_grouping and grouping_engine is not None:
+        grouping_engine.print_report()
+
+    return values
 
 
 if __name__ == "__main__":
+    # keep responses on disk, so a rerun after a failure doesn't start from scratch
+    fts_queries.enable_response_cache()
+    # contributions and organizations hold a lot of repeated strings, which we group on
+    fts_queries.enable_categoricals()
+    # and report where the time went
+    fts_metrics.enable_exit_report(json_path='/tmp/fts_metrics.json')
+
     # regions_of_interest = ['COL', 'KEN', 'YEM']
     # regions_of_interest = ['SSD']  # useful for testing CHF
     # regions_of_interest = ['AFG']  # useful for testing spotty data
     regions_of_interest = fts_queries.fetch_countries_json_as_dataframe().iso_code_A
 
-    populate_data_for_regions(regions_of_interest)
+    value_store = populate_data_for_regions(regions_of_interest, bulk=True, workers=fts_queries.DEFAULT_MAX_WORKERS)
+
+    # print value_store.to_dataframe()
+    # print get_values_joined_with_indicators(value_store)
+    write_values_as_scraperwiki_style_csv(value_store, '/tmp')
 
-    # print get_values_as_dataframe()
-    # print get_values_joined_with_indicators()
-    write_values_as_scraperwiki_style_csv('/tmp')
+    fts_queries.DEFAULT_CLIENT.cache.print_stats()
+    fts_queries.COALESCER.print_stats()
+    fts_queries.DEFAULT_CLIENT.scheduler.print_stats()
@@ -7,129 +7,420 @@ Can be used to produce the following CSV files for upload into CKAN:
   - appeals.csv (for a given country)
   - projects.csv (for a given country, based on appeals)
   - contributions.csv (for given country, based on emergencies, which should capture all appeals, also)
+These can also be written gzipped, or as typed columnar tables (see fts_export and fts_columnar) with --format.
 """
 
+import argparse
+import datetime
+import fts_bulk
+import fts_clusters
+import fts_export
+import fts_manifest
+import fts_metrics
 import fts_queries
+import fts_sync
+import json
 import os
-import pandas as pd
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
 
 # TODO extract strings to header section above the code
 
+CHECKPOINT_FILENAME = 'produce_csvs_checkpoint.json'
+CHECKPOINT_MAX_AGE_HOURS = 12  # so a checkpoint left by a failed nightly run isn't picked up the next night
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+DEFAULT_COUNTRY_WORKERS = 4
+YEAR_START = 1999  # first year that FTS has data
+YEAR_END = datetime.date.today().year + 1  # next year can start to show up near current year-end
 
-def build_csv_path(base_path, object_type, country=None):
+
+def build_csv_path(base_path, object_type, country=None, output_format=fts_export.CSV):
     """
     Using CSV names that duplicate the file paths here, which generally I don't like,
     but having very explicit filenames is maybe nicer to sort out for CKAN.
+    The extension depends on the output format, see fts_export.OUTPUT_FORMATS.
     """
-    filename = 'fts_' + object_type + '.csv'
+    extension = fts_export.OUTPUT_FORMATS[output_format]
+    filename = 'fts_' + object_type + extension
 
     if country:  # a little bit of duplication but easier to read
-        filename = 'fts_' + country + '_' + object_type + '.csv'
+        filename = 'fts_' + country + '_' + object_type + extension
 
     return os.path.join(base_path, filename)
 
 
-def write_dataframe_to_csv(dataframe, path):
+def write_dataframe_to_csv(dataframe, path, manifest=None, inputs=None):
+    """
+    Written in the output format given by the extension of path (CSV unless build_csv_path was told otherwise).
+    With a fts_manifest.OutputManifest, the file is only replaced if its content changed, and dataframe isn't even
+    serialized if the responses noted by inputs (a fts_manifest.InputCollector) are the same as last time
+    """
+    input_hashes = inputs.get_hashes() if inputs is not None else None
+    if manifest is not None and manifest.is_unchanged(path, input_hashes):
+        print "Unchanged", path
+        return
+
     print "Writing", path
     # include the index which is an ID for each of the objects serialized by this script
-    # use Unicode as many non-ASCII characters present in this data
-    dataframe.to_csv(path, index=True, encoding='utf-8')
+    # (CSVs are written as Unicode as many non-ASCII characters present in this data)
+    fts_export.write_dataframe(dataframe, path, manifest, inputs)
 
 
-def filter_out_empty_dataframes(dataframes):
-    # empty dataframes will fail the "if" test
-    return [frame for frame in dataframes if not frame.empty]
+def produce_sectors_csv(output_dir, manifest=None, output_format=fts_export.CSV):
+    with fts_manifest.collect_inputs() as inputs:
+        sectors = fts_queries.fetch_sectors_json_as_dataframe()
+    path = build_csv_path(output_dir, 'sectors', output_format=output_format)
+    write_dataframe_to_csv(sectors, path, manifest, inputs)
 
 
-def produce_sectors_csv(output_dir):
-    sectors = fts_queries.fetch_sectors_json_as_dataframe()
-    write_dataframe_to_csv(sectors, build_csv_path(output_dir, 'sectors'))
+def produce_countries_csv(output_dir, manifest=None, output_format=fts_export.CSV):
+    with fts_manifest.collect_inputs() as inputs:
+        countries = fts_queries.fetch_countries_json_as_dataframe()
+    path = build_csv_path(output_dir, 'countries', output_format=output_format)
+    write_dataframe_to_csv(countries, path, manifest, inputs)
 
 
-def produce_countries_csv(output_dir):
-    countries = fts_queries.fetch_countries_json_as_dataframe()
-    write_dataframe_to_csv(countries, build_csv_path(output_dir, 'countries'))
+def produce_organizations_csv(output_dir, manifest=None, output_format=fts_export.CSV):
+    with fts_manifest.collect_inputs() as inputs:
+        organizations = fts_queries.fetch_organizations_json_as_dataframe()
+    path = build_csv_path(output_dir, 'organizations', output_format=output_format)
+    write_dataframe_to_csv(organizations, path, manifest, inputs)
 
 
-def produce_organizations_csv(output_dir):
-    organizations = fts_queries.fetch_organizations_json_as_dataframe()
-    write_dataframe_to_csv(organizations, build_csv_path(output_dir, 'organizations'))
-
-
-def produce_global_csvs(base_output_dir):
+def produce_global_csvs(base_output_dir, manifest=None, output_format=fts_export.CSV):
     # not sure if this directory creation code should be somewhere else..?
     output_dir = os.path.join(base_output_dir, 'fts', 'global')
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    # produce_sectors_csv(output_dir)  # not sure if this is necessary
-    produce_countries_csv(output_dir)
-    produce_organizations_csv(output_dir)
+    # produce_sectors_csv(output_dir, manifest, output_format)  # not sure if this is necessary
+    produce_countries_csv(output_dir, manifest, output_format)
+    produce_organizations_csv(output_dir, manifest, output_format)
 
 
-def produce_emergencies_csv_for_country(output_dir, country):
-    emergencies = fts_queries.fetch_emergencies_json_for_country_as_dataframe(country)
-    write_dataframe_to_csv(emergencies, build_csv_path(output_dir, 'emergencies', country=country))
+def produce_emergencies_csv_for_country(output_dir, country, manifest=None, output_format=fts_export.CSV,
+                                        country_data=fts_bulk.LIVE_COUNTRY_DATA):
+    with fts_manifest.collect_inputs() as inputs:
+        emergencies = country_data.get_emergencies(country)
+    path = build_csv_path(output_dir, 'emergencies', country=country, output_format=output_format)
+    write_dataframe_to_csv(emergencies, path, manifest, inputs)
 
 
-def produce_appeals_csv_for_country(output_dir, country):
-    appeals = fts_queries.fetch_appeals_json_for_country_as_dataframe(country)
-    write_dataframe_to_csv(appeals, build_csv_path(output_dir, 'appeals', country=country))
+def produce_appeals_csv_for_country(output_dir, country, manifest=None, output_format=fts_export.CSV,
+                                    country_data=fts_bulk.LIVE_COUNTRY_DATA):
+    with fts_manifest.collect_inputs() as inputs:
+        appeals = country_data.get_appeals(country)
+    path = build_csv_path(output_dir, 'appeals', country=country, output_format=output_format)
+    write_dataframe_to_csv(appeals, path, manifest, inputs)
 
 
-def produce_projects_csv_for_country(output_dir, country):
-    # first get all appeals for this country (could eliminate this duplicative call, but it's not expensive)
-    appeals = fts_queries.fetch_appeals_json_for_country_as_dataframe(country)
-    appeal_ids = appeals.index
-    # then get all projects corresponding to those appeals and concatenate into one big frame
-    list_of_projects = [fts_queries.fetch_projects_json_for_appeal_as_dataframe(appeal_id) for appeal_id in appeal_ids]
-    list_of_non_empty_projects = filter_out_empty_dataframes(list_of_projects)
+def produce_projects_csv_for_country(output_dir, country, manifest=None, output_format=fts_export.CSV,
+                                     country_data=fts_bulk.LIVE_COUNTRY_DATA):
+    path = build_csv_path(output_dir, 'projects', country=country, output_format=output_format)
 
-    if list_of_non_empty_projects:
-        projects_frame = pd.concat(list_of_non_empty_projects)
-    else:
-        # we have a choice, missing file or empty file... here I go with empty file
-        projects_frame = pd.DataFrame()
+    with fts_manifest.collect_inputs() as inputs:
+        # first get all appeals for this country (could eliminate this duplicative call, but it's not expensive)
+        appeals = country_data.get_appeals(country)
+        # then write the projects of each of those appeals as they arrive, rather than holding them all in memory
+        # (if there are none we have a choice, missing file or empty file... here I go with empty file)
+        print "Writing", path
 
-    write_dataframe_to_csv(projects_frame, build_csv_path(output_dir, 'projects', country=country))
+        # FTS doesn't standardize cluster names, so add a column that does
+        standardizer = fts_clusters.get_cluster_standardizer()
+        with fts_export.open_writer(path, fts_export.PROJECT_SCHEMA, manifest=manifest, inputs=inputs) as writer:
+            for projects in fts_queries.iter_many(fts_queries.fetch_projects_json_for_appeal_as_dataframe,
+                                                  appeals.index):
+                writer.write(standardizer.standardize_frame(projects))
 
 
-def produce_contributions_csv_for_country(output_dir, country):
-    # first get all emergencies for this country (could eliminate this duplicative call, but it's not expensive)
-    emergencies = fts_queries.fetch_emergencies_json_for_country_as_dataframe(country)
-    emergency_ids = emergencies.index
-    # then get all contributions corresponding to those emergencies and concatenate into one big frame
-    list_of_contributions = [fts_queries.fetch_contributions_json_for_emergency_as_dataframe(emergency_id)
-                             for emergency_id in emergency_ids]
-    list_of_non_empty_contributions = filter_out_empty_dataframes(list_of_contributions)
+def produce_contributions_csv_for_country(output_dir, country, manifest=None, output_format=fts_export.CSV,
+                                          country_data=fts_bulk.LIVE_COUNTRY_DATA):
+    path = build_csv_path(output_dir, 'contributions', country=country, output_format=output_format)
 
-    if list_of_non_empty_contributions:
-        contributions_master_frame = pd.concat(list_of_non_empty_contributions)
-    else:
-        # we have a choice, missing file or empty file... here I go with empty file
-        contributions_master_frame = pd.DataFrame()
+    with fts_manifest.collect_inputs() as inputs:
+        # first get all emergencies for this country (could eliminate this duplicative call, but it's not expensive)
+        emergencies = country_data.get_emergencies(country)
+        # then write the contributions of each of those emergencies as they arrive, rather than holding them all in
+        # memory (if there are none we have a choice, missing file or empty file... here I go with empty file)
+        print "Writing", path
 
-    write_dataframe_to_csv(contributions_master_frame, build_csv_path(output_dir, 'contributions', country=country))
+        with fts_export.open_writer(path, fts_export.CONTRIBUTION_SCHEMA, manifest=manifest,
+                                    inputs=inputs) as writer:
+            for contributions in fts_queries.iter_many(
+                    fts_queries.fetch_contributions_json_for_emergency_as_dataframe, emergencies.index):
+                writer.write(contributions)
 
 
-def produce_csvs_for_country(base_output_dir, country):
+def get_output_dir_for_country(base_output_dir, country):
     output_dir = os.path.join(base_output_dir, 'fts', 'per_country', country)
     if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+        try:
+            os.makedirs(output_dir)
+        except OSError:
+            pass  # another country's thread created the parent directory at the same moment
+    return output_dir
+
 
-    produce_emergencies_csv_for_country(output_dir, country)
-    produce_appeals_csv_for_country(output_dir, country)
-    produce_projects_csv_for_country(output_dir, country)
-    produce_contributions_csv_for_country(output_dir, country)
+def produce_csvs_for_country(base_output_dir, country, manifest=None, output_format=fts_export.CSV,
+                             country_data=fts_bulk.LIVE_COUNTRY_DATA):
+    """
+    country_data provides the country's emergencies and appeals: fetched for the country by default, or taken from a
+    fts_bulk.YearSweepCountryData loaded for all countries at once (which gives the same files)
+    """
+    output_dir = get_output_dir_for_country(base_output_dir, country)
+
+    produce_emergencies_csv_for_country(output_dir, country, manifest, output_format, country_data)
+    produce_appeals_csv_for_country(output_dir, country, manifest, output_format, country_data)
+    produce_projects_csv_for_country(output_dir, country, manifest, output_format, country_data)
+    produce_contributions_csv_for_country(output_dir, country, manifest, output_format, country_data)
+
+
+def produce_csvs_for_country_incrementally(base_output_dir, country, sync_store, manifest=None,
+                                           output_format=fts_export.CSV):
+    """
+    Same CSVs as produce_csvs_for_country, but only refetching what may have changed since the last sync.
+    The tables are built from stored data as well as responses, so with a manifest every file is serialized, but
+    still only replaced if its content changed.
+    """
+    output_dir = get_output_dir_for_country(base_output_dir, country)
+
+    tables = sync_store.sync_country(country)
+    fts_clusters.get_cluster_standardizer().standardize_frame(tables['projects'])
+
+    for object_type in ['emergencies', 'appeals']:
+        path = build_csv_path(output_dir, object_type, country=country, output_format=output_format)
+        write_dataframe_to_csv(tables[object_type], path, manifest)
+
+    # same schema as produce_projects_csv_for_country/produce_contributions_csv_for_country write
+    for object_type, schema in [('projects', fts_export.PROJECT_SCHEMA),
+                                ('contributions', fts_export.CONTRIBUTION_SCHEMA)]:
+        path = build_csv_path(output_dir, object_type, country=country, output_format=output_format)
+        print "Writing", path
+        with fts_export.open_writer(path, schema, manifest=manifest) as writer:
+            writer.write(tables[object_type])
+
+
+class Checkpoint(object):
+    """
+    Records the countries completed so far in a JSON manifest, so a restarted run can skip them.
+    The checkpoint belongs to a run with the given options (a dict of whatever changes which files get written, e.g.
+    the output format), started at a certain time. One left by a run with different options, or started more than
+    max_age_hours ago, is ignored, so countries only get skipped when they were written the same way recently.
+    """
+    def __init__(self, path, options=None, max_age_hours=CHECKPOINT_MAX_AGE_HOURS):
+        self.path = path
+        self.options = options or {}
+        self.lock = threading.Lock()
+        self.started_at = datetime.datetime.now().strftime(TIMESTAMP_FORMAT)
+        self.completed = {}
+
+        if os.path.exists(path):
+            with open(path) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+
+            started_at = checkpoint.get('started_at')
+            if checkpoint.get('options') != self.options:
+                print 'Ignoring checkpoint', path, 'left by a run with other options:', checkpoint.get('options')
+            elif started_at is None or datetime.datetime.strptime(started_at, TIMESTAMP_FORMAT) <\
+                    datetime.datetime.now() - datetime.timedelta(hours=max_age_hours):
+                print 'Ignoring stale checkpoint', path, 'from a run started at', started_at
+            else:
+                self.started_at = started_at
+                self.completed = checkpoint['completed']
+
+    def is_completed(self, country):
+        return country in self.completed
+
+    def mark_completed(self, country, seconds):
+        with self.lock:
+            self.completed[country] = {'finished_at': datetime.datetime.now().strftime(TIMESTAMP_FORMAT),
+                                       'seconds': round(seconds, 1)}
+            checkpoint = {
+                'options': self.options,
+                'started_at': self.started_at,
+                'completed': self.completed,
+            }
+            # write then rename, so a crash mid-write doesn't lose the whole manifest
+            with open(self.path + '.tmp', 'w') as checkpoint_file:
+                json.dump(checkpoint, checkpoint_file, indent=1, sort_keys=True)
+            os.rename(self.path + '.tmp', self.path)
+
+    def clear(self):
+        with self.lock:
+            self.completed = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+class ProgressReporter(object):
+    def __init__(self, total):
+        self.total = total
+        self.finished = 0
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def report(self, country, seconds, error=None):
+        with self.lock:
+            self.finished += 1
+            elapsed = time.time() - self.start
+            per_minute = self.finished * 60. / elapsed if elapsed > 0 else 0.
+            minutes_left = (self.total - self.finished) / per_minute if per_minute > 0 else 0.
+
+            outcome = 'failed (%s)' % error if error is not None else 'done'
+            print '[%d/%d] %s %s in %.1f seconds - %.1f countries/minute, about %.0f minutes left' % \
+                (self.finished, self.total, country, outcome, seconds, per_minute, minutes_left)
+
+
+def produce_csvs_for_countries(base_output_dir, countries, workers=DEFAULT_COUNTRY_WORKERS, checkpoint=None,
+                               sync_store=None, manifest=None, output_format=fts_export.CSV,
+                               country_data=fts_bulk.LIVE_COUNTRY_DATA):
+    """
+    Produces the CSVs for each of countries, workers countries at a time, incrementally if sync_store is given.
+    Countries already completed according to checkpoint are skipped, and others are added to it as they complete
+    (as is the manifest, if given, which keeps unchanged files from being rewritten).
+    Files are written in output_format, one of fts_export.OUTPUT_FORMATS. Unless incremental, the emergencies and
+    appeals come from country_data (see produce_csvs_for_country).
+    A country failing doesn't stop the others; returns the list of (country, traceback text) for those that failed.
+    """
+    countries = list(countries)
+    if checkpoint is not None:
+        remaining_countries = [country for country in countries if not checkpoint.is_completed(country)]
+        if len(remaining_countries) < len(countries):
+            print 'Skipping', len(countries) - len(remaining_countries), 'countries completed in a previous run'
+        countries = remaining_countries
+
+    progress = ProgressReporter(len(countries))
+
+    def produce(country):
+        start = time.time()
+        try:
+            if sync_store is not None:
+                produce_csvs_for_country_incrementally(base_output_dir, country, sync_store, manifest, output_format)
+            else:
+                produce_csvs_for_country(base_output_dir, country, manifest, output_format, country_data)
+        except Exception as error:
+            progress.report(country, time.time() - start, error)
+            return country, traceback.format_exc()
+
+        if manifest is not None:
+            manifest.save()
+        if checkpoint is not None:
+            checkpoint.mark_completed(country, time.time() - start)
+        progress.report(country, time.time() - start)
+        return country, None
+
+    if workers <= 1:
+        results = [produce(country) for country in countries]
+    else:
+        pool = ThreadPool(workers)
+        try:
+            results = list(pool.imap_unordered(produce, countries))
+        finally:
+            pool.close()
+            pool.join()
+
+    return [(country, error) for country, error in results if error is not None]
 
 
 if __name__ == "__main__":
-    # output all CSVs for the given countries to '/tmp/'
+    parser = argparse.ArgumentParser(description='Produce FTS CSVs for CKAN')
+    parser.add_argument('--output-dir', default='/tmp/')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only refetch appeals/emergencies that may have changed since the last incremental run')
+    parser.add_argument('--state-dir', default=fts_sync.DEFAULT_STATE_DIR,
+                        help='where incremental runs keep their tables and state')
+    parser.add_argument('--year-sweep', action='store_true',
+                        help='load the emergencies and appeals of all countries from the year-level endpoints '
+                             'up front, rather than fetching them country by country. That takes 2 fetches per year '
+                             'instead of 2 per country, so it only helps for more countries than years; with fewer, '
+                             'it is skipped')
+    parser.add_argument('--year-start', type=int, default=YEAR_START)
+    parser.add_argument('--year-end', type=int, default=YEAR_END)
+    parser.add_argument('--workers', type=int, default=DEFAULT_COUNTRY_WORKERS,
+                        help='number of countries to produce at once')
+    parser.add_argument('--format', choices=fts_export.OUTPUT_FORMATS.keys(), default=fts_export.CSV,
+                        help='csv, gzipped csv, or typed columnar tables (see fts_columnar) for analysis jobs')
+    parser.add_argument('--compression-workers', type=int, default=fts_export.COMPRESSION_WORKERS,
+                        help='number of threads gzipping output at once, shared by all countries')
+    parser.add_argument('--restart', action='store_true',
+                        help='ignore the checkpoint of an unfinished previous run, and produce all countries')
+    parser.add_argument('--checkpoint-max-age', type=float, default=CHECKPOINT_MAX_AGE_HOURS,
+                        help='hours after which the checkpoint of an unfinished previous run is ignored')
+    args = parser.parse_args()
+    if args.year_sweep and args.incremental:
+        parser.error('--year-sweep and --incremental can not be combined')
+
+    # keep responses on disk, so a rerun after a failure doesn't start from scratch
+    fts_queries.enable_response_cache()
+    # the all-country frames hold a lot of repeated strings
+    fts_queries.enable_categoricals()
+    # gzipped output is compressed on a pool of threads shared by all countries
+    fts_export.set_compression_workers(args.compression_workers)
+    # and report where the time went
+    fts_metrics.enable_exit_report(json_path='/tmp/fts_metrics.json')
+
+    # output all CSVs for the given countries
     # country_codes = ['COL', 'KEN', 'YEM']  # starter countries for HDX
     country_codes = fts_queries.fetch_countries_json_as_dataframe().iso_code_A
 
-    tmp_output_dir = '/tmp/'
-
-    produce_global_csvs(tmp_output_dir)
-    for country_code in country_codes:
-        produce_csvs_for_country(tmp_output_dir, country_code)
+    # the sweep replaces 2 fetches per country with 2 per year, so it's only worth it for more countries than years
+    year_count = args.year_end - args.year_start + 1
+    if args.year_sweep and len(country_codes) <= year_count:
+        print 'Skipping the year sweep, as there are only', len(country_codes), 'countries for', year_count, 'years'
+        args.year_sweep = False
+
+    # only rewrite the files that actually changed since the last run
+    manifest = fts_manifest.OutputManifest(os.path.join(args.output_dir, 'fts', fts_manifest.MANIFEST_FILENAME))
+
+    produce_global_csvs(args.output_dir, manifest, args.format)
+
+    # global CSV production created this directory
+    # countries are only skipped if the previous run wrote them the same way
+    checkpoint_options = {
+        'format': args.format,
+        'incremental': args.incremental,
+        'year_sweep': args.year_sweep,
+        'year_start': args.year_start if args.year_sweep else None,
+        'year_end': args.year_end if args.year_sweep else None,
+    }
+    checkpoint = Checkpoint(os.path.join(args.output_dir, 'fts', CHECKPOINT_FILENAME), checkpoint_options,
+                            args.checkpoint_max_age)
+    if args.restart:
+        checkpoint.clear()
+
+    store = fts_sync.SyncStore(state_dir=args.state_dir) if args.incremental else None
+
+    country_data = fts_bulk.LIVE_COUNTRY_DATA
+    if args.year_sweep:
+        # contributions are still fetched per emergency, country by country, so they needn't all be held at once
+        country_data = fts_bulk.YearSweepCountryData(args.year_start, args.year_end, load_contributions=False)
+
+    failures = produce_csvs_for_countries(args.output_dir, country_codes, workers=args.workers,
+                                          checkpoint=checkpoint, sync_store=store, manifest=manifest,
+                                          output_format=args.format, country_data=country_data)
+
+    # keep the cluster name mappings for next time
+    fts_clusters.get_cluster_standardizer().save_mapping()
+
+    manifest.save()
+    manifest.print_report()
+
+    if not failures:
+        # all done, so the next run starts from scratch
+        checkpoint.clear()
+
+    fts_queries.DEFAULT_CLIENT.cache.print_stats()
+    fts_queries.COALESCER.print_stats()
+    fts_queries.DEFAULT_CLIENT.scheduler.print_stats()
+
+    if failures:
+        print 'Failed for', len(failures), 'countries, run again soon to retry just those:'
+        for country_code, error_traceback in failures:
+            print
+            print country_code
+            print error_traceback
+        # so whatever scheduled the run knows it failed
+        sys.exit(1)
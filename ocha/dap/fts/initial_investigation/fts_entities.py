@@ -0,0 +1,168 @@
+"""
+Compact stores for the entities returned by the FTS API, with the join indexes between them built up front.
+Each store keeps just the fields we use, one numpy array per field with a fixed type, instead of the wide dataframes
+of Python objects fts_queries returns. The foreign keys between entities (appeal -> emergency, project -> appeal,
+contribution -> project, contribution -> recipient organization) are resolved once into arrays of row positions,
+so joining is indexing into an array rather than a pd.merge.
+"""
+
+import numpy as np
+import pandas as pd
+
+# row position used in the join indexes when the referenced entity isn't there
+MISSING = -1
+
+
+class EntityStore(object):
+    """
+    Base class for the stores.
+    FIELDS lists the fields kept, with their numpy dtypes (object for strings); numeric fields that can be missing
+    are float, so they can hold NaN. INDEXED_FIELDS are the fields with a hash index from value to row position.
+    """
+    FIELDS = [('id', np.int64)]
+    INDEXED_FIELDS = ['id']
+
+    def __init__(self, dataframe):
+        """
+        dataframe is as returned by fts_queries, with id either as a column or as the index
+        """
+        if dataframe.index.name == 'id':
+            dataframe = dataframe.reset_index()
+
+        self.size = len(dataframe)
+
+        self.columns = {}
+        for name, dtype in self.FIELDS:
+            if name in dataframe.columns:
+                self.columns[name] = dataframe[name].values.astype(dtype)
+            elif dtype == object:
+                self.columns[name] = np.empty(self.size, dtype=object)
+            else:
+                self.columns[name] = np.empty(self.size, dtype=np.float64)
+                self.columns[name].fill(np.nan)
+
+        self.indexes = dict((name, self.build_index(self.columns[name])) for name in self.INDEXED_FIELDS)
+
+    @staticmethod
+    def build_index(values):
+        index = {}
+        for position, value in enumerate(values):
+            # first one wins if a value repeats; missing values aren't indexed
+            if not pd.isnull(value) and value not in index:
+                index[value] = position
+        return index
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def get_position(self, field, value):
+        return self.indexes[field].get(value, MISSING)
+
+    def get_positions(self, field, values):
+        """
+        Array of the row positions of values in the (indexed) field, MISSING where they aren't found
+        """
+        index = self.indexes[field]
+        return np.array([index.get(value, MISSING) for value in values], dtype=np.int64)
+
+    def get_record(self, field, value):
+        """
+        The row with the given value for the (indexed) field as a dict, or None if there isn't one
+        """
+        position = self.get_position(field, value)
+        if position == MISSING:
+            return None
+        return dict((name, values[position]) for name, values in self.columns.iteritems())
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.columns, columns=[name for name, dtype in self.FIELDS])
+
+
+class CountryStore(EntityStore):
+    FIELDS = [('id', np.int64), ('name', object), ('iso_code_A', object)]
+    INDEXED_FIELDS = ['id', 'name', 'iso_code_A']
+
+
+class EmergencyStore(EntityStore):
+    FIELDS = [('id', np.int64), ('title', object), ('country', object), ('year', np.float64)]
+
+
+class AppealStore(EntityStore):
+    FIELDS = [('id', np.int64), ('title', object), ('type', object), ('country', object), ('year', np.float64),
+              ('emergency_id', np.float64), ('original_requirements', np.float64),
+              ('current_requirements', np.float64), ('funding', np.float64), ('pledges', np.float64)]
+
+
+class ProjectStore(EntityStore):
+    FIELDS = [('id', np.int64), ('code', object), ('appeal_id', np.float64), ('cluster', object),
+              ('organisation', object), ('original_requirements', np.float64), ('current_requirements', np.float64),
+              ('funding', np.float64), ('pledges', np.float64)]
+    INDEXED_FIELDS = ['id', 'code']
+
+
+class ContributionStore(EntityStore):
+    FIELDS = [('id', np.int64), ('emergency_id', np.float64), ('appeal_id', np.float64), ('project_code', object),
+              ('donor', object), ('recipient', object), ('status', object), ('amount', np.float64)]
+
+
+class OrganizationStore(EntityStore):
+    FIELDS = [('id', np.int64), ('name', object), ('abbreviation', object), ('type', object)]
+    INDEXED_FIELDS = ['id', 'name']
+
+
+def build_join_index(store, field, target_store, target_field):
+    """
+    For each row of store, the position in target_store of the row it refers to (through field), or MISSING
+    """
+    if store is None or target_store is None:
+        return None
+    return target_store.get_positions(target_field, store[field])
+
+
+class FtsEntities(object):
+    """
+    A set of entity stores, any of which can be left out, and the join indexes between those present
+    """
+    def __init__(self, countries=None, emergencies=None, appeals=None, projects=None, contributions=None,
+                 organizations=None):
+        self.countries = countries
+        self.emergencies = emergencies
+        self.appeals = appeals
+        self.projects = projects
+        self.contributions = contributions
+        self.organizations = organizations
+
+        self.appeal_emergency_positions = build_join_index(appeals, 'emergency_id', emergencies, 'id')
+        self.project_appeal_positions = build_join_index(projects, 'appeal_id', appeals, 'id')
+        self.contribution_project_positions = build_join_index(contributions, 'project_code', projects, 'code')
+        self.contribution_recipient_positions = build_join_index(contributions, 'recipient', organizations, 'name')
+
+    @classmethod
+    def from_dataframes(cls, countries=None, emergencies=None, appeals=None, projects=None, contributions=None,
+                        organizations=None):
+        """
+        Builds the stores from dataframes as returned by fts_queries
+        """
+        def build(store_class, dataframe):
+            return store_class(dataframe) if dataframe is not None else None
+
+        return cls(countries=build(CountryStore, countries), emergencies=build(EmergencyStore, emergencies),
+                   appeals=build(AppealStore, appeals), projects=build(ProjectStore, projects),
+                   contributions=build(ContributionStore, contributions),
+                   organizations=build(OrganizationStore, organizations))
+
+    def get_contribution_project_field(self, field, contribution_mask=None):
+        """
+        Inner join of contributions (optionally just those selected by contribution_mask) to their projects.
+        Returns the positions of the contributions that have a project, and the project's field for each of them.
+        """
+        project_positions = self.contribution_project_positions
+        joined = project_positions != MISSING
+        if contribution_mask is not None:
+            joined &= contribution_mask
+
+        contribution_positions = np.flatnonzero(joined)
+        return contribution_positions, self.projects[field][project_positions[contribution_positions]]
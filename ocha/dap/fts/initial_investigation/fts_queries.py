@@ -3,7 +3,8 @@ This is just a quick stab to learn the FTS data and figure out how to arrange it
 It provides queries against the FTS API, fetching JSON and translating it into pandas dataframes.
 It unfortunately doesn't show the structure of the returned data explicitly, that's all handled by pandas.
 At some point we may want to create dedicated classes for each type of data returned by the API, to do validation etc,
-but then we'll also need to implement join logic between these classes.
+but then we'll also need to implement join logic between these classes. fts_entities is a start on that: typed stores
+built from these dataframes, with the joins between them indexed.
 """
 
 import pandas as pd
@@ -5,6 +5,7 @@ CERF Funding USD - contributions + commitments
 ERF Funding USD - contributions + commitments
 """
 
+import fts_entities
 import fts_queries
 import pandas as pd
 import argparse
@@ -24,11 +25,17 @@ PLEDGE_NAME = "Pledge"
 contributions = fts_queries.fetch_contributions_json_for_appeal_as_dataframe(appeal_id)
 projects = fts_queries.fetch_projects_json_for_appeal_as_dataframe(appeal_id)
 
-# join contributions with the associated project data
-merged = pd.merge(contributions, projects, left_on='project_code', right_on='code', how='inner')
+entities = fts_entities.FtsEntities.from_dataframes(projects=projects, contributions=contributions)
 
-# exclude pledges
-merged = merged[merged.status != PLEDGE_NAME]
+# join contributions (excluding pledges) with the associated project's cluster
+not_pledges = entities.contributions['status'] != PLEDGE_NAME
+contribution_positions, clusters = entities.get_contribution_project_field('cluster', not_pledges)
+
+merged = pd.DataFrame({
+    'cluster': clusters,
+    'donor': entities.contributions['donor'][contribution_positions],
+    'amount': entities.contributions['amount'][contribution_positions],
+})
 
 # pivot, summing amount by cluster and donor
 pivot = merged.pivot_table(values='amount', aggfunc='sum', rows=['cluster'], cols=['donor'])
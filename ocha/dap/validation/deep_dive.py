@@ -14,6 +14,11 @@ import datetime
 import textwrap
 import matplotlib_utils
 import fts_queries
+import sys
+
+# cluster names are standardized the same way as for the CKAN exports
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fts', 'ckan_loading_old'))
+import fts_clusters
 
 REGIONS_OF_INTEREST = ['COL', 'KEN', 'YEM']
 NEIGHBORS = {
@@ -419,8 +424,19 @@ def plot_fts_funding_over_time(base_path, region):
     write_figure_to_file(figure, dir_path, filename)
 
 
+# appeals are looked up once per year of interest, but the query returns all years, so keep them around
+APPEALS_BY_REGION = {}
+
+
+def get_fts_appeals_for_region(region):
+    if region not in APPEALS_BY_REGION:
+        APPEALS_BY_REGION[region] = fts_queries.fetch_appeals_json_for_country_as_dataframe(region)
+
+    return APPEALS_BY_REGION[region]
+
+
 def get_fts_appeal_ids_for_year(region, year):
-    appeals = fts_queries.fetch_appeals_json_for_country_as_dataframe(region)
+    appeals = get_fts_appeals_for_region(region)
     appeals_in_year = appeals[appeals.year == year]
     return appeals_in_year.index.values
 
@@ -445,15 +461,16 @@ def plot_fts_cluster_funding(base_path, region, year):
     if not cluster_data_list:
         return
 
-    # collapse appeals for a given year
+    # collapse appeals for a given year, under standard cluster names as FTS names them differently across appeals
     concat_cluster_data = pd.concat(cluster_data_list)
-    funding_by_cluster = concat_cluster_data.groupby('name').funding.sum()
+    standardizer = fts_clusters.get_cluster_standardizer()
+    standardizer.standardize_frame(concat_cluster_data, column='name')
+    standardizer.save_mapping()
+    funding_by_cluster = concat_cluster_data.groupby('standard_cluster').funding.sum()
 
     # sort by amount
     funding_by_cluster.sort()
 
-    # TODO standardize the cluster names across years
-
     figure = plt.figure()
     axes = plt.gca()
 